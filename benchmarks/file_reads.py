@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+'''time reading a large file through greenhouse.File at various chunk sizes
+
+each chunk size is run against the whole file and against the first half of
+it, so linear-time reads show up as the same throughput for both'''
+
+import os
+import sys
+import tempfile
+import time
+
+import greenhouse
+
+
+MEGABYTE = 1024 * 1024
+FILE_SIZE = 1024
+CHUNK_SIZES = [64, 512, 4096, 65536, MEGABYTE]
+
+def make_file(megabytes):
+    fd, path = tempfile.mkstemp()
+    block = os.urandom(MEGABYTE)
+    with os.fdopen(fd, 'wb') as fp:
+        for i in xrange(megabytes):
+            fp.write(block)
+    return path
+
+def read_chunks(path, limit, chunksize):
+    fp = greenhouse.File(path)
+    try:
+        total = 0
+        while total < limit:
+            chunk = fp.read(chunksize)
+            if not chunk:
+                break
+            total += len(chunk)
+        return total
+    finally:
+        fp.close()
+
+def readinto_chunks(path, limit, chunksize):
+    fp = greenhouse.File(path)
+    buf = bytearray(chunksize)
+    try:
+        total = 0
+        while total < limit:
+            count = fp.readinto(buf)
+            if not count:
+                break
+            total += count
+        return total
+    finally:
+        fp.close()
+
+def run(name, func, path, limit, chunksize):
+    start = time.time()
+    total = func(path, limit, chunksize)
+    elapsed = time.time() - start
+    print "%-8s %8d byte chunks %6d MB: %7.2fs %8.1f MB/s" % (name, chunksize,
+            total // MEGABYTE, elapsed, total / elapsed / MEGABYTE)
+
+def main():
+    megabytes = len(sys.argv) > 1 and int(sys.argv[1]) or FILE_SIZE
+    path = make_file(megabytes)
+    try:
+        for chunksize in CHUNK_SIZES:
+            for limit in (megabytes * MEGABYTE // 2, megabytes * MEGABYTE):
+                run("read", read_chunks, path, limit, chunksize)
+                run("readinto", readinto_chunks, path, limit, chunksize)
+    finally:
+        os.unlink(path)
+
+
+if __name__ == "__main__":
+    main()
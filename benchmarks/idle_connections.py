@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+'''report the memory cost of each idle greenhouse Socket
+
+the raw sockets are all created up front, so the numbers only cover what
+greenhouse adds on top of them'''
+
+import gc
+import resource
+import socket
+import sys
+
+import greenhouse
+
+
+CONNECTIONS = 10000
+
+def rss():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+def main():
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or CONNECTIONS
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < count * 2 + 64:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        count = min(count, (hard - 64) // 2)
+
+    pairs = [socket.socketpair() for i in xrange(count)]
+    gc.collect()
+    before = rss()
+
+    socks = []
+    for left, right in pairs:
+        socks.append(greenhouse.Socket(fromsock=left))
+        socks.append(greenhouse.Socket(fromsock=right))
+    gc.collect()
+    after = rss()
+
+    print "%d idle sockets: %d bytes each" % (
+            len(socks), (after - before) / len(socks))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+'''measure what it costs to wake a greenlet parked on socket readiness
+
+compares the single-waiter slots sockets park in against the Event
+set()/clear() pair they used to be woken with, then times round trips
+between greenlets over a socket pair'''
+
+import socket
+import sys
+import time
+
+import greenhouse
+import greenhouse.io
+from greenhouse._state import state
+
+
+WAKEUPS = 200000
+ROUNDTRIPS = 20000
+
+def wake_events(count):
+    event = greenhouse.Event()
+    glet = greenhouse.greenlet(lambda: None)
+    start = time.time()
+    for i in xrange(count):
+        event._waiters.append(glet)
+        event.set()
+        event.clear()
+        state.awoken_from_events.clear()
+    return (time.time() - start) / count
+
+def wake_slots(count, timeout=None):
+    sock = greenhouse.Socket()
+    glet = greenhouse.greenlet(lambda: None)
+    unpark = greenhouse.io._unpark
+    start = time.time()
+    for i in xrange(count):
+        sock._readable = glet
+        if timeout is not None:
+            sock._read_deadline = timeout
+            state.timed_paused.append((timeout, glet))
+        unpark(sock, True)
+        state.awoken_from_events.clear()
+    sock.close()
+    return (time.time() - start) / count
+
+def roundtrips(count):
+    left, right = [greenhouse.Socket(fromsock=s) for s in socket.socketpair()]
+    done = greenhouse.Event()
+
+    @greenhouse.schedule
+    def echo():
+        for i in xrange(count):
+            right.send(right.recv(1))
+        done.set()
+
+    start = time.time()
+    for i in xrange(count):
+        left.send("x")
+        left.recv(1)
+    done.wait()
+    elapsed = time.time() - start
+
+    left.close()
+    right.close()
+
+    # each round trip parks and wakes on both sides
+    return elapsed / (count * 2)
+
+def main():
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or WAKEUPS
+
+    print "Event set()/clear():  %6.3f us per wakeup" % (
+            wake_events(count) * 1e6)
+    print "readiness slot:       %6.3f us per wakeup" % (
+            wake_slots(count) * 1e6)
+    print "slot with a timeout:  %6.3f us per wakeup" % (
+            wake_slots(count, time.time() + 60) * 1e6)
+    print "socket pair ping-pong: %5.3f us per event" % (
+            roundtrips(ROUNDTRIPS) * 1e6)
+
+
+if __name__ == "__main__":
+    main()
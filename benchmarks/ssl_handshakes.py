@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+'''measure full TLS handshakes per second against a local self-signed
+server'''
+
+import os
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+import greenhouse
+import greenhouse.ssl
+
+
+PORT = 9000
+HANDSHAKES = 500
+
+def make_certificate(directory):
+    keyfile = os.path.join(directory, "key.pem")
+    certfile = os.path.join(directory, "cert.pem")
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(["openssl", "req", "-x509", "-newkey",
+            "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=localhost",
+            "-keyout", keyfile, "-out", certfile],
+            stdout=devnull, stderr=devnull)
+    return certfile, keyfile
+
+def run(client_context, count):
+    start = time.time()
+    for i in xrange(count):
+        sock = greenhouse.Socket()
+        sock.connect(("127.0.0.1", PORT))
+        sslsock = greenhouse.ssl.wrap_socket(sock, client_context,
+                server_hostname="localhost")
+        sslsock.sendall("x")
+        sslsock.recv(1)
+        sslsock.close()
+    return count / (time.time() - start)
+
+def main():
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or HANDSHAKES
+    certdir = tempfile.mkdtemp()
+    try:
+        certfile, keyfile = make_certificate(certdir)
+
+        server_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        server_context.load_cert_chain(certfile, keyfile)
+        client_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        client_context.verify_mode = ssl.CERT_REQUIRED
+        client_context.load_verify_locations(certfile)
+
+        def handler(sock, address):
+            sslsock = greenhouse.ssl.wrap_socket(sock, server_context,
+                    server_side=True)
+            sslsock.sendall(sslsock.recv(1))
+
+        server = greenhouse.StreamServer(("127.0.0.1", PORT), handler)
+        server.start()
+
+        print "full handshakes: %8.1f/s" % run(client_context, count)
+
+        server.stop(1)
+    finally:
+        shutil.rmtree(certdir)
+
+
+if __name__ == "__main__":
+    main()
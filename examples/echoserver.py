@@ -1,7 +1,5 @@
 #!/usr/bin/env python
 
-import socket
-
 import greenhouse
 
 
@@ -29,17 +27,12 @@ def connection_handler(clientsock, address):
 def main():
     print "localhost echoing server starting on port %d." % PORT
     print "shut it down with <Ctrl>-C"
+    server = greenhouse.StreamServer(("", PORT), connection_handler)
     try:
-        serversock = greenhouse.Socket()
-        serversock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        serversock.bind(("", PORT))
-        serversock.listen(5)
-        while 1:
-            clientsock, address = serversock.accept()
-            greenhouse.schedule(connection_handler, args=[clientsock, address])
+        server.serve_forever()
     except KeyboardInterrupt:
         print "KeyboardInterrupt caught, closing listener socket"
-        serversock.close()
+        server.stop()
 
 
 if __name__ == "__main__":
@@ -1,7 +1,5 @@
 #!/usr/bin/env python
 
-import socket
-
 import greenhouse
 
 
@@ -12,21 +10,14 @@ def start():
     print "localhost nc chat server starting on port %d." % PORT
     print "shut it down with <Ctrl>-C"
 
+    server = greenhouse.StreamServer(("", PORT), connection_handler)
     try:
-        serversock = greenhouse.Socket()
-        serversock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        serversock.bind(("", PORT))
-        serversock.listen(5)
-
-        while 1:
-            clientsock, address = serversock.accept()
-            greenhouse.schedule(connection_handler, args=(clientsock,))
-
+        server.serve_forever()
     except KeyboardInterrupt:
         print "KeyboardInterrupt caught, closing connections"
-        serversock.close()
         for sock in CONNECTED.values():
             sock.close()
+        server.stop()
 
 def broadcast(msg, skip=None):
     for recip in CONNECTED:
@@ -34,7 +25,7 @@ def broadcast(msg, skip=None):
         if sock and not sock._closed and skip != recip:
             sock.sendall(msg)
 
-def connection_handler(clientsock):
+def connection_handler(clientsock, address):
     clientsock.sendall("enter your name up to 20 characters\r\n")
     name = clientsock.recv(8192).rstrip("\r\n")
 
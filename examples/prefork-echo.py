@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+import os
+import socket
+import sys
+
+import greenhouse
+
+
+PORT = 9000
+WORKERS = 4
+
+def connection_handler(clientsock, address):
+    while 1:
+        received = clientsock.recv(8192)
+        if not received:
+            break
+        clientsock.sendall(received)
+
+def main():
+    workers = len(sys.argv) > 1 and int(sys.argv[1]) or WORKERS
+
+    # fork the workers before the front process starts its greenhouse loop,
+    # each one gets its own end of a socket pair to receive connections on
+    channels = []
+    for i in xrange(workers):
+        front, back = socket.socketpair()
+        if not os.fork():
+            # the poller (an epoll or kqueue descriptor) was created at import
+            # and came along through the fork, give the worker its own
+            greenhouse.poller.set()
+            front.close()
+            for channel in channels:
+                channel.close()
+            worker = greenhouse.Worker(greenhouse.Socket(fromsock=back),
+                    connection_handler)
+            worker.serve_forever()
+            os._exit(0)
+        back.close()
+        channels.append(front)
+
+    print "localhost echoing server starting on port %d with %d workers." % (
+            PORT, workers)
+    print "shut it down with <Ctrl>-C"
+    dispatcher = greenhouse.Dispatcher(("", PORT),
+            [greenhouse.Socket(fromsock=channel) for channel in channels])
+    try:
+        dispatcher.serve_forever()
+    except KeyboardInterrupt:
+        dispatcher.stop()
+
+
+if __name__ == "__main__":
+    main()
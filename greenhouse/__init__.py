@@ -4,4 +4,5 @@ from greenhouse.scheduler import *
 from greenhouse.utils import *
 from greenhouse.pool import *
 from greenhouse.io import *
+from greenhouse.server import *
 import greenhouse.poller
@@ -19,3 +19,9 @@ state.descriptormap = collections.defaultdict(list)
 
 # lined up to run right away
 state.to_run = collections.deque()
+
+# sockets with coalesced writes waiting to be flushed
+state.unflushed = set()
+
+# sockets with buffered writes waiting for the poller to find them writable
+state.write_blocked = set()
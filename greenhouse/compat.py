@@ -1,5 +1,13 @@
+import mmap
 import os
+import socket
+import struct
 import sys
+try:
+    import ctypes
+    import ctypes.util
+except ImportError: #pragma: no cover
+    ctypes = None
 try:
     from greenlet import greenlet, GreenletExit
 except ImportError, error: #pragma: no cover
@@ -22,3 +30,415 @@ if sys.platform.lower().startswith("freebsd"):
 else:
     def mkfile(path):
         os.mknod(path, 0644)
+
+
+# system calls that the stdlib doesn't expose, reached through ctypes. each
+# of these is None where libc (or the call) isn't available, so callers must
+# be ready to fall back to a pure-python approach
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+except (AttributeError, OSError): #pragma: no cover
+    _libc = None
+
+if _libc is not None and hasattr(_libc, "writev"):
+    IOV_MAX = 1024
+
+    class _iovec(ctypes.Structure):
+        _fields_ = [("iov_base", ctypes.c_void_p),
+                    ("iov_len", ctypes.c_size_t)]
+
+    _as_read_buffer = ctypes.pythonapi.PyObject_AsReadBuffer
+    _as_read_buffer.argtypes = [ctypes.py_object,
+            ctypes.POINTER(ctypes.c_void_p),
+            ctypes.POINTER(ctypes.c_ssize_t)]
+
+    class _Py_buffer(ctypes.Structure):
+        _fields_ = [("buf", ctypes.c_void_p),
+                    ("obj", ctypes.c_void_p),
+                    ("len", ctypes.c_ssize_t),
+                    ("itemsize", ctypes.c_ssize_t),
+                    ("readonly", ctypes.c_int),
+                    ("ndim", ctypes.c_int),
+                    ("format", ctypes.c_char_p),
+                    ("shape", ctypes.c_void_p),
+                    ("strides", ctypes.c_void_p),
+                    ("suboffsets", ctypes.c_void_p),
+                    ("smalltable", ctypes.c_ssize_t * 2),
+                    ("internal", ctypes.c_void_p)]
+
+    _get_buffer = ctypes.pythonapi.PyObject_GetBuffer
+    _get_buffer.argtypes = [ctypes.py_object, ctypes.POINTER(_Py_buffer),
+            ctypes.c_int]
+    _release_buffer = ctypes.pythonapi.PyBuffer_Release
+    _release_buffer.argtypes = [ctypes.POINTER(_Py_buffer)]
+    _release_buffer.restype = None
+
+    def _buffer_address(obj):
+        # the address and length in bytes of the data behind a str,
+        # bytearray, memoryview, buffer, array or mmap. memoryviews only
+        # speak the new buffer protocol and old-style objects like array and
+        # mmap only the old one on python 2, so try them in that order. the
+        # caller has to hold a reference to obj while using the address
+        if isinstance(obj, (memoryview, bytearray)):
+            view = _Py_buffer()
+            _get_buffer(obj, ctypes.byref(view), 0) # PyBUF_SIMPLE
+            try:
+                return view.buf, view.len
+            finally:
+                _release_buffer(ctypes.byref(view))
+        address, length = ctypes.c_void_p(), ctypes.c_ssize_t()
+        _as_read_buffer(obj, ctypes.byref(address), ctypes.byref(length))
+        return address.value, length.value
+
+    _libc.writev.argtypes = [ctypes.c_int, ctypes.POINTER(_iovec),
+            ctypes.c_int]
+    _libc.writev.restype = ctypes.c_ssize_t
+
+    def writev(fd, buffers, offset=0):
+        """write a sequence of buffers to a descriptor in a single syscall
+
+        the first *offset* bytes of the first buffer are skipped, so a caller
+        can pick up after a partial write without slicing anything. returns
+        the number of bytes written, or raises OSError"""
+        buffers = buffers[:IOV_MAX]
+        iovecs = (_iovec * len(buffers))()
+        for i, buf in enumerate(buffers):
+            address, length = _buffer_address(buf)
+            iovecs[i].iov_base = address + offset
+            iovecs[i].iov_len = length - offset
+            offset = 0
+        rc = _libc.writev(fd, iovecs, len(buffers))
+        if rc < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return rc
+else: #pragma: no cover
+    writev = None
+
+if hasattr(os, "sendfile"): #pragma: no cover
+    sendfile = os.sendfile
+elif _libc is not None and sys.platform.startswith("linux"):
+    _sendfile = getattr(_libc, "sendfile64", None) or _libc.sendfile
+    _sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+            ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    _sendfile.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, count):
+        """copy *count* bytes from *in_fd* at *offset* to *out_fd* in the
+        kernel, returning the number of bytes sent or raising OSError"""
+        rc = _sendfile(out_fd, in_fd, ctypes.byref(ctypes.c_int64(offset)),
+                count)
+        if rc < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return rc
+else: #pragma: no cover
+    sendfile = None
+
+if _libc is not None and hasattr(_libc, "splice"):
+    SPLICE_F_MOVE = 1
+    SPLICE_F_NONBLOCK = 2
+    SPLICE_F_MORE = 4
+
+    _libc.splice.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+            ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+    _libc.splice.restype = ctypes.c_ssize_t
+
+    def splice(fd_in, fd_out, count, flags=SPLICE_F_MOVE | SPLICE_F_NONBLOCK):
+        """move up to *count* bytes from *fd_in* to *fd_out* in the kernel,
+        one of which must be a pipe. returns the number of bytes moved (0 at
+        the end of the input), or raises OSError"""
+        rc = _libc.splice(fd_in, None, fd_out, None, count, flags)
+        if rc < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return rc
+else: #pragma: no cover
+    splice = None
+
+if _libc is not None and sys.platform.startswith("linux"):
+    SCM_RIGHTS = 1
+    MSG_CMSG_CLOEXEC = 0x40000000
+
+    class _msghdr(ctypes.Structure):
+        _fields_ = [("msg_name", ctypes.c_void_p),
+                    ("msg_namelen", ctypes.c_uint32),
+                    ("msg_iov", ctypes.POINTER(_iovec)),
+                    ("msg_iovlen", ctypes.c_size_t),
+                    ("msg_control", ctypes.c_void_p),
+                    ("msg_controllen", ctypes.c_size_t),
+                    ("msg_flags", ctypes.c_int)]
+
+    class _cmsghdr(ctypes.Structure):
+        _fields_ = [("cmsg_len", ctypes.c_size_t),
+                    ("cmsg_level", ctypes.c_int),
+                    ("cmsg_type", ctypes.c_int)]
+
+    def _cmsg_align(length):
+        size = ctypes.sizeof(ctypes.c_size_t)
+        return (length + size - 1) & ~(size - 1)
+
+    _CMSG_HEADER = _cmsg_align(ctypes.sizeof(_cmsghdr))
+
+    _libc.sendmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_msghdr),
+            ctypes.c_int]
+    _libc.sendmsg.restype = ctypes.c_ssize_t
+    _libc.recvmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_msghdr),
+            ctypes.c_int]
+    _libc.recvmsg.restype = ctypes.c_ssize_t
+
+    def sendmsg_fds(fd, data, fds):
+        """send *data* over the AF_UNIX socket *fd*, passing along the file
+        descriptors *fds* (SCM_RIGHTS). returns the number of bytes of data
+        sent, or raises OSError"""
+        address, length = _buffer_address(data)
+        iov = _iovec(address, length)
+
+        fdarray = (ctypes.c_int * len(fds))(*fds)
+        control = ctypes.create_string_buffer(
+                _CMSG_HEADER + _cmsg_align(ctypes.sizeof(fdarray)))
+        cmsg = _cmsghdr.from_buffer(control)
+        cmsg.cmsg_len = _CMSG_HEADER + ctypes.sizeof(fdarray)
+        cmsg.cmsg_level = socket.SOL_SOCKET
+        cmsg.cmsg_type = SCM_RIGHTS
+        ctypes.memmove(ctypes.addressof(control) + _CMSG_HEADER, fdarray,
+                ctypes.sizeof(fdarray))
+
+        msg = _msghdr(None, 0, ctypes.pointer(iov), 1,
+                ctypes.addressof(control), ctypes.sizeof(control), 0)
+        rc = _libc.sendmsg(fd, ctypes.byref(msg), 0)
+        if rc < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return rc
+
+    def recvmsg_fds(fd, bufsize, maxfds):
+        """receive up to *bufsize* bytes from the AF_UNIX socket *fd* along
+        with up to *maxfds* file descriptors passed with them
+
+        returns a two-tuple of the data and a list of the descriptors (which
+        are close-on-exec), or raises OSError"""
+        buf = ctypes.create_string_buffer(bufsize)
+        iov = _iovec(ctypes.addressof(buf), bufsize)
+        fdspace = _cmsg_align(maxfds * ctypes.sizeof(ctypes.c_int))
+        control = ctypes.create_string_buffer(_CMSG_HEADER + fdspace)
+
+        msg = _msghdr(None, 0, ctypes.pointer(iov), 1,
+                ctypes.addressof(control), ctypes.sizeof(control), 0)
+        rc = _libc.recvmsg(fd, ctypes.byref(msg), MSG_CMSG_CLOEXEC)
+        if rc < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        fds = []
+        offset = 0
+        while offset + _CMSG_HEADER <= msg.msg_controllen:
+            cmsg = _cmsghdr.from_buffer(control, offset)
+            if cmsg.cmsg_len < _CMSG_HEADER:
+                break
+            if cmsg.cmsg_level == socket.SOL_SOCKET and \
+                    cmsg.cmsg_type == SCM_RIGHTS:
+                count = (cmsg.cmsg_len - _CMSG_HEADER) // \
+                        ctypes.sizeof(ctypes.c_int)
+                fds.extend((ctypes.c_int * count).from_buffer(
+                    control, offset + _CMSG_HEADER))
+            offset += _cmsg_align(cmsg.cmsg_len)
+
+        return buf.raw[:rc], fds
+else: #pragma: no cover
+    sendmsg_fds = recvmsg_fds = None
+
+if sendmsg_fds is not None and hasattr(_libc, "sendmmsg") and \
+        hasattr(_libc, "recvmmsg"):
+    UIO_MAXIOV = 1024
+    _SOCKADDR_SIZE = 128 # sizeof(struct sockaddr_storage)
+
+    class _mmsghdr(ctypes.Structure):
+        _fields_ = [("msg_hdr", _msghdr),
+                    ("msg_len", ctypes.c_uint)]
+
+    _libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr),
+            ctypes.c_uint, ctypes.c_int]
+    _libc.sendmmsg.restype = ctypes.c_int
+    _libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr),
+            ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    _libc.recvmmsg.restype = ctypes.c_int
+
+    def pack_sockaddr(family, address):
+        """the struct sockaddr for an AF_INET or AF_INET6 *address* tuple,
+        which must have a numeric host. raises socket.error or ValueError"""
+        if family == socket.AF_INET:
+            return struct.pack("=H", family) + \
+                    struct.pack("!H", address[1]) + \
+                    socket.inet_pton(family, address[0]) + "\0" * 8
+        if family == socket.AF_INET6:
+            flowinfo, scope_id = (tuple(address[2:]) + (0, 0))[:2]
+            return struct.pack("=H", family) + \
+                    struct.pack("!HI", address[1], flowinfo) + \
+                    socket.inet_pton(family, address[0]) + \
+                    struct.pack("=I", scope_id)
+        raise ValueError("unsupported address family")
+
+    def unpack_sockaddr(sockaddr):
+        """the address tuple for an AF_INET or AF_INET6 struct sockaddr, as
+        recvfrom() would return it. raises ValueError for anything else"""
+        family = struct.unpack("=H", sockaddr[:2])[0]
+        if family == socket.AF_INET:
+            return (socket.inet_ntop(family, sockaddr[4:8]),
+                    struct.unpack("!H", sockaddr[2:4])[0])
+        if family == socket.AF_INET6:
+            port, flowinfo = struct.unpack("!HI", sockaddr[2:8])
+            return (socket.inet_ntop(family, sockaddr[8:24]), port, flowinfo,
+                    struct.unpack("=I", sockaddr[24:28])[0])
+        raise ValueError("unsupported address family")
+
+    def _mmsghdrs(buffers):
+        # an array of mmsghdrs with a single-iovec message over each buffer
+        msgs = (_mmsghdr * len(buffers))()
+        iovs = (_iovec * len(buffers))()
+        for i, buf in enumerate(buffers):
+            iovs[i].iov_base, iovs[i].iov_len = _buffer_address(buf)
+            msgs[i].msg_hdr.msg_iov = ctypes.pointer(iovs[i])
+            msgs[i].msg_hdr.msg_iovlen = 1
+        return msgs
+
+    def sendmmsg(fd, datagrams):
+        """send a sequence of (data, sockaddr) pairs on the datagram socket
+        *fd* in a single syscall, each sockaddr being from pack_sockaddr()
+
+        returns the number of datagrams sent, which may be fewer than were
+        passed, or raises OSError"""
+        datagrams = datagrams[:UIO_MAXIOV]
+        msgs = _mmsghdrs([data for data, sockaddr in datagrams])
+        names = [ctypes.create_string_buffer(sockaddr, len(sockaddr))
+                for data, sockaddr in datagrams]
+        for msg, name in zip(msgs, names):
+            msg.msg_hdr.msg_name = ctypes.addressof(name)
+            msg.msg_hdr.msg_namelen = len(name)
+        rc = _libc.sendmmsg(fd, msgs, len(msgs), 0)
+        if rc < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return rc
+
+    def recvmmsg(fd, buffers):
+        """receive as many datagrams as are waiting on *fd* in a single
+        syscall, up to one into each of the writable *buffers*
+
+        returns a list of (nbytes, sockaddr) pairs for the buffers that were
+        filled, or raises OSError"""
+        buffers = buffers[:UIO_MAXIOV]
+        msgs = _mmsghdrs(buffers)
+        names = ctypes.create_string_buffer(_SOCKADDR_SIZE * len(buffers))
+        base = ctypes.addressof(names)
+        for i, msg in enumerate(msgs):
+            msg.msg_hdr.msg_name = base + i * _SOCKADDR_SIZE
+            msg.msg_hdr.msg_namelen = _SOCKADDR_SIZE
+        rc = _libc.recvmmsg(fd, msgs, len(msgs), 0, None)
+        if rc < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        raw = names.raw
+        return [(msgs[i].msg_len, raw[i * _SOCKADDR_SIZE:
+                i * _SOCKADDR_SIZE + msgs[i].msg_hdr.msg_namelen])
+                for i in xrange(rc)]
+else: #pragma: no cover
+    sendmmsg = recvmmsg = None
+
+# linux doesn't charge private mappings made with MAP_NORESERVE against the
+# commit limit up front, so even huge files can be mapped copy-on-write
+MAP_NORESERVE = getattr(mmap, "MAP_NORESERVE",
+        sys.platform.startswith("linux") and 0x4000 or 0)
+
+def mmap_private(fd, length):
+    """a private, copy-on-write mapping of *length* bytes of the file *fd*
+
+    writes through it never reach the file, they only touch the process's
+    own copy of the pages"""
+    return mmap.mmap(fd, length, flags=mmap.MAP_PRIVATE | MAP_NORESERVE,
+            prot=mmap.PROT_READ | mmap.PROT_WRITE)
+
+if ctypes is not None:
+    def mmap_view(mapping):
+        """a memoryview over the memory of a writable (private or shared)
+        mmap, which python 2's mmap objects can't provide. the view keeps
+        the mmap alive"""
+        return memoryview((ctypes.c_char * len(mapping)).from_buffer(mapping))
+else: #pragma: no cover
+    mmap_view = None
+
+MADV_NORMAL = 0
+MADV_RANDOM = 1
+MADV_SEQUENTIAL = 2
+MADV_WILLNEED = 3
+MADV_DONTNEED = 4
+
+if _libc is not None and hasattr(_libc, "writev") and \
+        hasattr(_libc, "madvise"):
+    _libc.madvise.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int]
+    _libc.madvise.restype = ctypes.c_int
+
+    def madvise(mapping, advice, start=0, length=None):
+        """advise the kernel how the *length* bytes of *mapping* (an mmap)
+        from *start* on are going to be accessed, raises OSError"""
+        address, size = _buffer_address(mapping)
+        if length is None:
+            length = size - start
+
+        # the start address has to be page-aligned
+        aligned = start - start % mmap.PAGESIZE
+        length += start - aligned
+        if _libc.madvise(address + aligned, length, advice) < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+else: #pragma: no cover
+    madvise = None
+
+if _libc is not None and hasattr(_libc, "inotify_init1"):
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+
+    _inotify_event = struct.Struct("iIII")
+
+    _libc.inotify_init1.argtypes = [ctypes.c_int]
+    _libc.inotify_init1.restype = ctypes.c_int
+    _libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+            ctypes.c_uint32]
+    _libc.inotify_add_watch.restype = ctypes.c_int
+
+    def inotify_init():
+        "create a non-blocking, close-on-exec inotify descriptor"
+        fd = _libc.inotify_init1(os.O_NONBLOCK | 02000000) # IN_CLOEXEC
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return fd
+
+    def inotify_add_watch(fd, path, mask):
+        "watch *path* for the IN_* events in *mask*, returns the watch id"
+        wd = _libc.inotify_add_watch(fd, path, mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return wd
+
+    def inotify_events(data):
+        "parse (wd, mask, cookie, name) tuples from data read off inotify"
+        events = []
+        offset = 0
+        while offset + _inotify_event.size <= len(data):
+            wd, mask, cookie, length = _inotify_event.unpack_from(data, offset)
+            offset += _inotify_event.size
+            name = data[offset:offset + length].rstrip("\0")
+            offset += length
+            events.append((wd, mask, cookie, name))
+        return events
+else: #pragma: no cover
+    inotify_init = inotify_add_watch = inotify_events = None
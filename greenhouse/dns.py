@@ -0,0 +1,403 @@
+import random
+import socket
+import struct
+import time
+
+import greenhouse
+
+
+__all__ = ["Resolver", "resolve", "getaddrinfo", "gethostbyname",
+        "set_resolver"]
+
+RESOLV_CONF = "/etc/resolv.conf"
+HOSTS_FILE = "/etc/hosts"
+
+# the stdlib implementations. getaddrinfo is still used once the host has been
+# resolved to a numeric address, which it handles without touching the network
+_getaddrinfo = socket.getaddrinfo
+_gethostbyname = socket.gethostbyname
+
+QTYPES = {socket.AF_INET: 1, socket.AF_INET6: 28}
+QTYPE_SOA = 6
+CLASS_IN = 1
+RCODE_NXDOMAIN = 3
+FLAG_TRUNCATED = 0x0200
+
+def _is_numeric(host):
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+        except (socket.error, ValueError):
+            continue
+        return True
+    return False
+
+# the resolv.conf options understood, with glibc's limits on them
+RESOLV_OPTIONS = {'ndots': (0, 15), 'timeout': (1, 30), 'attempts': (1, 5)}
+
+def _read_resolv_conf(path):
+    # returns a dict with the nameservers and search list, and whichever of
+    # ndots, timeout and attempts the file sets
+    conf = {'nameservers': [], 'search': []}
+    try:
+        fp = greenhouse.File(path)
+    except IOError:
+        return conf
+    with fp:
+        for line in fp:
+            fields = line.split("#", 1)[0].split(";", 1)[0].split()
+            if len(fields) < 2:
+                continue
+            if fields[0] == "nameserver":
+                conf['nameservers'].append(fields[1])
+            elif fields[0] == "domain":
+                # domain and search override each other, the last one wins
+                conf['search'] = [fields[1].rstrip(".")]
+            elif fields[0] == "search":
+                conf['search'] = [domain.rstrip(".")
+                        for domain in fields[1:]]
+            elif fields[0] == "options":
+                for option in fields[1:]:
+                    name, _, value = option.partition(":")
+                    if name not in RESOLV_OPTIONS:
+                        continue
+                    try:
+                        value = int(value)
+                    except ValueError:
+                        continue
+                    low, high = RESOLV_OPTIONS[name]
+                    conf[name] = max(low, min(value, high))
+    return conf
+
+def _read_hosts(path):
+    hosts = {}
+    try:
+        fp = greenhouse.File(path)
+    except IOError:
+        return hosts
+    with fp:
+        for line in fp:
+            fields = line.split("#", 1)[0].split()
+            if len(fields) < 2:
+                continue
+            family = ':' in fields[0] and socket.AF_INET6 or socket.AF_INET
+            for name in fields[1:]:
+                hosts.setdefault((name.lower(), family), []).append(fields[0])
+    return hosts
+
+def _build_query(qid, name, qtype):
+    labels = []
+    for label in name.rstrip(".").split("."):
+        if not 0 < len(label) < 64:
+            raise socket.gaierror(socket.EAI_NONAME,
+                    "Name or service not known")
+        labels.append(chr(len(label)) + label)
+    return "".join([struct.pack("!6H", qid, 0x0100, 1, 0, 0, 0)] + labels +
+            ["\0", struct.pack("!2H", qtype, CLASS_IN)])
+
+def _read_name(data, offset):
+    # returns the (possibly compressed) name at *offset*, and the offset just
+    # past it in the original record
+    labels, end = [], None
+    for i in xrange(128):
+        length = ord(data[offset])
+        if length & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+            offset = struct.unpack("!H", data[offset:offset + 2])[0] & 0x3FFF
+            continue
+        offset += 1
+        if not length:
+            return ".".join(labels), end is None and offset or end
+        labels.append(data[offset:offset + length])
+        offset += length
+    raise ValueError("name compression loop")
+
+def _parse_response(data, qid, qtype):
+    '''returns (truncated, rcode, addresses, ttl) for a response packet
+
+    raises ValueError if it can't be parsed or doesn't match the query'''
+    try:
+        rid, flags, qdcount, ancount, nscount, arcount = struct.unpack(
+                "!6H", data[:12])
+        if rid != qid or not flags & 0x8000:
+            raise ValueError("not a response to this query")
+        if flags & FLAG_TRUNCATED:
+            return True, 0, [], 0
+
+        offset = 12
+        for i in xrange(qdcount):
+            offset = _read_name(data, offset)[1] + 4
+
+        family = qtype == QTYPES[socket.AF_INET6] and socket.AF_INET6 or \
+                socket.AF_INET
+        addresses, ttl = [], None
+        for i in xrange(ancount + nscount):
+            offset = _read_name(data, offset)[1]
+            rtype, rclass, rttl, rdlength = struct.unpack(
+                    "!2HIH", data[offset:offset + 10])
+            offset += 10
+            rdata = data[offset:offset + rdlength]
+            offset += rdlength
+
+            if i < ancount:
+                if rtype == qtype and rclass == CLASS_IN:
+                    addresses.append(socket.inet_ntop(family, rdata))
+                    ttl = rttl if ttl is None else min(ttl, rttl)
+            elif rtype == QTYPE_SOA and not addresses:
+                # negative answers are cached for the SOA minimum
+                soa_offset = offset - rdlength
+                soa_offset = _read_name(data, soa_offset)[1]
+                soa_offset = _read_name(data, soa_offset)[1]
+                minimum = struct.unpack("!I",
+                        data[soa_offset + 16:soa_offset + 20])[0]
+                ttl = min(rttl, minimum)
+    except (struct.error, IndexError, socket.error), exc:
+        raise ValueError("malformed response: %r" % (exc,))
+
+    return False, flags & 0xF, addresses, ttl
+
+class _Lookup(object):
+    "an in-flight query that other greenlets asking the same thing wait on"
+    def __init__(self):
+        self.done = greenhouse.Event()
+        self.addresses = None
+        self.error = None
+
+class Resolver(object):
+    """a non-blocking stub resolver with an in-process cache
+
+    queries go to *nameservers* (hosts or (host, port) pairs) over UDP
+    through greenhouse sockets, retrying over TCP for truncated responses.
+    names in *hosts* (a dict mapping (name, family) to a list of addresses,
+    by default from /etc/hosts) are answered without a query.
+
+    names with fewer than *ndots* dots are tried with each domain in the
+    *search* list appended before they are tried as they are, names with
+    more the other way around, and names ending in a dot only as they are.
+    the nameservers, search list, ndots, timeout and attempts all default
+    to what /etc/resolv.conf says.
+
+    answers are cached for their TTL, failed lookups for the SOA minimum or
+    *negative_ttl*, and concurrent lookups of the same name share a single
+    query"""
+    PORT = 53
+
+    def __init__(self, nameservers=None, hosts=None, timeout=None,
+            attempts=None, negative_ttl=30, search=None, ndots=None):
+        conf = {}
+        if None in (nameservers, timeout, attempts, search, ndots):
+            conf = _read_resolv_conf(RESOLV_CONF)
+        if nameservers is None:
+            nameservers = conf['nameservers'] or ["127.0.0.1"]
+        self.nameservers = [isinstance(ns, tuple) and ns or (ns, self.PORT)
+                for ns in nameservers]
+        if hosts is None:
+            hosts = _read_hosts(HOSTS_FILE)
+        self.hosts = hosts
+        if search is None:
+            search = conf['search']
+        self.search = [domain.lower().rstrip(".") for domain in search]
+        if ndots is None:
+            ndots = conf.get('ndots', 1)
+        self.ndots = ndots
+        if timeout is None:
+            timeout = conf.get('timeout', 2.0)
+        self.timeout = timeout
+        if attempts is None:
+            attempts = conf.get('attempts', 2)
+        self.attempts = attempts
+        self.negative_ttl = negative_ttl
+        self._cache = {}
+        self._lookups = {}
+
+    def clear_cache(self):
+        self._cache.clear()
+
+    def resolve(self, name, family=socket.AF_INET):
+        """resolve *name* to a list of address strings
+
+        *family* may be AF_INET, AF_INET6, or AF_UNSPEC for both, in which
+        case the two are looked up at the same time and whichever addresses
+        come back are returned even if the other lookup fails. raises
+        socket.gaierror if the name has no addresses or can't be resolved"""
+        if _is_numeric(name):
+            return [name]
+        absolute = name.endswith(".")
+        name = name.lower().rstrip(".")
+        families = family == socket.AF_UNSPEC and \
+                (socket.AF_INET, socket.AF_INET6) or (family,)
+        if any(fam not in QTYPES for fam in families):
+            raise socket.gaierror(socket.EAI_FAMILY,
+                    "ai_family not supported")
+
+        addresses = []
+        for fam in families:
+            addresses.extend(self.hosts.get((name, fam), ()))
+        if addresses:
+            return addresses
+
+        qtypes = [QTYPES[fam] for fam in families]
+        error = None
+        for candidate in self._candidates(name, absolute):
+            addresses, exc = self._lookup_all(candidate, qtypes)
+            if addresses:
+                return addresses
+            error = error or exc
+        raise error or socket.gaierror(socket.EAI_NONAME,
+                "Name or service not known")
+
+    def _candidates(self, name, absolute):
+        # the names to try for *name* in order, following the search list
+        if absolute or not self.search:
+            return [name]
+        searched = ["%s.%s" % (name, domain) for domain in self.search]
+        if name.count(".") >= self.ndots:
+            return [name] + searched
+        return searched + [name]
+
+    def _lookup_all(self, name, qtypes):
+        # look up all of *qtypes* for *name* at once, returning the
+        # addresses found (in qtypes order) and the first error hit
+        results = [None] * len(qtypes)
+        waits = []
+
+        def lookup(i, done=None):
+            try:
+                results[i] = self._lookup(name, qtypes[i])
+            except socket.gaierror, exc:
+                results[i] = exc
+            finally:
+                if done is not None:
+                    done.set()
+
+        for i in xrange(1, len(qtypes)):
+            done = greenhouse.Event()
+            greenhouse.schedule(lookup, args=(i, done))
+            waits.append(done)
+        lookup(0)
+        for done in waits:
+            done.wait()
+
+        addresses, error = [], None
+        for result in results:
+            if isinstance(result, socket.gaierror):
+                error = error or result
+            elif result:
+                addresses.extend(result)
+        return addresses, error
+
+    def _lookup(self, name, qtype):
+        key = (name, qtype)
+        cached = self._cache.get(key)
+        if cached is not None:
+            if cached[0] > time.time():
+                return cached[1]
+            del self._cache[key]
+
+        lookup = self._lookups.get(key)
+        if lookup is not None:
+            # somebody is already asking, just wait for their answer
+            lookup.done.wait()
+        else:
+            lookup = self._lookups[key] = _Lookup()
+            try:
+                addresses, ttl = self._query(name, qtype)
+                self._cache[key] = (time.time() + ttl, addresses)
+                lookup.addresses = addresses
+            except socket.gaierror, exc:
+                lookup.error = exc
+            finally:
+                del self._lookups[key]
+                lookup.done.set()
+
+        if lookup.error is not None:
+            raise lookup.error
+        return lookup.addresses
+
+    def _query(self, name, qtype):
+        qid = random.randrange(0x10000)
+        packet = _build_query(qid, name, qtype)
+        for i in xrange(self.attempts):
+            for server in self.nameservers:
+                try:
+                    truncated, rcode, addresses, ttl = _parse_response(
+                            self._send_udp(server, packet, qid), qid, qtype)
+                    if truncated:
+                        truncated, rcode, addresses, ttl = _parse_response(
+                                self._send_tcp(server, packet), qid, qtype)
+                except (socket.error, ValueError, EOFError):
+                    continue
+
+                if addresses:
+                    return addresses, ttl
+                if rcode in (0, RCODE_NXDOMAIN):
+                    # a real negative answer
+                    if ttl is None:
+                        ttl = self.negative_ttl
+                    return [], min(ttl, self.negative_ttl)
+                # SERVFAIL, REFUSED etc., so try somebody else
+
+        raise socket.gaierror(socket.EAI_AGAIN,
+                "Temporary failure in name resolution")
+
+    def _server_family(self, server):
+        return ':' in server[0] and socket.AF_INET6 or socket.AF_INET
+
+    def _send_udp(self, server, packet, qid):
+        sock = greenhouse.Socket(self._server_family(server),
+                socket.SOCK_DGRAM)
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect(server)
+            sock.send(packet)
+            while 1:
+                response = sock.recv(65535)
+                if response[:2] == packet[:2]:
+                    return response
+        finally:
+            sock.close()
+
+    def _send_tcp(self, server, packet):
+        sock = greenhouse.Socket(self._server_family(server),
+                socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect(server)
+            sock.sendall(struct.pack("!H", len(packet)) + packet)
+            stream = greenhouse.Stream(sock, bufsize=4096)
+            length = struct.unpack("!H", stream.readexactly(2))[0]
+            return stream.readexactly(length)
+        finally:
+            sock.close()
+
+_resolver = None
+
+def set_resolver(resolver=None):
+    "replace the default resolver used by the module-level functions"
+    global _resolver
+    _resolver = resolver
+
+def _get_resolver():
+    if _resolver is None:
+        set_resolver(Resolver())
+    return _resolver
+
+def resolve(name, family=socket.AF_INET):
+    "resolve *name* to a list of addresses with the default Resolver"
+    return _get_resolver().resolve(name, family)
+
+def getaddrinfo(host, port, family=0, socktype=0, proto=0, flags=0):
+    "a non-blocking drop-in replacement for socket.getaddrinfo"
+    if host is None or _is_numeric(host) or \
+            flags & getattr(socket, "AI_NUMERICHOST", 0):
+        return _getaddrinfo(host, port, family, socktype, proto, flags)
+    results = []
+    for address in resolve(host, family):
+        results.extend(_getaddrinfo(address, port, family, socktype, proto,
+                flags | getattr(socket, "AI_NUMERICHOST", 0)))
+    return results
+
+def gethostbyname(name):
+    "a non-blocking drop-in replacement for socket.gethostbyname"
+    return resolve(name, socket.AF_INET)[0]
@@ -1,21 +1,25 @@
+import _io
+import bisect
 import contextlib
 import errno
 import fcntl
 import os
 import socket
 import stat
+import sys
+import thread
+import time
 import weakref
-try:
-    from cStringIO import StringIO
-except ImportError: #pragma: no cover
-    from StringIO import StringIO
 
 import greenhouse
-from greenhouse import utils
+from greenhouse import compat, dns, scheduler, utils
 from greenhouse._state import state
+from greenhouse.compat import greenlet, recvmmsg, recvmsg_fds, sendfile, \
+        sendmmsg, sendmsg_fds, writev
 
 
-__all__ = ["Socket", "File", "monkeypatch", "unmonkeypatch", "pipe"]
+__all__ = ["Socket", "Stream", "RingBuffer", "DatagramEndpoint", "File",
+        "monkeypatch", "unmonkeypatch", "pipe", "splice", "proxy"]
 
 
 _socket = socket.socket
@@ -24,20 +28,161 @@ _file = __builtins__['file']
 
 SOCKET_CLOSED = set((errno.ECONNRESET, errno.ENOTCONN, errno.ESHUTDOWN))
 
+# sendfile() errors meaning the descriptors just don't support it
+SENDFILE_UNSUPPORTED = set((errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK,
+        errno.EOPNOTSUPP))
+
+# the most a pipe holds by default, so the most one splice() call moves
+SPLICE_CHUNK = 65536
+
 def monkeypatch():
     """replace functions in the standard library socket module
     with their non-blocking greenhouse equivalents"""
     socket.socket = Socket
+    socket.getaddrinfo = dns.getaddrinfo
+    socket.gethostbyname = dns.gethostbyname
     __builtins__['open'] = __builtins__['file'] = File
 
 def unmonkeypatch():
     "undo a call to monkeypatch()"
     socket.socket = _socket
+    socket.getaddrinfo = dns._getaddrinfo
+    socket.gethostbyname = dns._gethostbyname
     __builtins__['open'] = _open
     __builtins__['file'] = _file
 
+def _memoryview(data):
+    try:
+        return memoryview(data)
+    except TypeError:
+        # unicode gets the stdlib treatment of the default encoding, and
+        # things like array.array only support the old buffer interface
+        if isinstance(data, unicode):
+            return memoryview(str(data))
+        return memoryview(buffer(data)[:])
+
+def _park(obj, reading, timeout):
+    # wait in a Socket or File's read (or write) readiness slot until
+    # _unpark(), returning False if *timeout* runs out first. a slot usually
+    # holds just the one parked greenlet with its deadline alongside, and
+    # only turns into a list of [greenlet, deadline] pairs when a second
+    # greenlet waits on the same direction
+    current = greenlet.getcurrent()
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+
+    if reading:
+        waiting = obj._readable
+        if waiting is None:
+            obj._readable = current
+            obj._read_deadline = deadline
+        elif type(waiting) is list:
+            waiting.append([current, deadline])
+        else:
+            obj._readable = [[waiting, obj._read_deadline],
+                    [current, deadline]]
+            obj._read_deadline = None
+    else:
+        waiting = obj._writable
+        if waiting is None:
+            obj._writable = current
+            obj._write_deadline = deadline
+        elif type(waiting) is list:
+            waiting.append([current, deadline])
+        else:
+            obj._writable = [[waiting, obj._write_deadline],
+                    [current, deadline]]
+            obj._write_deadline = None
+    if deadline is not None:
+        bisect.insort(state.timed_paused, (deadline, current))
+
+    try:
+        state.mainloop.switch()
+    finally:
+        # still being in the slot means _unpark() wasn't what woke us
+        if reading:
+            waiting = obj._readable
+        else:
+            waiting = obj._writable
+        timed_out = False
+        if waiting is current:
+            timed_out = True
+            if reading:
+                obj._readable = obj._read_deadline = None
+            else:
+                obj._writable = obj._write_deadline = None
+        elif type(waiting) is list:
+            for i, waiter in enumerate(waiting):
+                if waiter[0] is current:
+                    timed_out = True
+                    del waiting[i]
+                    break
+            if not waiting:
+                if reading:
+                    obj._readable = None
+                else:
+                    obj._writable = None
+        if timed_out and deadline is not None:
+            scheduler._untime(deadline, current)
+    return not timed_out
+
+def _unpark(obj, reading):
+    # wake every greenlet parked in a readiness slot. the ones that find
+    # nothing to do for them will just park again
+    if reading:
+        waiting = obj._readable
+        if waiting is None:
+            return
+        deadline = obj._read_deadline
+        obj._readable = obj._read_deadline = None
+    else:
+        waiting = obj._writable
+        if waiting is None:
+            return
+        deadline = obj._write_deadline
+        obj._writable = obj._write_deadline = None
+
+    if type(waiting) is not list:
+        # if the timeout has already scheduled it, leave it to that
+        if deadline is None or scheduler._untime(deadline, waiting):
+            state.awoken_from_events.add(waiting)
+        return
+    for glet, deadline in waiting:
+        if deadline is None or scheduler._untime(deadline, glet):
+            state.awoken_from_events.add(glet)
+
+def _forget_descriptor(obj):
+    # drop a socket or file (and any dead references) from the
+    # descriptormap, leaving alone other objects that share the descriptor
+    refs = state.descriptormap.get(obj._fileno)
+    if refs is None:
+        return
+    refs[:] = [ref for ref in refs if ref() is not None and ref() is not obj]
+    if not refs:
+        del state.descriptormap[obj._fileno]
+
+class _ClosedSocket(socket._closedsocket):
+    # stands in for the underlying socket after a close(), raising EBADF for
+    # everything but closing it again
+    __slots__ = []
+
+    def close(self):
+        pass
+
 #@utils._debugger
 class Socket(object):
+    # there can be a great many of these around at once, mostly sitting idle
+    __slots__ = ["_sock", "family", "type", "proto", "_fileno", "_readable",
+            "_writable", "_read_deadline", "_write_deadline", "_timeout",
+            "_closed", "_registrations",
+            "_makefile_refs", "_close_pending", "_outbuf", "_outbuf_size",
+            "_high_water", "_low_water", "_write_error", "__weakref__"]
+
+    # how long close() waits for buffered writes to go out on a socket with
+    # no timeout of its own
+    CLOSE_TIMEOUT = 5.0
+
     def __init__(self, *args, **kwargs):
         # wrap a basic socket or build our own
         sock = kwargs.pop('fromsock', None) or _socket(*args, **kwargs)
@@ -55,34 +200,45 @@ class Socket(object):
         # make the underlying socket non-blocking
         self.setblocking(False)
 
-        # create events
-        self._readable = greenhouse.Event()
-        self._writable = greenhouse.Event()
-
-        # make sure these events raise socket.timeout upon timeout
-        def timeout_callback():
-            raise socket.timeout("timed out")
-        self._readable._add_timeout_callback(timeout_callback)
-        self._writable._add_timeout_callback(timeout_callback)
+        # the greenlets parked waiting on readability/writability and their
+        # deadlines, if any (see _park)
+        self._readable = self._writable = None
+        self._read_deadline = self._write_deadline = None
 
         # some more housekeeping
         self._timeout = None
         self._closed = False
 
+        # poller registrations currently held, and makefile() file objects
+        # keeping the descriptor open after a close()
+        self._registrations = 0
+        self._makefile_refs = 0
+        self._close_pending = False
+
+        # write buffering is off until setwritebuffer() or setwatermarks()
+        self._outbuf = None
+        self._outbuf_size = 0
+        self._high_water = None
+        self._low_water = None
+        self._write_error = None
+
         # allow for lookup by fileno
         state.descriptormap[self._fileno].append(weakref.ref(self))
 
     def __del__(self):
         try:
-            state.poller.unregister(self)
-            state.descriptormap.pop(self._fileno, None)
+            for i in xrange(self._registrations):
+                state.poller.unregister(self._fileno)
+            _forget_descriptor(self)
         except:
             pass
 
     @contextlib.contextmanager
     def _registered(self, events=None):
+        if self._fileno < 0:
+            raise socket.error(errno.EBADF, "Bad file descriptor")
         poller = state.poller
-        mask = None
+        mask = poller.INMASK | poller.OUTMASK | poller.ERRMASK
         if events:
             mask = 0
             if 'r' in events:
@@ -97,15 +253,48 @@ class Socket(object):
             if error.args and error.args[0] in errno.errorcode:
                 raise socket.error(*error.args)
             raise
+        self._registrations += 1
+
+        try:
+            yield
+        finally:
+            # close() drops all the registrations itself
+            if self._registrations:
+                self._registrations -= 1
+                try:
+                    poller.unregister(self, mask)
+                except (IOError, OSError), error: #pragma: no cover
+                    if error.args and error.args[0] in errno.errorcode:
+                        raise socket.error(*error.args)
+                    raise
 
-        yield
+    def _wait(self, reading):
+        # park the current greenlet until the poller finds the socket
+        # readable (or writable), raising socket.timeout on our timeout
+        if not _park(self, reading, self._timeout):
+            raise socket.timeout("timed out")
 
+    def _nonblocking(self, events, func, *args):
+        # optimistically try the call first, and only register with the
+        # poller and park on the event if it would have blocked
+        if self._closed:
+            raise socket.error(errno.EBADF, "Bad file descriptor")
         try:
-            poller.unregister(self)
-        except (IOError, OSError), error: #pragma: no cover
-            if error.args and error.args[0] in errno.errorcode:
-                raise socket.error(*error.args)
-            raise
+            return func(*args)
+        except socket.error, err:
+            if err[0] not in (errno.EWOULDBLOCK, errno.EAGAIN):
+                raise
+
+        with self._registered(events):
+            while 1:
+                self._wait(events == 'r')
+                if self._closed:
+                    raise socket.error(errno.EBADF, "Bad file descriptor")
+                try:
+                    return func(*args)
+                except socket.error, err:
+                    if err[0] not in (errno.EWOULDBLOCK, errno.EAGAIN):
+                        raise
 
     def accept(self):
         with self._registered('r'):
@@ -114,7 +303,7 @@ class Socket(object):
                     client, addr = self._sock.accept()
                 except socket.error, err:
                     if err[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
-                        self._readable.wait(self._timeout)
+                        self._wait(True)
                         continue
                     else:
                         raise #pragma: no cover
@@ -124,18 +313,80 @@ class Socket(object):
         return self._sock.bind(*args, **kwargs)
 
     def close(self):
-        # as much as this sucks, it's necessary for sufficient stdlib socket
-        # compatibility to make httplib (and by extension urllib, urllib2)
-        # work. the problem is it calls close(), then recv(). WTF
-        pass
+        """close the socket, releasing its file descriptor
+
+        like the stdlib socket, file objects from makefile() keep the
+        descriptor open until they are closed as well (httplib relies on
+        this). any greenlets blocked on the socket get an EBADF socket.error.
+
+        writes buffered by setwritebuffer() or setwatermarks() are flushed
+        first, waiting up to the socket's timeout (or CLOSE_TIMEOUT). if they
+        can't all go out, or an earlier buffered write failed, the socket is
+        still closed but the error is raised from here"""
+        if self._makefile_refs:
+            self._close_pending = True
+        else:
+            self._close()
+
+    def _decref(self):
+        self._makefile_refs -= 1
+        if self._close_pending and not self._makefile_refs:
+            self._close()
+
+    def _close(self):
+        if self._fileno < 0:
+            return
+
+        # buffered writes were already reported as sent, so get them out
+        # (or at least report that they didn't make it)
+        error = None
+        if self._outbuf is not None:
+            timeout = self._timeout
+            if timeout is None:
+                self._timeout = self.CLOSE_TIMEOUT
+            try:
+                self.flush()
+            except socket.error, err:
+                error = err
+            finally:
+                self._timeout = timeout
+        self._outbuf = None
+        state.unflushed.discard(self)
+        state.write_blocked.discard(self)
+
+        for i in xrange(self._registrations):
+            try:
+                state.poller.unregister(self._fileno)
+            except (IOError, OSError): #pragma: no cover
+                pass
+        self._registrations = 0
+        _forget_descriptor(self)
+
+        self._closed = True
+        self._sock.close()
+        self._sock = _ClosedSocket()
+        self._fileno = -1
+
+        # wake up anything blocked on the socket so it finds it closed
+        _unpark(self, True)
+        _unpark(self, False)
+
+        if error is not None:
+            raise error
 
     def connect(self, address):
+        if self.family in (socket.AF_INET, socket.AF_INET6) and address[0] \
+                and not dns._is_numeric(address[0]):
+            # resolve hostnames cooperatively rather than letting the
+            # underlying socket block the whole process in getaddrinfo
+            address = (dns.resolve(address[0], self.family)[0],) + \
+                    tuple(address[1:])
         with self._registered('w'):
             while True:
                 err = self.connect_ex(address)
                 if err in (errno.EINPROGRESS, errno.EALREADY,
                         errno.EWOULDBLOCK):
-                    self._writable.wait(self._timeout)
+                    self._wait(False)
                     continue
                 if err not in (0, errno.EISCONN): #pragma: no cover
                     raise socket.error(err, errno.errorcode[err])
@@ -166,53 +417,203 @@ class Socket(object):
         return self._sock.listen(backlog)
 
     def makefile(self, mode='r', bufsize=-1):
-        return socket._fileobject(self, mode, bufsize)
+        return _SocketFile(self, mode, bufsize)
 
-    def recv(self, nbytes):
-        with self._registered('r'):
-            while 1:
-                if self._closed:
-                    raise socket.error(errno.EBADF, "Bad file descriptor")
-                try:
-                    return self._sock.recv(nbytes)
-                except socket.error, e:
-                    if e[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
-                        self._readable.wait(self._timeout)
-                        continue
-                    if e[0] in SOCKET_CLOSED:
-                        self._closed = True
-                        return ''
-                    raise #pragma: no cover
+    def recv(self, nbytes, flags=0):
+        try:
+            return self._nonblocking('r', self._sock.recv, nbytes, flags)
+        except socket.error, err:
+            if err[0] in SOCKET_CLOSED:
+                self._closed = True
+                return ''
+            raise
 
-    def recv_into(self, buffer, nbytes):
-        with self._registered('r'):
-            self._readable.wait(self._timeout)
-            return self._sock.recv_into(buffer, nbytes)
+    def recv_fds(self, bufsize, maxfds):
+        """receive up to *bufsize* bytes and up to *maxfds* file descriptors
+        sent with send_fds() over an AF_UNIX socket
 
-    def recvfrom(self, nbytes):
-        with self._registered('r'):
-            self._readable.wait(self._timeout)
-            return self._sock.recvfrom(nbytes)
+        returns a two-tuple of the data and a list of the received
+        descriptors, which now belong to the caller"""
+        if recvmsg_fds is None: #pragma: no cover
+            raise NotImplementedError("descriptor passing isn't supported")
+        try:
+            return self._nonblocking('r', self._recvmsg_fds, bufsize, maxfds)
+        except socket.error, err:
+            if err[0] in SOCKET_CLOSED:
+                self._closed = True
+                return '', []
+            raise
 
-    def recvfrom_into(self, buffer, nbytes):
-        with self._registered('r'):
-            self._readable.wait(self._timeout)
-            return self._sock.recvfrom_into(buffer, nbytes)
+    def _recvmsg_fds(self, bufsize, maxfds):
+        try:
+            return recvmsg_fds(self._fileno, bufsize, maxfds)
+        except (OSError, IOError), err:
+            raise socket.error(*err.args)
+
+    def recv_into(self, buffer, nbytes=0, flags=0):
+        return self._nonblocking('r', self._sock.recv_into, buffer, nbytes,
+                flags)
 
-    def send(self, data):
+    def recvfrom(self, nbytes, flags=0):
+        return self._nonblocking('r', self._sock.recvfrom, nbytes, flags)
+
+    def recvfrom_into(self, buffer, nbytes=0, flags=0):
+        return self._nonblocking('r', self._sock.recvfrom_into, buffer,
+                nbytes, flags)
+
+    def send(self, data, flags=0):
+        if self._outbuf is not None:
+            self._buffer_write(data)
+            return len(data)
         try:
-            return self._sock.send(data)
+            return self._sock.send(data, flags)
         except socket.error, err: #pragma: no cover
             if err[0] in (errno.EWOULDBLOCK, errno.ENOTCONN):
                 return 0
             raise
 
-    def sendall(self, data):
-        with self._registered('w'):
-            sent = self.send(data)
-            while sent < len(data): #pragma: no cover
-                self._writable.wait(self._timeout)
-                sent += self.send(data[sent:])
+    def sendall(self, data, flags=0):
+        if self._outbuf is not None:
+            self._buffer_write(data)
+            return
+        view = _memoryview(data)
+        sent = self.send(view, flags)
+        if sent < len(view):
+            with self._registered('w'):
+                while sent < len(view):
+                    self._wait(False)
+                    if self._closed:
+                        raise socket.error(errno.EBADF, "Bad file descriptor")
+                    sent += self.send(view[sent:], flags)
+
+    def send_fds(self, data, fds):
+        """send *data* along with the file descriptors *fds* (ints or objects
+        with a fileno() method) over an AF_UNIX socket
+
+        the descriptors are duplicated into the receiving process, so the
+        sender is still responsible for closing its own copies. they travel
+        with the start of *data*, which mustn't be empty"""
+        if sendmsg_fds is None: #pragma: no cover
+            raise NotImplementedError("descriptor passing isn't supported")
+        if not data:
+            raise ValueError("descriptors must be sent with some data")
+        fds = [fd if isinstance(fd, (int, long)) else fd.fileno()
+                for fd in fds]
+        if self._outbuf:
+            self.flush()
+
+        sent = self._nonblocking('w', self._sendmsg_fds, data, fds)
+        if sent < len(data):
+            self.sendall(_memoryview(data)[sent:])
+
+    def _sendmsg_fds(self, data, fds):
+        try:
+            return sendmsg_fds(self._fileno, data, fds)
+        except (OSError, IOError), err:
+            raise socket.error(*err.args)
+
+    def send_many(self, buffers):
+        """send a sequence of buffers as though they were concatenated
+
+        the buffers may be anything sendall() takes. as many buffers as
+        possible go out in each writev() call, and partial writes resume
+        mid-buffer, so nothing gets joined or sliced"""
+        buffers = [view for view in map(_memoryview, buffers) if len(view)]
+        if self._outbuf is not None:
+            for buf in buffers:
+                self._buffer_write(buf)
+            return
+        if writev is None: #pragma: no cover
+            for buf in buffers:
+                self.sendall(buf)
+            return
+
+        index, offset = self._writev_some(buffers, 0, 0)
+        if index < len(buffers):
+            with self._registered('w'):
+                while index < len(buffers):
+                    self._wait(False)
+                    if self._closed:
+                        raise socket.error(errno.EBADF, "Bad file descriptor")
+                    index, offset = self._writev_some(buffers, index, offset)
+
+    def _writev_some(self, buffers, index, offset):
+        # writev() until it would block, then return the new position
+        while index < len(buffers):
+            try:
+                sent = writev(self._fileno, buffers[index:], offset)
+            except (OSError, IOError), err:
+                if err.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    break
+                raise socket.error(*err.args)
+
+            # advance past the buffers that were completely written. sent
+            # counts bytes, so measure the views in bytes too
+            while sent:
+                view = buffers[index]
+                remaining = len(view) * view.itemsize - offset
+                if sent < remaining:
+                    offset += sent
+                    break
+                sent -= remaining
+                index += 1
+                offset = 0
+        return index, offset
+
+    def sendfile(self, file, offset=0, count=None):
+        """send *count* bytes of *file* starting from *offset*
+
+        with a *count* of None, everything after *offset* is sent. this uses
+        the sendfile system call so the data never has to be copied into
+        python strings, falling back to a read/send loop where sendfile isn't
+        supported. returns the number of bytes sent, and leaves the file
+        positioned just past them"""
+        if self._outbuf:
+            self.flush()
+        # sendfile reads from the descriptor, so data still sitting in a
+        # File's write buffer has to get there first
+        if isinstance(file, File) and file._wbuf:
+            file.flush()
+        infd = file.fileno()
+        if count is None:
+            count = max(os.fstat(infd).st_size - offset, 0)
+
+        total = 0
+        if sendfile is not None:
+            with self._registered('w'):
+                while total < count:
+                    try:
+                        sent = sendfile(self._fileno, infd, offset + total,
+                                count - total)
+                    except (OSError, IOError), err:
+                        if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                            self._wait(False)
+                            if self._closed:
+                                raise socket.error(errno.EBADF,
+                                        "Bad file descriptor")
+                            continue
+                        if err.args[0] in SENDFILE_UNSUPPORTED and not total:
+                            break
+                        raise socket.error(*err.args)
+                    if not sent:
+                        # hit the end of the file
+                        count = total
+                        break
+                    total += sent
+
+        if total < count:
+            # sendfile isn't supported here, do it the old-fashioned way
+            file.seek(offset)
+            while total < count:
+                data = file.read(min(count - total, 65536))
+                if not data:
+                    break
+                self.sendall(data)
+                total += len(data)
+        else:
+            file.seek(offset + total)
+
+        return total
 
     def sendto(self, *args):
         try:
@@ -222,6 +623,119 @@ class Socket(object):
                 return 0
             raise
 
+    def setwritebuffer(self, size):
+        """turn on write coalescing with a buffer of *size* bytes
+
+        while it is on, send(), sendall() and send_many() only append to a
+        buffer, and the scheduler sends everything that has accumulated right
+        before it next polls. buffers growing past *size* are flushed early.
+        a *size* of 0 flushes the buffer and turns coalescing back off"""
+        self._high_water = self._low_water = None
+        if size:
+            if self._outbuf is None:
+                self._outbuf = bytearray()
+            self._outbuf_size = size
+        elif self._outbuf is not None:
+            self.flush()
+            self._outbuf = None
+
+    def setwatermarks(self, high, low=None):
+        """buffer outgoing data so that writing never blocks
+
+        send(), sendall() and send_many() only append to a buffer, which goes
+        out in the background whenever the socket is writable. to bound its
+        memory, drain() blocks while more than *high* bytes are buffered,
+        until they are down to *low* (a quarter of *high* by default). the
+        whole buffer, not just what is above *low*, still goes out before
+        shutdown() or close(). a *high* of 0 flushes the buffer and turns
+        buffering back off"""
+        if not high:
+            self.setwritebuffer(0)
+            return
+        if low is None:
+            low = high // 4
+        if low > high:
+            raise ValueError("low watermark is above the high watermark")
+        if self._outbuf is None:
+            self._outbuf = bytearray()
+        self._outbuf_size = 0
+        self._high_water = high
+        self._low_water = low
+
+    def drain(self):
+        """with more than the high watermark buffered (see setwatermarks),
+        block until the buffer is down to the low watermark"""
+        self._raise_write_error()
+        if self._high_water is None or len(self._outbuf) <= self._high_water:
+            return
+        with self._registered('w'):
+            while not self._flush_some() and \
+                    len(self._outbuf) > self._low_water:
+                self._wait(False)
+                if self._closed:
+                    raise socket.error(errno.EBADF, "Bad file descriptor")
+        self._raise_write_error()
+
+    def _buffer_write(self, data):
+        self._raise_write_error()
+        self._outbuf += data
+        if self not in state.write_blocked:
+            state.unflushed.add(self)
+        if self._outbuf_size and len(self._outbuf) >= self._outbuf_size:
+            self.flush()
+
+    def _raise_write_error(self):
+        if self._write_error is not None:
+            err, self._write_error = self._write_error, None
+            raise err
+
+    def _flush_some(self):
+        # send as much of the coalesced buffer as the socket will take
+        # without blocking. errors get saved for the next write or flush,
+        # since this may be running from the scheduler
+        try:
+            sent = self._sock.send(self._outbuf)
+        except socket.error, err:
+            if err[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                sent = 0
+            else:
+                self._write_error = err
+                sent = len(self._outbuf)
+        del self._outbuf[:sent]
+        if self._outbuf:
+            self._flush_when_writable()
+            return False
+        state.unflushed.discard(self)
+        if self in state.write_blocked:
+            state.write_blocked.discard(self)
+            if self._registrations:
+                self._registrations -= 1
+                state.poller.unregister(self, state.poller.OUTMASK)
+        return True
+
+    def _flush_when_writable(self):
+        # rather than retrying before every poll, have the scheduler flush
+        # again once the poller finds the socket writable
+        if self in state.write_blocked or self._fileno < 0:
+            return
+        try:
+            state.poller.register(self, state.poller.OUTMASK)
+        except (IOError, OSError): #pragma: no cover
+            return
+        self._registrations += 1
+        state.unflushed.discard(self)
+        state.write_blocked.add(self)
+
+    def flush(self):
+        "send any coalesced writes, blocking until they have all gone out"
+        if self._outbuf and not self._flush_some():
+            with self._registered('w'):
+                while not self._flush_some():
+                    self._wait(False)
+                    if self._closed:
+                        raise socket.error(errno.EBADF, "Bad file descriptor")
+        self._raise_write_error()
+
     def setblocking(self, flag):
         return self._sock.setblocking(flag)
 
@@ -229,16 +743,421 @@ class Socket(object):
         return self._sock.setsockopt(level, option, value)
 
     def shutdown(self, flag):
+        # buffered writes were already reported as sent, so they have to go
+        # out before the writing half is shut
+        if self._outbuf and flag in (socket.SHUT_WR, socket.SHUT_RDWR):
+            self.flush()
         return self._sock.shutdown(flag)
 
     def settimeout(self, timeout):
         self._timeout = timeout
 
+class _SocketFile(socket._fileobject):
+    # a makefile() file object, keeping the descriptor of *refsock* open
+    # until it is closed itself
+    __slots__ = ["_refsock"]
+
+    def __init__(self, sock, mode='r', bufsize=-1, refsock=None):
+        socket._fileobject.__init__(self, sock, mode, bufsize)
+        self._refsock = refsock or sock
+        self._refsock._makefile_refs += 1
+
+    def close(self):
+        try:
+            socket._fileobject.close(self)
+        finally:
+            refsock, self._refsock = self._refsock, None
+            if refsock is not None:
+                refsock._decref()
+
+class _ReadBuffer(object):
+    # the reusable read buffer behind Stream and File: buffered data lives in
+    # self._buf (through self._view) between self._start and self._end
+
+    def _make_room(self, needed):
+        # make sure there are at least *needed* bytes of space after the
+        # currently buffered data, moving it to the front or growing the
+        # buffer only when that is actually necessary
+        start, end = self._start, self._end
+        if len(self._buf) - end >= needed:
+            return
+
+        buffered = end - start
+        if buffered + needed <= len(self._buf):
+            self._view[:buffered] = self._view[start:end]
+        else:
+            buf = bytearray(max(len(self._buf) * 2, buffered + needed))
+            buf[:buffered] = self._view[start:end]
+            self._buf, self._view = buf, memoryview(buf)
+        self._start, self._end = 0, buffered
+
+    def _consume(self, nbytes):
+        start = self._start
+        self._start += nbytes
+        rc = self._view[start:self._start].tobytes()
+        if self._start == self._end and self._rewindable():
+            self._start = self._end = 0
+        return rc
+
+    def _rewindable(self):
+        # whether a drained buffer can start over from the front
+        return True
+
+class Stream(_ReadBuffer):
+    """a buffered reader over a greenhouse Socket
+
+    received data goes into one large reusable bytearray via recv_into, and
+    the line/delimiter/length-based read methods slice their results
+    directly out of it"""
+    BUFSIZE = 65536
+    MAX_LINE = 65536
+
+    class Incomplete(EOFError):
+        "raised when the connection closes before a read could complete"
+        def __init__(self, partial, expected):
+            EOFError.__init__(self, "%d bytes read on a total of %s expected"
+                    % (len(partial), expected))
+            self.partial = partial
+            self.expected = expected
+
+    class LimitExceeded(ValueError):
+        "raised when no delimiter was found within the maximum line length"
+        pass
+
+    def __init__(self, sock, bufsize=None, max_line=None):
+        self.sock = sock
+        self.max_line = max_line or self.MAX_LINE
+        self._buf = bytearray(bufsize or self.BUFSIZE)
+        self._view = memoryview(self._buf)
+        self._start = self._end = 0
+        self._eof = False
+
+    def __iter__(self):
+        line = self.readline()
+        while line:
+            yield line
+            line = self.readline()
+
+    def _fill(self, needed=1):
+        "one recv_into the end of the buffer, returns the number of bytes read"
+        if self._eof:
+            return 0
+        self._make_room(needed)
+        end = self._end
+        received = self.sock.recv_into(self._view[end:], len(self._buf) - end)
+        if not received:
+            self._eof = True
+        self._end += received
+        return received
+
+    def buffered(self):
+        "the number of bytes which can be read without touching the socket"
+        return self._end - self._start
+
+    def peek(self, size=-1):
+        """return up to *size* bytes without consuming them
+
+        this only waits on the socket if nothing at all is buffered yet"""
+        if self._start == self._end:
+            self._fill()
+        end = self._end
+        if size >= 0:
+            end = min(end, self._start + size)
+        return self._view[self._start:end].tobytes()
+
+    def read(self, size=-1):
+        """read up to *size* bytes, blocking only if nothing is buffered
+
+        with a negative *size* this reads everything until the connection is
+        closed"""
+        if size < 0:
+            while self._fill(self.BUFSIZE):
+                pass
+            return self._consume(self._end - self._start)
+        if self._start == self._end:
+            self._fill()
+        return self._consume(min(size, self._end - self._start))
+
+    def readexactly(self, size):
+        """read exactly *size* bytes
+
+        raises Stream.Incomplete (with the bytes that were available as the
+        ``partial`` attribute) if the connection closes first"""
+        while self._end - self._start < size:
+            if not self._fill(size - (self._end - self._start)):
+                raise self.Incomplete(
+                        self._consume(self._end - self._start), size)
+        return self._consume(size)
+
+    def readuntil(self, delimiter="\n"):
+        """read up to and including the next occurrence of *delimiter*
+
+        raises Stream.LimitExceeded if *delimiter* isn't found within
+        *max_line* bytes, and Stream.Incomplete if the connection closes
+        first"""
+        dlen, limit = len(delimiter), self.max_line
+        scanned = self._start
+        while 1:
+            index = self._buf.find(delimiter, scanned, self._end)
+            if index >= 0:
+                if index + dlen - self._start > limit:
+                    break
+                return self._consume(index + dlen - self._start)
+
+            # don't re-scan what we already looked at
+            scanned = max(self._start, self._end - dlen + 1)
+
+            if self._end - self._start >= limit:
+                break
+
+            offset = scanned - self._start
+            if not self._fill():
+                raise self.Incomplete(
+                        self._consume(self._end - self._start), None)
+            scanned = self._start + offset
+
+        raise self.LimitExceeded("delimiter not found within %d bytes" % limit)
+
+    def readline(self):
+        """read a single line, including the trailing newline
+
+        like file.readline(), at the end of the stream this returns whatever
+        is left over without a newline, and the empty string after that"""
+        try:
+            return self.readuntil("\n")
+        except self.Incomplete, exc:
+            return exc.partial
+
+class RingBuffer(object):
+    """a fixed-size circular receive buffer
+
+    *buffer* is either a size or a caller-owned bytearray (or a writable
+    memoryview over one). fill() receives from a socket straight into the
+    free space, and views() hands back memoryviews over the unread data so
+    it can be parsed in place"""
+    def __init__(self, buffer):
+        if isinstance(buffer, (int, long)):
+            buffer = bytearray(buffer)
+        self.buffer = memoryview(buffer)
+        self.size = len(self.buffer)
+        self._head = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def free(self):
+        "the number of bytes that can still be received into the buffer"
+        return self.size - self._count
+
+    def fill(self, sock):
+        """receive once from *sock* into the contiguous free region
+
+        returns the number of bytes received, which is 0 when the connection
+        has been closed"""
+        if self._count == self.size:
+            raise BufferError("ring buffer is full")
+        if not self._count:
+            self._head = 0
+        tail = self._head + self._count
+        if tail < self.size:
+            start, end = tail, self.size
+        else:
+            start, end = tail - self.size, self._head
+        received = sock.recv_into(self.buffer[start:end], end - start)
+        self._count += received
+        return received
+
+    def views(self):
+        "a list of one or two memoryviews covering the unread data, in order"
+        head, tail = self._head, self._head + self._count
+        if tail <= self.size:
+            return [self.buffer[head:tail]]
+        return [self.buffer[head:], self.buffer[:tail - self.size]]
+
+    def consume(self, nbytes):
+        "mark *nbytes* of the unread data as processed, freeing the space"
+        if nbytes > self._count:
+            raise ValueError("can't consume more than is buffered")
+        self._head = (self._head + nbytes) % self.size
+        self._count -= nbytes
+
+class DatagramEndpoint(object):
+    """a datagram socket that receives in batches
+
+    each recv_batch() drains every pending datagram (up to *batch_size*)
+    into a set of preallocated *bufsize* buffers, only waiting on the socket
+    when nothing at all is pending. *sock* is a bound greenhouse Socket, or
+    an address to bind a new UDP socket to.
+
+    for AF_INET and AF_INET6 sockets on linux a whole batch goes through a
+    single recvmmsg() or sendmmsg() call, elsewhere it takes a call per
+    datagram"""
+    def __init__(self, sock, batch_size=32, bufsize=65535,
+            family=socket.AF_INET):
+        if not isinstance(sock, Socket):
+            address, sock = sock, Socket(family, socket.SOCK_DGRAM)
+            sock.bind(address)
+        self.socket = sock
+        self.batch_size = batch_size
+        self._buf = memoryview(bytearray(batch_size * bufsize))
+        self._views = [self._buf[i * bufsize:(i + 1) * bufsize]
+                for i in xrange(batch_size)]
+        self._mmsg = recvmmsg is not None and \
+                sock.family in (socket.AF_INET, socket.AF_INET6)
+
+    def __iter__(self):
+        while 1:
+            yield self.recv_batch()
+
+    def recv_batch(self):
+        """receive a list of (data, address) pairs
+
+        each data is a memoryview into one of the endpoint's buffers, so it
+        is only valid until the next call to recv_batch()"""
+        if self._mmsg:
+            return self._recv_batch_mmsg()
+        sock = self.socket
+        recvfrom_into = sock._sock.recvfrom_into
+        batch = []
+        while len(batch) < self.batch_size:
+            if sock._closed:
+                raise socket.error(errno.EBADF, "Bad file descriptor")
+            view = self._views[len(batch)]
+            try:
+                nbytes, address = recvfrom_into(view)
+            except socket.error, err:
+                if err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                if batch:
+                    break
+                with sock._registered('r'):
+                    sock._wait(True)
+                continue
+            batch.append((view[:nbytes], address))
+        return batch
+
+    def _recv_batch_mmsg(self):
+        sock = self.socket
+        while 1:
+            if sock._closed:
+                raise socket.error(errno.EBADF, "Bad file descriptor")
+            try:
+                received = recvmmsg(sock._fileno, self._views)
+            except (OSError, IOError), err:
+                if err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise socket.error(*err.args)
+                with sock._registered('r'):
+                    sock._wait(True)
+                continue
+            return [(view[:nbytes], compat.unpack_sockaddr(sockaddr))
+                    for view, (nbytes, sockaddr) in zip(self._views, received)]
+
+    def serve(self, handler):
+        "call *handler* with every batch received, forever"
+        for batch in self:
+            handler(batch)
+
+    def sendto(self, data, address):
+        self.sendto_many([(data, address)])
+
+    def sendto_many(self, datagrams):
+        """send a sequence of (data, address) pairs
+
+        they go out back to back, only waiting on the socket if its send
+        buffer fills up. hostnames are looked up with the cooperative
+        resolver in greenhouse.dns"""
+        datagrams = self._resolve(datagrams)
+        if self._mmsg:
+            try:
+                packed = [(_memoryview(data),
+                        compat.pack_sockaddr(self.socket.family, address))
+                        for data, address in datagrams]
+            except (socket.error, ValueError, TypeError, IndexError):
+                # special addresses like '<broadcast>' are left to sendto()
+                pass
+            else:
+                return self._sendto_many_mmsg(packed)
+
+        sock = self.socket
+        sendto = sock._sock.sendto
+        for data, address in datagrams:
+            while 1:
+                try:
+                    sendto(data, address)
+                except socket.error, err:
+                    if err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        raise
+                    with sock._registered('w'):
+                        sock._wait(False)
+                    continue
+                break
+
+    def _resolve(self, datagrams):
+        # swap hostnames for addresses before anything reaches the socket,
+        # which would otherwise block the process in getaddrinfo
+        family = self.socket.family
+        if family not in (socket.AF_INET, socket.AF_INET6):
+            return list(datagrams)
+        resolved = {}
+        result = []
+        for data, address in datagrams:
+            host = address[0]
+            if host and host != "<broadcast>" and not dns._is_numeric(host):
+                if host not in resolved:
+                    resolved[host] = dns.resolve(host, family)[0]
+                address = (resolved[host],) + tuple(address[1:])
+            result.append((data, address))
+        return result
+
+    def _sendto_many_mmsg(self, datagrams):
+        sock = self.socket
+        sent = 0
+        while sent < len(datagrams):
+            try:
+                sent += sendmmsg(sock._fileno, datagrams[sent:])
+            except (OSError, IOError), err:
+                if err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise socket.error(*err.args)
+                with sock._registered('w'):
+                    sock._wait(False)
+                if sock._closed:
+                    raise socket.error(errno.EBADF, "Bad file descriptor")
+
 #@utils._debugger
-class File(object):
+class File(_ReadBuffer):
+    """a cooperative replacement for the builtin file
+
+    *newline* is the line terminator readline() and iteration split on, and
+    lines longer than *max_line* (if given) come back in pieces of that size.
+
+    with *mmap* set, a read-only regular file is memory-mapped instead of
+    being read through a buffer, and readview() and iterviews() can hand out
+    pieces of it without copying anything"""
     CHUNKSIZE = 8192
     NEWLINE = "\n"
 
+    # access pattern hints for madvise()
+    MADV_NORMAL = compat.MADV_NORMAL
+    MADV_RANDOM = compat.MADV_RANDOM
+    MADV_SEQUENTIAL = compat.MADV_SEQUENTIAL
+    MADV_WILLNEED = compat.MADV_WILLNEED
+    MADV_DONTNEED = compat.MADV_DONTNEED
+
+    # how often follow() checks the file where inotify isn't available
+    FOLLOW_INTERVAL = 1.0
+
+    # write buffering, which is off until setwritebuffer()
+    _wbuf = None
+    _wbuf_size = 0
+    _flush_interval = _fsync_interval = None
+    _flush_scheduled = _fsync_scheduled = False
+    _fsyncing = ()
+
+    # readiness slots, used where the poller can handle files (see _park)
+    _readable = _writable = None
+    _read_deadline = _write_deadline = None
+
     @staticmethod
     def _mode_to_flags(mode):
         flags = os.O_RDONLY | os.O_NONBLOCK # always non-blocking
@@ -261,19 +1180,57 @@ class File(object):
 
             # if we got here, poller.register worked, so set up event-based IO
             self._waiter = "_wait_event"
-            self._readable = greenhouse.Event()
-            self._writable = greenhouse.Event()
             state.descriptormap[self._fileno].append(weakref.ref(self))
         except IOError:
             self._waiter = "_wait_yield"
 
-    def __init__(self, name, mode='rb'):
+    def _set_up_buffer(self):
+        # read-ahead data lives in a reusable bytearray between the _start
+        # and _end offsets, and is only moved (or the buffer grown) when
+        # there isn't enough room left after _end. _raw reads from the
+        # descriptor straight into it
+        self._buf = bytearray(self.CHUNKSIZE)
+        self._view = memoryview(self._buf)
+        self._start = self._end = 0
+        self._raw = _io.FileIO(self._fileno, 'r', closefd=False)
+        self._mapping = None
+
+    def _set_up_mapping(self):
+        # the whole file is the buffer, with _start as the read position.
+        # mapping it copy-on-write is what lets compat.mmap_view make a
+        # memoryview of it, and means writes through the views handed out
+        # stay private rather than faulting on read-only pages
+        size = os.fstat(self._fileno).st_size
+        if size:
+            self._mapping = compat.mmap_private(self._fileno, size)
+            self._buf = self._mapping
+            self._view = compat.mmap_view(self._mapping)
+        else:
+            # empty files can't be mapped
+            self._mapping = None
+            self._buf = bytearray()
+            self._view = memoryview(self._buf)
+        self._start, self._end = 0, size
+        self._raw = None
+
+        # there's never anything to wait for
+        self._waiter = "_wait_yield"
+
+    def __init__(self, name, mode='rb', newline=None, max_line=None,
+            mmap=False):
+        self.name = name
         self.mode = mode
-        self._buf = StringIO()
+        self.newline = newline or self.NEWLINE
+        self.max_line = max_line
         self._closed = False
 
         # translate mode into the proper open flags
         flags = self._mode_to_flags(mode)
+        if mmap:
+            if flags & (os.O_WRONLY | os.O_RDWR):
+                raise ValueError("only read-only files can be mapped")
+            if compat.mmap_view is None: #pragma: no cover
+                raise ValueError("memory-mapping isn't supported here")
 
         # if write or append mode and the file doesn't exist, create it
         if flags & (os.O_WRONLY | os.O_RDWR) and not os.path.exists(name):
@@ -287,21 +1244,27 @@ class File(object):
             # raises OSError. pfft, whatever.
             raise IOError(*exc.args)
 
+        if mmap:
+            try:
+                self._set_up_mapping()
+            except EnvironmentError:
+                os.close(self._fileno)
+                raise
+            return
+        self._set_up_buffer()
+
         # try to drive the asyncronous waiting off of the polling interface,
         # but epoll doesn't seem to support filesystem descriptors, so fall
         # back to a waiting with a simple yield
         self._set_up_waiting()
 
     def _wait_event(self, reading): #pragma: no cover
-        "wait on our events"
-        if reading:
-            self._readable.wait()
-        else:
-            self._writable.wait()
+        "wait for the poller to find us ready"
+        _park(self, reading, None)
 
     def _wait_yield(self, reading): #pragma: no cover
         "generic wait, for when polling won't work"
-        scheduler.pause()
+        greenhouse.pause()
 
     def _wait(self, reading):
         getattr(self, self._waiter)(reading)
@@ -313,12 +1276,15 @@ class File(object):
             fcntl.fcntl(fd, fcntl.F_SETFL, flags | fdflags)
 
     @classmethod
-    def fromfd(cls, fd, mode='rb'):
+    def fromfd(cls, fd, mode='rb', newline=None, max_line=None):
         fp = object.__new__(cls) # bypass __init__
+        fp.name = "<fdopen>"
         fp.mode = mode
+        fp.newline = newline or cls.NEWLINE
+        fp.max_line = max_line
         fp._fileno = fd
-        fp._buf = StringIO()
         fp._closed = False
+        fp._set_up_buffer()
 
         cls._add_flags(fd, cls._mode_to_flags(mode))
         fp._set_up_waiting()
@@ -326,10 +1292,23 @@ class File(object):
         return fp
 
     def __iter__(self):
-        line = self.readline()
-        while line:
-            yield line
+        self._check_closed()
+        newline = self.newline
+        nlen = len(newline)
+        limit = self.max_line or sys.maxint
+        while 1:
+            # slice out the lines that are already complete in the buffer,
+            # only going through readline() to read more
+            start = self._start
+            index = self._buf.find(newline, start, self._end)
+            if index >= 0 and index + nlen - start <= limit:
+                yield self._consume(index + nlen - start)
+                continue
+
             line = self.readline()
+            if not line:
+                break
+            yield line
 
     def __enter__(self):
         return self
@@ -344,107 +1323,397 @@ class File(object):
             pass
 
     def close(self):
+        if self._wbuf:
+            self.flush()
+        if self._fsync_scheduled:
+            self._fsync()
+        # a timed fsync may still be running on this descriptor in its thread
+        while self._fsyncing:
+            self._fsyncing[0].wait()
         self._closed = True
         os.close(self._fileno)
         state.poller.unregister(self)
 
+        # views from readview() and iterviews() keep the mapping alive, so
+        # drop our references rather than unmapping it out from under them
+        self._mapping = self._buf = self._view = None
+        self._start = self._end = 0
+
+    def _check_closed(self):
+        if self._closed:
+            raise IOError(errno.EBADF, "Bad file descriptor")
+
     def fileno(self):
         return self._fileno
 
     def flush(self):
-        return None
-
-    def read(self, size=-1):
-        chunksize = size < 0 and self.CHUNKSIZE or min(self.CHUNKSIZE, size)
-
-        buf = self._buf
-        buf.seek(0, os.SEEK_END)
-        collected = buf.tell()
-
-        while 1:
-            if size >= 0 and collected >= size:
-                # we have read enough already
-                break
-
+        """write out anything buffered since setwritebuffer(), following it
+        with an fsync if the fsync policy calls for one"""
+        buf = self._wbuf
+        if not buf:
+            return
+        while buf:
             try:
-                output = os.read(self._fileno, chunksize)
+                went = os.write(self._fileno, buf)
             except (OSError, IOError), err: #pragma: no cover
                 if err.args[0] in (errno.EAGAIN, errno.EINTR):
-                    # would have blocked
-                    self._wait(reading=True)
+                    self._wait(reading=False)
                     continue
+                raise
+            del buf[:went]
+
+        if self._fsync_interval == 0:
+            self._fsync()
+        elif self._fsync_interval and not self._fsync_scheduled:
+            self._fsync_scheduled = True
+            greenhouse.schedule_in(self._fsync_interval, self._fsync_timer)
+
+    def setwritebuffer(self, size, interval=None, fsync=None):
+        """turn on write buffering with a buffer of *size* bytes
+
+        while it is on, write() only appends to a buffer, which is written
+        out once it grows past *size*, on flush() or close(), and (given an
+        *interval*) that many seconds after a write into an empty buffer.
+
+        *fsync* is the policy for getting flushed data onto the disk: None
+        never fsyncs, 0 fsyncs after every flush, and a number of seconds
+        fsyncs at most that often. fsync runs in a separate thread, so only
+        the greenlet calling it waits on the disk.
+
+        a *size* of 0 flushes the buffer and turns buffering back off"""
+        if not size:
+            self.flush()
+            self._wbuf = None
+            self._flush_interval = self._fsync_interval = None
+            return
+        if self._wbuf is None:
+            self._wbuf = bytearray()
+        self._wbuf_size = size
+        self._flush_interval = interval
+        self._fsync_interval = fsync
+
+    def _flush_timer(self):
+        self._flush_scheduled = False
+        if not self._closed:
+            self.flush()
+
+    def _fsync_timer(self):
+        if self._fsync_scheduled and not self._closed:
+            self._fsync()
+
+    def _fsync(self):
+        self._fsync_scheduled = False
+        done = utils.Event()
+        self._fsyncing += (done,)
+        try:
+            _off_loop(os.fsync, self._fileno)
+        finally:
+            self._fsyncing = tuple(e for e in self._fsyncing if e is not done)
+            done.set()
+
+    def _readinto(self, view):
+        # a single read from the descriptor into *view*, waiting if need be
+        if self._raw is None:
+            # memory-mapped, everything is already in the buffer
+            return 0
+        while 1:
+            try:
+                received = self._raw.readinto(view)
+            except (OSError, IOError), err: #pragma: no cover
+                if err.args[0] in (errno.EAGAIN, errno.EINTR):
+                    received = None
                 else:
                     raise
+            if received is not None:
+                return received
+            # would have blocked
+            self._wait(reading=True)
+
+    def _fill(self, needed):
+        "one read into the end of the buffer, returns the number of bytes read"
+        if self._raw is None:
+            return 0
+        if self._wbuf:
+            # let reads see what has been written
+            self.flush()
+        self._make_room(needed)
+        received = self._readinto(self._view[self._end:])
+        self._end += received
+        return received
+
+    def _rewindable(self):
+        # a memory-mapped buffer is the file itself, offsets and all
+        return self._raw is not None
 
-            if not output:
-                # nothing more to read
+    def read(self, size=-1):
+        self._check_closed()
+        if size < 0:
+            while self._fill(self.CHUNKSIZE):
+                pass
+            return self._consume(self._end - self._start)
+
+        while self._end - self._start < size:
+            if not self._fill(max(size - (self._end - self._start),
+                    self.CHUNKSIZE)):
                 break
+        return self._consume(min(size, self._end - self._start))
+
+    def readinto(self, buffer):
+        """read into the writable *buffer* (a bytearray or memoryview, say)
+
+        returns the number of bytes read, which is only less than the size of
+        *buffer* at the end of the file. large reads go straight into
+        *buffer* without being copied through the internal buffer"""
+        self._check_closed()
+        view = memoryview(buffer)
+        total = min(len(view), self._end - self._start)
+        view[:total] = self._view[self._start:self._start + total]
+        self._consume(total)
+
+        while total < len(view):
+            if len(view) - total < self.CHUNKSIZE:
+                # small remainder: read ahead a full chunk and copy it over
+                if not self._fill(self.CHUNKSIZE):
+                    break
+                count = min(len(view) - total, self._end - self._start)
+                view[total:total + count] = \
+                        self._view[self._start:self._start + count]
+                self._consume(count)
+            else:
+                count = self._readinto(view[total:])
+                if not count:
+                    break
+            total += count
+
+        return total
+
+    def readline(self, size=-1):
+        """read a line, including the trailing newline
+
+        lines longer than *size* (or max_line) are returned in pieces of that
+        length. at the end of the file this returns whatever is left without
+        a newline, and then the empty string"""
+        self._check_closed()
+        newline = self.newline
+        nlen = len(newline)
+        limit = self.max_line or sys.maxint
+        if size >= 0:
+            limit = min(limit, size)
 
-            collected += len(output)
-            buf.write(output)
+        scanned = self._start
+        while 1:
+            index = self._buf.find(newline, scanned, self._end)
+            if index >= 0:
+                return self._consume(min(index + nlen - self._start, limit))
+
+            buffered = self._end - self._start
+            if buffered >= limit:
+                return self._consume(limit)
+
+            # each chunk only gets scanned once, only the bytes that could
+            # hold the start of a split newline are looked at again
+            offset = max(0, buffered - nlen + 1)
+            if not self._fill(self.CHUNKSIZE):
+                # hit the end of the file, no more newlines
+                return self._consume(self._end - self._start)
+            scanned = self._start + offset
+
+    def readview(self, size=-1):
+        """like read(), but returns a memoryview
+
+        for a memory-mapped file it is a view right into the mapping, so
+        nothing gets copied"""
+        self._check_closed()
+        if self._mapping is None:
+            return memoryview(self.read(size))
+        start = self._start
+        if size < 0:
+            self._start = self._end
+        else:
+            self._start = min(self._end, start + size)
+        return self._view[start:self._start]
+
+    def iterviews(self):
+        """iterate over the lines like iterating over the file itself, but
+        producing memoryviews
+
+        for a memory-mapped file they are views right into the mapping, so
+        nothing gets copied"""
+        self._check_closed()
+        if self._mapping is None:
+            for line in self:
+                yield memoryview(line)
+            return
+
+        newline = self.newline
+        nlen = len(newline)
+        limit = self.max_line or sys.maxint
+        while self._start < self._end:
+            start = self._start
+            index = self._buf.find(newline, start, self._end)
+            if index < 0:
+                index = self._end
+            else:
+                index += nlen
+            self._start = min(index, start + limit)
+            yield self._view[start:self._start]
+
+    def madvise(self, advice, start=0, length=None):
+        """hint to the kernel how a memory-mapped file's pages are going to
+        be used, with one of the File.MADV_* constants
+
+        *start* and *length* limit the hint to part of the file. where the
+        hint can't be given, this does nothing"""
+        if self._raw is not None:
+            raise ValueError("only memory-mapped files take madvise hints")
+        if self._mapping is not None and compat.madvise is not None:
+            compat.madvise(self._mapping, advice, start, length)
+
+    def follow(self):
+        """generate lines as they are appended to the file, indefinitely
+
+        this picks up from the current position (seek to the end first to
+        only see new lines), and where inotify is available it waits on that
+        rather than polling. a trailing line is only produced once it is
+        complete. if the file is truncated it starts over from the top, and
+        if it is rotated (moved away and replaced) it finishes the old file
+        and carries on with the new one"""
+        if self._raw is None or self.name == "<fdopen>":
+            raise ValueError("only files opened by name can be followed")
+        newline = self.newline
+        limit = self.max_line or sys.maxint
+        notify = self._watch()
+        try:
+            pending = ""
+            rotated = False
+            while 1:
+                line = self.readline(limit - len(pending))
+                while line:
+                    pending += line
+                    if pending.endswith(newline) or len(pending) >= limit:
+                        yield pending
+                        pending = ""
+                    line = self.readline(limit - len(pending))
+
+                # at the end, so see what has happened to the file
+                if rotated:
+                    if pending:
+                        yield pending
+                        pending = ""
+                    self._reopen()
+                    rotated = False
+                    continue
 
-        # get rid of the old buffer
-        rc = buf.getvalue()
-        buf.seek(0)
-        buf.truncate()
+                opened = os.fstat(self._fileno)
+                if opened.st_size < self.tell():
+                    # truncated
+                    self.seek(0)
+                    pending = ""
+                    continue
 
-        if size >= 0:
-            # leave the overflow in the buffer
-            buf.write(rc[size:])
-            return rc[:size]
-        return rc
+                try:
+                    current = os.stat(self.name)
+                except OSError:
+                    current = None
+                if current is not None and (current.st_dev, current.st_ino) \
+                        != (opened.st_dev, opened.st_ino):
+                    # read anything else that made it into the old file
+                    # before moving over to the new one
+                    rotated = True
+                    continue
 
-    def readline(self):
-        buf = self._buf
-        newline, chunksize = self.NEWLINE, self.CHUNKSIZE
-        buf.seek(0)
+                self._wait_for_change(notify)
+        finally:
+            if notify is not None:
+                notify.close()
 
-        text = buf.read()
-        while text.find(newline) < 0:
-            try:
-                text = os.read(self._fileno, chunksize)
-            except (OSError, IOError), err: #pragma: no cover
-                if err.args[0] in (errno.EAGAIN, errno.EINTR):
-                    # would have blocked
-                    self._wait(reading=True)
-                    continue
-                else:
-                    raise
-            if not text:
-                break
-            buf.write(text)
-        else:
-            # found a newline
-            rc = buf.getvalue()
-            index = rc.find(newline) + len(newline)
-
-            buf.seek(0)
-            buf.truncate()
-            buf.write(rc[index:])
-            return rc[:index]
-
-        # hit the end of the file, no more newlines
-        rc = buf.getvalue()
-        buf.seek(0)
-        buf.truncate()
-        return rc
+    def _watch(self):
+        # an inotify descriptor (wrapped in a File so we can wait on it)
+        # watching our directory, so it also sees the file being replaced
+        if compat.inotify_init is None: #pragma: no cover
+            return None
+        try:
+            fd = compat.inotify_init()
+        except OSError: #pragma: no cover
+            return None
+        try:
+            compat.inotify_add_watch(fd,
+                    os.path.dirname(os.path.abspath(self.name)),
+                    compat.IN_MODIFY | compat.IN_ATTRIB | compat.IN_CREATE |
+                    compat.IN_DELETE | compat.IN_MOVED_FROM |
+                    compat.IN_MOVED_TO | compat.IN_CLOSE_WRITE)
+        except OSError: #pragma: no cover
+            os.close(fd)
+            return None
+        return File.fromfd(fd)
+
+    def _wait_for_change(self, notify):
+        if notify is None: #pragma: no cover
+            greenhouse.pause_for(self.FOLLOW_INTERVAL)
+            return
+        name = os.path.basename(self.name)
+        while 1:
+            if notify._start == notify._end:
+                notify._fill(notify.CHUNKSIZE)
+            data = notify._consume(notify._end - notify._start)
+            for wd, mask, cookie, filename in compat.inotify_events(data):
+                if filename == name or mask & compat.IN_Q_OVERFLOW:
+                    return
+
+    def _reopen(self):
+        # switch over to whatever file is at our path now
+        state.poller.unregister(self)
+        _forget_descriptor(self)
+        os.close(self._fileno)
+        self._fileno = os.open(self.name, self._mode_to_flags(self.mode))
+        self._set_up_buffer()
+        self._set_up_waiting()
 
     def readlines(self):
         return list(self.__iter__())
 
     def seek(self, pos, modifier=0):
+        if self._wbuf:
+            self.flush()
+        if self._raw is None:
+            # memory-mapped, just move around in the buffer
+            if modifier == os.SEEK_CUR:
+                pos += self._start
+            elif modifier == os.SEEK_END:
+                pos += self._end
+            if pos < 0:
+                raise IOError(errno.EINVAL, os.strerror(errno.EINVAL))
+            self._start = min(pos, self._end)
+            return
+
+        if modifier == os.SEEK_CUR:
+            # relative to where the reader is, not the read-ahead
+            pos -= self._end - self._start
         os.lseek(self._fileno, pos, modifier)
 
         # clear out the buffer
-        buf = self._buf
-        buf.seek(0)
-        buf.truncate()
+        self._start = self._end = 0
 
     def tell(self):
-        with os.fdopen(os.dup(self._fileno)) as fp:
-            return fp.tell()
+        if self._raw is None:
+            return self._start
+        return os.lseek(self._fileno, 0, os.SEEK_CUR) - \
+                (self._end - self._start) + len(self._wbuf or "")
 
     def write(self, data):
+        if self._start != self._end:
+            # drop the read-ahead so the write lands where the reader is
+            self.seek(0, os.SEEK_CUR)
+        if self._wbuf is not None:
+            self._wbuf += data
+            if len(self._wbuf) >= self._wbuf_size:
+                self.flush()
+            elif self._flush_interval is not None \
+                    and not self._flush_scheduled:
+                self._flush_scheduled = True
+                greenhouse.schedule_in(self._flush_interval,
+                        self._flush_timer)
+            return
         while data:
             try:
                 went = os.write(self._fileno, data)
@@ -463,3 +1732,177 @@ class File(object):
 def pipe():
     r, w = os.pipe()
     return File.fromfd(r, 'rb'), File.fromfd(w, 'wb')
+
+def _off_loop(func, *args):
+    # run a blocking call in an OS thread, parking just the current greenlet
+    # until it is done. the thread wakes us up through a pipe
+    r, w = os.pipe()
+    rfp = File.fromfd(r, 'rb')
+    result = []
+
+    def run():
+        try:
+            result.append((func(*args), None))
+        except:
+            result.append((None, sys.exc_info()))
+        finally:
+            # the waiting greenlet hangs unless this always happens
+            try:
+                os.write(w, "\0")
+            except OSError:
+                pass
+            os.close(w)
+
+    try:
+        thread.start_new_thread(run, ())
+        rfp.read(1)
+    finally:
+        rfp.close()
+
+    rc, exc_info = result[0]
+    if exc_info is not None:
+        raise exc_info[0], exc_info[1], exc_info[2]
+    return rc
+
+def splice(src, dst, nbytes=None):
+    """move up to *nbytes* from *src* to *dst*, without copying into python
+
+    either end can be a greenhouse Socket or File (pipe() makes Files). the
+    data goes through an intermediate pipe with the splice system call so it
+    never leaves the kernel, and the greenlet parks whenever an end isn't
+    ready. with *nbytes* of None everything up to the end of *src* is moved.
+    where splice isn't supported it falls back to a copy loop. returns the
+    number of bytes moved, which is only short of *nbytes* at end of input"""
+    remaining = sys.maxint if nbytes is None else nbytes
+    total = 0
+
+    # anything already buffered in userspace has to go first
+    if isinstance(dst, Socket) and dst._outbuf:
+        dst.flush()
+    if isinstance(dst, File) and (dst._wbuf or dst._end > dst._start):
+        dst.seek(0, os.SEEK_CUR)
+    if isinstance(src, File) and src._end > src._start:
+        data = src._consume(min(src._end - src._start, remaining))
+        _write_all(dst, data)
+        total += len(data)
+
+    if compat.splice is not None and _spliceable(src) and _spliceable(dst):
+        moved, supported = _splice_some(src, dst, remaining - total)
+        total += moved
+        if supported:
+            return total
+
+    while total < remaining:
+        data = _read_some(src, min(remaining - total, SPLICE_CHUNK))
+        if not data:
+            break
+        _write_all(dst, data)
+        total += len(data)
+    return total
+
+def _spliceable(obj):
+    # memory-mapped Files don't read through their descriptor
+    return isinstance(obj, Socket) or (
+            isinstance(obj, File) and obj._raw is not None)
+
+def _splice_some(src, dst, count):
+    # the splice() loop proper. returns the bytes moved and whether the
+    # descriptors supported it, bailing out early if they don't
+    r, w = os.pipe()
+    try:
+        total = pending = 0
+        while 1:
+            if not pending:
+                if total >= count:
+                    break
+                try:
+                    pending = compat.splice(src.fileno(), w,
+                            min(count - total, SPLICE_CHUNK))
+                except OSError, err:
+                    if err.args[0] in (errno.EAGAIN, errno.EINTR):
+                        _wait_ready(src, True)
+                        continue
+                    if err.args[0] in SENDFILE_UNSUPPORTED and not total:
+                        return 0, False
+                    raise socket.error(*err.args)
+                if not pending:
+                    # end of the input
+                    break
+
+            try:
+                sent = compat.splice(r, dst.fileno(), pending)
+            except OSError, err:
+                if err.args[0] in (errno.EAGAIN, errno.EINTR):
+                    _wait_ready(dst, False)
+                    continue
+                if err.args[0] in SENDFILE_UNSUPPORTED and not total:
+                    # get what is already in the pipe out the slow way
+                    data = os.read(r, pending)
+                    _write_all(dst, data)
+                    return len(data), False
+                raise socket.error(*err.args)
+            pending -= sent
+            total += sent
+        return total, True
+    finally:
+        os.close(r)
+        os.close(w)
+
+def _wait_ready(obj, reading):
+    # park until a Socket or File can be read from or written to
+    if isinstance(obj, Socket):
+        with obj._registered(reading and 'r' or 'w'):
+            obj._wait(reading)
+        if obj._closed:
+            raise socket.error(errno.EBADF, "Bad file descriptor")
+    else:
+        obj._wait(reading)
+
+def _read_some(obj, size):
+    if isinstance(obj, File):
+        if obj._start == obj._end:
+            obj._fill(size)
+        return obj._consume(min(size, obj._end - obj._start))
+    return obj.recv(size)
+
+def _write_all(obj, data):
+    if isinstance(obj, File):
+        obj.write(data)
+    else:
+        obj.sendall(data)
+
+def proxy(sock_a, sock_b):
+    """relay data in both directions between two connected sockets
+
+    each direction is moved with splice(), and once one side reaches the end
+    of its data the writing half of the other is shut down. this returns
+    when both directions are finished, with the number of bytes relayed as
+    (a to b, b to a)"""
+    counts = [0, 0]
+    failures = []
+    finished = utils.Event()
+
+    def relay(src, dst, index):
+        try:
+            counts[index] = splice(src, dst)
+        except socket.error, err:
+            # a peer going away just ends that direction
+            if err.args[0] not in SOCKET_CLOSED and err.args[0] != errno.EPIPE:
+                failures.append(sys.exc_info())
+        try:
+            dst.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass
+
+    @greenhouse.schedule
+    def backward():
+        try:
+            relay(sock_b, sock_a, 1)
+        finally:
+            finished.set()
+
+    relay(sock_a, sock_b, 0)
+    finished.wait()
+    if failures:
+        raise failures[0][0], failures[0][1], failures[0][2]
+    return tuple(counts)
@@ -1,4 +1,5 @@
 import collections
+import operator
 import select
 
 from greenhouse._state import state
@@ -28,9 +29,8 @@ class Poll(object):
         if eventmask is None:
             eventmask = self.INMASK | self.OUTMASK | self.ERRMASK
 
-        # get the mask of the current registration, if any
-        registered = self._registry.get(fd)
-        registered = registered and registered[-1] or 0
+        # get the mask of the current registrations, if any
+        registered = _combined(self._registry.get(fd))
 
         # make sure eventmask includes all previous masks
         newmask = eventmask | registered
@@ -42,12 +42,15 @@ class Poll(object):
         # register the new mask
         rc = self._poller.register(fd, newmask)
 
-        # append to a list of eventmasks so we can backtrack
-        self._registry[fd].append(newmask)
+        # keep each registration's own mask, so that they can be undone in
+        # any order without losing events somebody else is waiting on
+        self._registry[fd].append(eventmask)
 
         return rc
 
-    def unregister(self, fd):
+    def unregister(self, fd, eventmask=None):
+        """undo a registration of *fd* with *eventmask*, or the most recent
+        registration if no *eventmask* is given"""
         # integer file descriptor
         fd = isinstance(fd, int) and fd or fd.fileno()
 
@@ -57,11 +60,10 @@ class Poll(object):
 
         # unregister the current registration
         self._poller.unregister(fd)
-        self._registry[fd].pop()
+        _remove_mask(self._registry[fd], eventmask)
 
-        # re-do the previous registration, if any
-        newmask = self._registry[fd]
-        newmask = newmask and newmask[-1]
+        # re-do the remaining registrations, if any
+        newmask = _combined(self._registry[fd])
         if newmask:
             self._poller.register(fd, newmask)
         else:
@@ -96,9 +98,8 @@ class Select(object):
         if eventmask is None:
             eventmask = self.INMASK | self.OUTMASK | self.ERRMASK
 
-        # get the mask of the current registration, if any
-        registered = self._registry.get(fd)
-        registered = registered and registered[-1] or 0
+        # get the mask of the current registrations, if any
+        registered = _combined(self._registry.get(fd))
 
         # make sure eventmask includes all previous masks
         newmask = eventmask | registered
@@ -106,21 +107,27 @@ class Select(object):
         # apply the new mask
         self._currentmasks[fd] = newmask
 
-        # append to the list of masks so we can backtrack
-        self._registry[fd].append(newmask)
+        # keep each registration's own mask so they can be undone in any order
+        self._registry[fd].append(eventmask)
 
         return not registered
 
-    def unregister(self, fd):
+    def unregister(self, fd, eventmask=None):
+        """undo a registration of *fd* with *eventmask*, or the most recent
+        registration if no *eventmask* is given"""
         # integer file descriptor
         fd = isinstance(fd, int) and fd or fd.fileno()
 
-        # get rid of the last registered mask
-        self._registry[fd].pop()
+        # allow for extra noop calls
+        if not self._registry.get(fd):
+            return
 
-        # re-do the previous registration, if any
+        # get rid of the registration's mask
+        _remove_mask(self._registry[fd], eventmask)
+
+        # re-do the remaining registrations, if any
         if self._registry[fd]:
-            self._currentmasks[fd] = self._registry[fd][-1]
+            self._currentmasks[fd] = _combined(self._registry[fd])
         else:
             self._registry.pop(fd)
             self._currentmasks.pop(fd)
@@ -144,6 +151,15 @@ class Select(object):
             events[fd] |= self.ERRMASK
         return events.items()
 
+def _combined(masks):
+    return reduce(operator.or_, masks or (), 0)
+
+def _remove_mask(masks, eventmask):
+    if eventmask is not None and eventmask in masks:
+        masks.remove(eventmask)
+    else:
+        masks.pop()
+
 def best():
     if hasattr(select, 'epoll'):
         return Epoll()
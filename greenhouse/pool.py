@@ -1,8 +1,17 @@
+import collections
+import contextlib
+import errno
+import socket
+import time
+
+from greenhouse import scheduler, utils
+from greenhouse.compat import greenlet
+from greenhouse.io import Socket
 from greenhouse.scheduler import schedule
 from greenhouse.utils import Queue
 
 
-__all__ = ["OneWayPool", "Pool", "OrderedPool"]
+__all__ = ["OneWayPool", "Pool", "OrderedPool", "ConnectionPool"]
 
 _STOP = object()
 
@@ -77,6 +86,168 @@ class OrderedPool(Pool):
         return self._cache.pop(self._getcount - 1)
 
 
+class ConnectionPool(object):
+    """a pool of connected client sockets, kept per (host, port) endpoint
+
+    get() hands out an idle connection to the endpoint if there is a live
+    one, otherwise it connects a new one, unless *max_per_host* connections
+    to that endpoint are already open, in which case it blocks until one is
+    put() back or discarded.
+
+    connections idle for more than *idle_timeout* seconds are closed.
+    *factory*, if provided, is called with (host, port) to create new
+    connections"""
+    class Exhausted(Exception):
+        pass
+
+    def __init__(self, max_per_host=10, idle_timeout=60, factory=None):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.factory = factory or self._connect
+        self.stats = {'hits': 0, 'misses': 0, 'waits': 0, 'evictions': 0}
+        self._idle = collections.defaultdict(collections.deque)
+        self._open = collections.defaultdict(int)
+        self._waiters = collections.defaultdict(collections.deque)
+        self._endpoints = {}
+        self._sweep_at = None
+
+    @staticmethod
+    def _connect(host, port):
+        sock = Socket()
+        sock.connect((host, port))
+        return sock
+
+    @staticmethod
+    def _is_alive(sock):
+        # a non-blocking peek: nothing to read means the connection is still
+        # up, while EOF, an error or unsolicited data make it unusable
+        try:
+            sock._sock.recv(1, socket.MSG_PEEK)
+        except socket.error, err:
+            return err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK)
+        return False
+
+    def get(self, host, port, timeout=None):
+        """check out a connection to (host, port)
+
+        if the endpoint is at *max_per_host* open connections this blocks
+        until one becomes available, raising ConnectionPool.Exhausted if
+        *timeout* seconds pass first"""
+        endpoint = (host, port)
+        idle = self._idle[endpoint]
+        while idle:
+            sock = idle.pop()[0]
+            if self._is_alive(sock):
+                self.stats['hits'] += 1
+                self._endpoints[sock] = endpoint
+                return sock
+            self._close(sock, endpoint)
+
+        if self._open[endpoint] >= self.max_per_host:
+            self.stats['waits'] += 1
+            sock = self._wait(endpoint, timeout)
+            if sock is not None:
+                self.stats['hits'] += 1
+                self._endpoints[sock] = endpoint
+                return sock
+            # otherwise a closed connection's slot was passed on to us
+        else:
+            self._open[endpoint] += 1
+
+        self.stats['misses'] += 1
+        try:
+            sock = self.factory(host, port)
+        except:
+            self._release_slot(endpoint)
+            raise
+        self._endpoints[sock] = endpoint
+        return sock
+
+    def _wait(self, endpoint, timeout):
+        waiter = [greenlet.getcurrent(), None, None, False, None]
+        if not utils._park(self._waiters[endpoint], waiter, timeout):
+            raise self.Exhausted("no connection available within %s seconds"
+                    % timeout)
+        return waiter[2]
+
+    def _wake(self, endpoint, sock=None):
+        # hand a connection, or a free slot if *sock* is None, to a waiter
+        waiters = self._waiters[endpoint]
+        if not waiters:
+            return False
+        waiter = waiters.popleft()
+        waiter[2] = sock
+        utils._unpark(waiter)
+        return True
+
+    def put(self, sock, discard=False):
+        """return a connection checked out with get()
+
+        pass *discard* as True if the connection shouldn't be reused, for
+        instance after an error left it in an unknown protocol state"""
+        endpoint = self._endpoints.pop(sock)
+        if discard or sock._closed:
+            self._close(sock, endpoint)
+        elif not self._wake(endpoint, sock):
+            self._idle[endpoint].append((sock, time.time()))
+            self._schedule_sweep(time.time() + self.idle_timeout)
+
+    @contextlib.contextmanager
+    def connection(self, host, port, timeout=None):
+        """a context manager checking out a connection and putting it back,
+        discarding it if the block raised an exception"""
+        sock = self.get(host, port, timeout)
+        try:
+            yield sock
+        except:
+            self.put(sock, discard=True)
+            raise
+        self.put(sock)
+
+    def _close(self, sock, endpoint):
+        try:
+            sock.close()
+        finally:
+            self._release_slot(endpoint)
+
+    def _release_slot(self, endpoint):
+        # pass the slot straight on to a waiter, or else give it up
+        if not self._wake(endpoint):
+            self._open[endpoint] -= 1
+
+    def _schedule_sweep(self, when):
+        if self._sweep_at is None or when < self._sweep_at:
+            self._sweep_at = when
+            scheduler.schedule_at(when, self._sweep)
+
+    def _sweep(self):
+        if self._sweep_at is None or self._sweep_at > time.time():
+            # a superseded sweep
+            return
+        self._sweep_at = None
+
+        cutoff = time.time() - self.idle_timeout
+        oldest = None
+        for endpoint, idle in self._idle.items():
+            while idle and idle[0][1] <= cutoff:
+                self.stats['evictions'] += 1
+                self._close(idle.popleft()[0], endpoint)
+            if idle:
+                oldest = min(oldest or idle[0][1], idle[0][1])
+            else:
+                del self._idle[endpoint]
+
+        if oldest is not None:
+            self._schedule_sweep(oldest + self.idle_timeout)
+
+    def close(self):
+        "close all the idle connections"
+        for endpoint, idle in self._idle.items():
+            while idle:
+                self._close(idle.popleft()[0], endpoint)
+        self._idle.clear()
+
+
 def map(func, items, pool_size=10):
     op = OrderedPool(func, pool_size)
     op.start()
@@ -20,24 +20,35 @@ _exception_handlers = []
 NOTHING_TO_DO_PAUSE = 0.005
 
 def _repopulate(include_paused=True):
-    # start with polling sockets to trigger events
+    # send out coalesced socket writes before blocking in the poller
+    for sock in list(state.unflushed):
+        sock._flush_some()
+
+    # start with polling sockets to trigger events, waking the greenlets
+    # parked in the readiness slots of the sockets on each ready descriptor
+    inmask, outmask = state.poller.INMASK, state.poller.OUTMASK
+    unpark = greenhouse.io._unpark
     events = state.poller.poll()
     for fd, eventmap in events:
-        socks = []
-        for index, weak in enumerate(state.descriptormap[fd]):
+        refs = state.descriptormap.get(fd)
+        if not refs:
+            continue
+        stale = False
+        for weak in refs:
             sock = weak()
             if sock is None or sock._closed:
-                state.descriptormap[fd].pop(index)
-            else:
-                socks.append(sock)
-        if eventmap & state.poller.INMASK:
-            for sock in socks:
-                sock._readable.set()
-                sock._readable.clear()
-        if eventmap & state.poller.OUTMASK:
-            for sock in socks:
-                sock._writable.set()
-                sock._writable.clear()
+                stale = True
+                continue
+            if eventmap & inmask and sock._readable is not None:
+                unpark(sock, True)
+            if eventmap & outmask:
+                if sock in state.write_blocked:
+                    sock._flush_some()
+                if sock._writable is not None:
+                    unpark(sock, False)
+        if stale:
+            refs[:] = [weak for weak in refs
+                    if weak() is not None and not weak()._closed]
 
     # grab the greenlets that were awoken by those and other events
     state.to_run.extend(state.awoken_from_events)
@@ -53,6 +64,16 @@ def _repopulate(include_paused=True):
         state.to_run.extend(state.paused)
         state.paused = []
 
+def _untime(deadline, glet):
+    # take a greenlet's timeout back out of timed_paused, returning False if
+    # it wasn't there (because it has already been scheduled)
+    timed = state.timed_paused
+    index = bisect.bisect_left(timed, (deadline, glet))
+    if index < len(timed) and timed[index][1] is glet:
+        del timed[index]
+        return True
+    return False
+
 def pause():
     'pause and reschedule the current greenlet and switch to the next'
     schedule(greenlet.getcurrent())
@@ -238,5 +259,7 @@ def hybridize():
     state.state.paused = procstate.paused
     state.state.descriptormap = procstate.descriptormap
     state.state.to_run = procstate.to_run
+    state.state.unflushed = procstate.unflushed
+    state.state.write_blocked = procstate.write_blocked
     state.state.mainloop = procstate.mainloop
     greenhouse.poller.set()
@@ -0,0 +1,263 @@
+import errno
+import os
+import socket
+import struct
+
+from greenhouse import scheduler, utils
+from greenhouse.io import Socket, Stream, _unpark
+
+
+__all__ = ["StreamServer", "Dispatcher", "Worker"]
+
+
+class StreamServer(object):
+    """a server accepting connections on *address* and running
+    ``handler(sock, address)`` in a new greenlet for each one
+
+    *address* may also be an already bound greenhouse Socket. once
+    *max_connections* handlers are running, no more connections are accepted
+    (they queue up in the listen backlog) until one of them finishes. the
+    client socket is closed when its handler returns"""
+    ACCEPT_BATCH = 128
+
+    # how long to back off when accept() fails for lack of descriptors or
+    # memory, in the hope that finishing handlers will free some up
+    ACCEPT_BACKOFF = 0.1
+
+    def __init__(self, address, handler, backlog=128, max_connections=None,
+            family=socket.AF_INET):
+        if isinstance(address, Socket):
+            self.socket = address
+        else:
+            self.socket = Socket(family, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.bind(address)
+        self.handler = handler
+        self.backlog = backlog
+        self.max_connections = max_connections
+        self.connections = 0
+        self._started = False
+        self._stopping = False
+        self._accepting = utils.Event()
+        self._accepting.set()
+        self._finished = utils.Event()
+        self._finished.set()
+        self._stopped = utils.Event()
+
+    @property
+    def address(self):
+        return self.socket.getsockname()
+
+    def start(self):
+        "start listening and accepting in a new greenlet"
+        if self._started:
+            return
+        self._started = True
+        self.socket.listen(self.backlog)
+        scheduler.schedule(self._accept_loop)
+
+    def serve_forever(self):
+        "start the server and block until it is stopped"
+        self.start()
+        self._stopped.wait()
+
+    def stop(self, timeout=None):
+        """stop accepting and close the listening socket, then wait up to
+        *timeout* seconds for the running handlers to finish
+
+        returns True if all the handlers finished in time"""
+        self._stopping = True
+        self._accepting.set()
+
+        # knock the accept loop out of waiting on the listening socket
+        _unpark(self.socket, True)
+
+        if self._started:
+            self._stopped.wait()
+        else:
+            self.socket.close()
+        self._finished.wait(timeout)
+        return not self.connections
+
+    def _accept_loop(self):
+        listener = self.socket
+        try:
+            while not self._stopping:
+                self._accepting.wait()
+
+                # stay registered with the poller for as long as we're
+                # accepting, rather than registering for each accept()
+                with listener._registered('r'):
+                    while self._accepting.is_set() and not self._stopping:
+                        if not self._accept_batch():
+                            listener._wait(True)
+        finally:
+            listener.close()
+            self._stopped.set()
+
+    def _accept_batch(self):
+        # accept everything that is already waiting (up to the connection
+        # limit), returns the number of connections accepted
+        limit = self.ACCEPT_BATCH
+        if self.max_connections:
+            limit = min(limit, self.max_connections - self.connections)
+
+        for accepted in xrange(limit):
+            try:
+                client, address = self.socket._sock.accept()
+            except socket.error, err:
+                if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return accepted
+                if err.args[0] in (errno.ECONNABORTED, errno.EPROTO):
+                    continue
+                if err.args[0] in (errno.EMFILE, errno.ENFILE,
+                        errno.ENOBUFS, errno.ENOMEM):
+                    # the connection stays in the backlog, so keep the
+                    # listener and try it again after a while
+                    scheduler.pause_for(self.ACCEPT_BACKOFF)
+                    if self._stopping:
+                        return accepted
+                    continue
+                raise
+
+            self.connections += 1
+            self._finished.clear()
+            if self.connections == self.max_connections:
+                self._accepting.clear()
+            scheduler.schedule(self._handle, args=(
+                Socket(fromsock=client), address))
+
+        return limit
+
+    def _handle(self, sock, address):
+        try:
+            self.handler(sock, address)
+        finally:
+            try:
+                sock.close()
+            except socket.error:
+                # buffered writes the client never took
+                pass
+            self.connections -= 1
+            self._accepting.set()
+            if not self.connections:
+                self._finished.set()
+
+
+class Dispatcher(object):
+    """accept connections on *address* and hand each one off to the least
+    loaded of a group of worker processes
+
+    *channels* is a list of connected AF_UNIX greenhouse Sockets (from
+    socketpair(), say), one per worker, with a Worker serving the other end
+    of each in its own process and greenhouse loop. the accepted sockets are
+    passed over them with Socket.send_fds, and the workers report their
+    number of running connections back over the same channels. a worker
+    whose channel closes gets no more connections"""
+    def __init__(self, address, channels, backlog=128,
+            family=socket.AF_INET):
+        self.channels = channels
+        self.loads = [0] * len(channels)
+        self.server = StreamServer(address, self._dispatch, backlog,
+                family=family)
+
+    @property
+    def address(self):
+        return self.server.address
+
+    def start(self):
+        "start accepting and dispatching in new greenlets"
+        if self.server._started:
+            return
+        self.server.start()
+        for index in xrange(len(self.channels)):
+            scheduler.schedule(self._read_reports, args=(index,))
+
+    def serve_forever(self):
+        "start the dispatcher and block until it is stopped"
+        self.start()
+        self.server._stopped.wait()
+
+    def stop(self, timeout=None):
+        """stop accepting and close the listening socket
+
+        returns True if all the accepted connections were handed off within
+        *timeout* seconds"""
+        return self.server.stop(timeout)
+
+    def _dispatch(self, sock, address):
+        index = min(xrange(len(self.loads)), key=self.loads.__getitem__)
+
+        # count it now rather than waiting on the worker's report, so that a
+        # burst of connections doesn't all go to the same worker
+        self.loads[index] += 1
+        self.channels[index].send_fds("\0", [sock])
+
+    def _read_reports(self, index):
+        stream = Stream(self.channels[index])
+        try:
+            while 1:
+                self.loads[index], = struct.unpack("!I",
+                        stream.readexactly(4))
+        except (EOFError, socket.error):
+            self.loads[index] = float("inf")
+
+class Worker(object):
+    """serve connections handed over by a Dispatcher in another process,
+    running ``handler(sock, address)`` in a new greenlet for each one
+
+    *channel* is this worker's end of the AF_UNIX socket pair, and *family*
+    is the address family of the dispatcher's listening socket. as with
+    StreamServer, client sockets are closed when their handler returns"""
+    RECEIVE_BATCH = 64
+
+    def __init__(self, channel, handler, family=socket.AF_INET):
+        self.channel = channel
+        self.handler = handler
+        self.family = family
+        self.connections = 0
+        self._finished = utils.Event()
+        self._finished.set()
+
+    def serve_forever(self):
+        """receive and handle connections until the dispatcher closes the
+        channel, then wait for the running handlers to finish"""
+        while 1:
+            data, fds = self.channel.recv_fds(
+                    self.RECEIVE_BATCH, self.RECEIVE_BATCH)
+            if not data:
+                break
+            for fd in fds:
+                try:
+                    sock = socket.fromfd(fd, self.family, socket.SOCK_STREAM)
+                finally:
+                    os.close(fd)
+                self.connections += 1
+                self._finished.clear()
+                scheduler.schedule(self._handle, args=(Socket(fromsock=sock),))
+            self._report()
+        self._finished.wait()
+
+    def _report(self):
+        try:
+            self.channel.sendall(struct.pack("!I", self.connections))
+        except socket.error:
+            pass
+
+    def _handle(self, sock):
+        try:
+            try:
+                address = sock.getpeername()
+            except socket.error:
+                address = None
+            self.handler(sock, address)
+        finally:
+            try:
+                sock.close()
+            except socket.error:
+                # buffered writes the client never took
+                pass
+            self.connections -= 1
+            self._report()
+            if not self.connections:
+                self._finished.set()
@@ -0,0 +1,103 @@
+from __future__ import absolute_import
+
+import errno
+import socket
+import ssl
+
+from greenhouse.io import _SocketFile, _memoryview
+
+
+__all__ = ["SSLSocket", "wrap_socket"]
+
+class SSLSocket(object):
+    """a TLS connection over a connected greenhouse Socket
+
+    the handshake, reads and writes are all driven through the poller, with
+    the greenlet parked on readability or writability whenever OpenSSL asks
+    for it, so nothing blocks the process. use wrap_socket() to create one"""
+    def __init__(self, sock, context, server_side=False, server_hostname=None,
+            do_handshake_on_connect=True):
+        self.socket = sock
+        self.context = context
+        self._sslsock = context.wrap_socket(sock, server_side=server_side,
+                do_handshake_on_connect=False,
+                server_hostname=server_hostname)
+
+        if do_handshake_on_connect:
+            self.do_handshake()
+
+    def _io(self, func, *args):
+        sock = self.socket
+        while 1:
+            if sock._closed:
+                raise socket.error(errno.EBADF, "Bad file descriptor")
+            try:
+                return func(*args)
+            except ssl.SSLWantReadError:
+                events = 'r'
+            except ssl.SSLWantWriteError:
+                events = 'w'
+            with sock._registered(events):
+                sock._wait(events == 'r')
+
+    def do_handshake(self):
+        self._io(self._sslsock.do_handshake)
+
+    def close(self):
+        self.socket.close()
+
+    def cipher(self):
+        return self._sslsock.cipher()
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def getpeercert(self, binary_form=False):
+        return self._sslsock.getpeercert(binary_form)
+
+    def getpeername(self):
+        return self.socket.getpeername()
+
+    def getsockname(self):
+        return self.socket.getsockname()
+
+    def gettimeout(self):
+        return self.socket.gettimeout()
+
+    def makefile(self, mode='r', bufsize=-1):
+        return _SocketFile(self, mode, bufsize, self.socket)
+
+    def pending(self):
+        return self._sslsock.pending()
+
+    def recv(self, nbytes, flags=0):
+        return self._io(self._sslsock.read, nbytes)
+
+    def recv_into(self, buffer, nbytes=0, flags=0):
+        return self._io(self._sslsock.read, nbytes or len(buffer), buffer)
+
+    def send(self, data, flags=0):
+        return self._io(self._sslsock.write, data)
+
+    def sendall(self, data, flags=0):
+        view = _memoryview(data)
+        sent = 0
+        while sent < len(view):
+            sent += self.send(view[sent:])
+
+    def settimeout(self, timeout):
+        self.socket.settimeout(timeout)
+
+    def shutdown(self, flag):
+        return self.socket.shutdown(flag)
+
+def wrap_socket(sock, context=None, server_side=False, server_hostname=None,
+        do_handshake_on_connect=True):
+    """wrap a connected greenhouse Socket in a greenhouse SSLSocket
+
+    *context* defaults to ssl.create_default_context(), which is only
+    suitable for the client side"""
+    if context is None:
+        context = ssl.create_default_context()
+    return SSLSocket(sock, context, server_side, server_hostname,
+            do_handshake_on_connect)
@@ -3,6 +3,9 @@ from __future__ import with_statement
 import bisect
 import collections
 import functools
+import heapq
+import itertools
+import random
 import sys
 import time
 import weakref
@@ -13,7 +16,8 @@ from greenhouse import scheduler
 
 
 __all__ = ["Event", "Lock", "RLock", "Condition", "Semaphore",
-           "BoundedSemaphore", "Timer", "Local", "Queue"]
+           "BoundedSemaphore", "Timer", "Local", "Queue", "PriorityQueue",
+           "LifoQueue"]
 
 def _debugger(cls): #pragma: no cover
     import types
@@ -344,6 +348,31 @@ class Local(object):
     def __setattr__(self, name, value):
         self.data.setdefault(greenlet.getcurrent(), {})[name] = value
 
+def _park(waiters, waiter, timeout):
+    # park the current greenlet with *waiter* (a [greenlet, deadline, item,
+    # done, batch] list) at the back of *waiters*, until whatever takes it
+    # from there calls _unpark on it or *timeout* runs out. returns whether
+    # it was dealt with rather than timed out
+    if timeout is not None:
+        waiter[1] = time.time() + timeout
+        bisect.insort(state.timed_paused, (waiter[1], waiter[0]))
+    waiters.append(waiter)
+    try:
+        state.mainloop.switch()
+    finally:
+        if not waiter[3]:
+            waiters.remove(waiter)
+            if waiter[1] is not None:
+                scheduler._untime(waiter[1], waiter[0])
+    return waiter[3]
+
+def _unpark(waiter):
+    # mark a waiter from _park dealt with and wake its greenlet, unless its
+    # timeout has already got it scheduled
+    waiter[3] = True
+    if waiter[1] is None or scheduler._untime(waiter[1], waiter[0]):
+        state.awoken_from_events.add(waiter[0])
+
 class Queue(object):
     """a producer-consumer queue
 
@@ -356,13 +385,28 @@ class Queue(object):
 
     def __init__(self, maxsize=0):
         self.maxsize = maxsize
-        self.queue = collections.deque()
+        self._init(maxsize)
         self.unfinished_tasks = 0
-        self.not_empty = Condition()
-        self.not_full = Condition()
         self.all_tasks_done = Event()
         self.all_tasks_done.set()
 
+        # greenlets blocked in get() and put(). there are only ever getters
+        # with the queue empty, and putters with it full. a waiter's batch is
+        # None for single items, for a getter it can be the number of items
+        # to collect in a list, and for a putter True with a deque of items
+        self._getters = collections.deque()
+        self._putters = collections.deque()
+
+    # the storage, overridden by PriorityQueue and LifoQueue
+    def _init(self, maxsize):
+        self.queue = collections.deque()
+
+    def _put(self, item):
+        self.queue.append(item)
+
+    def _get(self):
+        return self.queue.popleft()
+
     def empty(self):
         "without blocking, returns True if the queue is empty"
         return not self.queue
@@ -371,12 +415,23 @@ class Queue(object):
         """returns True if the queue is full without blocking
 
         if the queue has no *maxsize* this will always return False"""
-        return self.maxsize > 0 and len(self.queue) == self.maxsize
+        return self.maxsize > 0 and len(self.queue) >= self.maxsize
 
     def _unsafe_get(self):
-        with self.not_full:
-            self.not_full.notify()
-        return self.queue.popleft()
+        item = self._get()
+        if self._putters:
+            # let the longest-blocked put() into the space
+            waiter = self._putters[0]
+            if waiter[4] is None:
+                self._putters.popleft()
+                self._unsafe_put(waiter[2])
+                _unpark(waiter)
+            else:
+                self._unsafe_put(waiter[2].popleft())
+                if not waiter[2]:
+                    self._putters.popleft()
+                    _unpark(waiter)
+        return item
 
     def get(self, blocking=True, timeout=None):
         """get an item out of the queue
@@ -387,14 +442,54 @@ class Queue(object):
 
         if *blocking* is False, it will immediately either return an item or
         raise a Queue.Empty exception"""
-        if not self.queue:
-            if blocking:
-                with self.not_empty:
-                    self.not_empty.wait(timeout)
-                if self.queue:
-                    return self._unsafe_get()
+        if self.queue:
+            return self._unsafe_get()
+        if not blocking:
+            raise self.Empty()
+
+        # a put() will hand its item straight to us
+        waiter = [greenlet.getcurrent(), None, None, False, None]
+        if not _park(self._getters, waiter, timeout):
+            raise self.Empty()
+        return waiter[2]
+
+    def get_many(self, max_items, blocking=True, timeout=None):
+        """get up to *max_items* items out of the queue at once, as a list
+
+        blocking and timeouts work as in get(), for as long as the queue is
+        empty. as soon as there is anything, everything there (up to
+        *max_items*) is returned"""
+        items = []
+        while self.queue and len(items) < max_items:
+            items.append(self._unsafe_get())
+        if items:
+            return items
+        if not blocking:
             raise self.Empty()
-        return self._unsafe_get()
+
+        waiter = [greenlet.getcurrent(), None, items, False, 1]
+        if not _park(self._getters, waiter, timeout) and not items:
+            raise self.Empty()
+
+        # more may have come in since we were woken
+        while self.queue and len(items) < max_items:
+            items.append(self._unsafe_get())
+        return items
+
+    def get_batch(self, max_items, max_wait=None):
+        """collect a list of *max_items* items out of the queue
+
+        this blocks until there are *max_items* items or *max_wait* seconds
+        have gone by, whichever comes first, and then returns what it has
+        (which may be nothing). it is only woken up once, with the batch"""
+        items = []
+        while self.queue and len(items) < max_items:
+            items.append(self._unsafe_get())
+        if len(items) < max_items:
+            # put() adds items to the list and wakes us once it is full
+            waiter = [greenlet.getcurrent(), None, items, False, max_items]
+            _park(self._getters, waiter, max_wait)
+        return items
 
     def get_nowait(self):
         "immediately return an item from the queue or raise Queue.Empty"
@@ -405,12 +500,22 @@ class Queue(object):
         self.all_tasks_done.wait()
 
     def _unsafe_put(self, item):
-        with self.not_empty:
-            self.not_empty.notify()
-        self.queue.append(item)
         if not self.unfinished_tasks:
             self.all_tasks_done.clear()
         self.unfinished_tasks += 1
+        if self._getters:
+            waiter = self._getters[0]
+            if waiter[4] is None:
+                self._getters.popleft()
+                waiter[2] = item
+                _unpark(waiter)
+            else:
+                waiter[2].append(item)
+                if len(waiter[2]) >= waiter[4]:
+                    self._getters.popleft()
+                    _unpark(waiter)
+        else:
+            self._put(item)
 
     def put(self, item, blocking=True, timeout=None):
         """put an item into the queue
@@ -422,15 +527,38 @@ class Queue(object):
 
         if *blocking* is False, it will immediately either place the item in
         the queue or raise a Query.Full exception"""
-        if self.maxsize and len(self.queue) >= self.maxsize:
-            if not blocking:
-                raise self.Full()
-            with self.not_full:
-                self.not_full.wait(timeout)
-            if len(self.queue) < self.maxsize:
-                self._unsafe_put(item)
-        else:
+        if not self.maxsize or len(self.queue) < self.maxsize:
             self._unsafe_put(item)
+            return
+        if not blocking:
+            raise self.Full()
+
+        # a get() will move our item into the queue as it makes room
+        waiter = [greenlet.getcurrent(), None, item, False, None]
+        if not _park(self._putters, waiter, timeout):
+            raise self.Full()
+
+    def put_many(self, items, blocking=True, timeout=None):
+        """put a sequence of items into the queue, in order
+
+        blocking and timeouts work as in put(), except that a blocked
+        put_many() is only woken up once every item has made it into the
+        queue. if it raises Queue.Full, the items before the one that didn't
+        fit are still in the queue"""
+        items = collections.deque(items)
+        while items:
+            if self.maxsize and len(self.queue) >= self.maxsize:
+                break
+            self._unsafe_put(items.popleft())
+        if not items:
+            return
+        if not blocking:
+            raise self.Full()
+
+        # get() moves the rest into the queue one by one as it makes room
+        waiter = [greenlet.getcurrent(), None, items, False, True]
+        if not _park(self._putters, waiter, timeout):
+            raise self.Full()
 
     def put_nowait(self, item):
         "immediately place an item into the queue or raise Query.Full"
@@ -448,11 +576,47 @@ class Queue(object):
         if not self.unfinished_tasks:
             self.all_tasks_done.set()
 
+class PriorityQueue(Queue):
+    """a producer-consumer queue that hands out the lowest priority first
+
+    an item's priority is its first element if it is a tuple (as in the
+    standard library's PriorityQueue), or else the item itself. items with
+    equal priorities come out in the order they were put in"""
+    def _init(self, maxsize):
+        self.queue = []
+        self._counter = itertools.count()
+
+    def _put(self, item):
+        priority = item[0] if isinstance(item, tuple) else item
+        heapq.heappush(self.queue, (priority, next(self._counter), item))
+
+    def _get(self):
+        return heapq.heappop(self.queue)[2]
+
+class LifoQueue(Queue):
+    "a producer-consumer queue that hands out the most recent item first"
+    def _init(self, maxsize):
+        self.queue = []
+
+    def _get(self):
+        return self.queue.pop()
+
 class Channel(object):
-    def __init__(self):
-        self._dataqueue = collections.deque()
-        self._waiters = collections.deque()
-        self._balance = 0
+    """a channel for passing items between greenlets
+
+    with the default *capacity* of 0 every send() blocks until a receive()
+    takes its item. otherwise up to *capacity* items are buffered, and
+    send() only blocks while the buffer is full. see also select()"""
+    def __init__(self, capacity=0):
+        self.capacity = capacity
+        self._buffer = collections.deque()
+
+        # parked senders and receivers, as [greenlet, item, select, index]
+        # lists. select is None, or for a select() call the [index, item,
+        # deadline] list shared by all of its operations, with index being
+        # which of those this is
+        self._senders = collections.deque()
+        self._receivers = collections.deque()
         self._preference = -1
         self._closing = False
 
@@ -461,15 +625,15 @@ class Channel(object):
 
     @property
     def balance(self):
-        return self._dataqueue and len(self._dataqueue) or \
-                -len(self._waiters)
+        return len(self._buffer) + len(self._senders) or \
+                -len(self._receivers)
 
     def close(self):
         self._closing = True
 
     @property
     def closed(self):
-        return self._closing and not self._dataqueue
+        return self._closing and not self._buffer and not self._senders
 
     @property
     def closing(self):
@@ -493,36 +657,146 @@ class Channel(object):
 
     @property
     def queue(self):
-        return self._waiters and self._waiters[0] or None
+        waiters = self._senders or self._receivers
+        return waiters and waiters[0][0] or None
+
+    @staticmethod
+    def _live(waiters):
+        # drop waiters left behind by select() calls that already went
+        # another way, then report whether there are any left
+        while waiters and waiters[0][2] is not None and \
+                waiters[0][2][0] is not None:
+            waiters.popleft()
+        return bool(waiters)
+
+    def _can_receive(self):
+        return bool(self._buffer) or self._live(self._senders)
+
+    def _can_send(self):
+        return self._live(self._receivers) or \
+                len(self._buffer) < self.capacity
+
+    def _wake(self, waiter, switch):
+        # wake a parked greenlet, switching straight to it if *switch*
+        glet, sel = waiter[0], waiter[2]
+        if sel is not None and sel[2] is not None and \
+                not scheduler._untime(sel[2], glet):
+            # its timeout already has it scheduled
+            return
+        if switch:
+            scheduler.schedule(greenlet.getcurrent())
+            glet.switch()
+        else:
+            scheduler.schedule(glet)
+
+    def _take(self):
+        # the item from the first parked sender, which gets woken up
+        sender = self._senders.popleft()
+        if sender[2] is not None:
+            sender[2][0] = sender[3]
+        return sender[1], sender
 
     def receive(self):
-        if self._closing and not self._dataqueue:
-            raise StopIteration()
-        if self._dataqueue:
-            item = self._dataqueue.popleft()
-            sender = self._waiters.popleft()
-            if self.preference is 1:
-                scheduler.schedule(greenlet.getcurrent())
-                sender.switch()
-            else:
-                scheduler.schedule(sender)
+        if self._buffer:
+            item = self._buffer.popleft()
+            if self._live(self._senders):
+                # a blocked sender's item takes the freed space
+                moved, sender = self._take()
+                self._buffer.append(moved)
+                self._wake(sender, self._preference == 1)
             return item
-        else:
-            self._waiters.append(greenlet.getcurrent())
-            state.mainloop.switch()
-            return self._dataqueue.pop()
+        if self._live(self._senders):
+            item, sender = self._take()
+            self._wake(sender, self._preference == 1)
+            return item
+        if self._closing:
+            raise StopIteration()
+
+        waiter = [greenlet.getcurrent(), None, None, None]
+        self._receivers.append(waiter)
+        state.mainloop.switch()
+        return waiter[1]
 
     next = receive
 
     def send(self, item):
-        if self._waiters and not self._dataqueue:
-            self._dataqueue.append(item)
-            if self.preference is -1:
-                scheduler.schedule(greenlet.getcurrent())
-                self._waiters.popleft().switch()
-            else:
-                scheduler.schedule(self._waiters.popleft())
+        if self._live(self._receivers):
+            receiver = self._receivers.popleft()
+            receiver[1] = item
+            if receiver[2] is not None:
+                receiver[2][0], receiver[2][1] = receiver[3], item
+            self._wake(receiver, self._preference == -1)
+        elif len(self._buffer) < self.capacity:
+            self._buffer.append(item)
         else:
-            self._dataqueue.append(item)
-            self._waiters.append(greenlet.getcurrent())
+            self._senders.append([greenlet.getcurrent(), item, None, None])
             state.mainloop.switch()
+
+def select(operations, timeout=None, blocking=True):
+    """carry out the first of several channel operations that can go ahead
+
+    each of *operations* is either a Channel to receive from or a (Channel,
+    item) pair to send item on. exactly one of them happens, and this returns
+    its index and the item received (None for a send). if several are ready
+    at once, one of them is picked at random.
+
+    if none are ready this blocks until one is, then cancels the rest. with
+    *blocking* False, or after *timeout* seconds, it gives up and returns
+    (None, None) instead. receiving from a closed channel never goes ahead,
+    and if that's all there is StopIteration is raised"""
+    ops = []
+    for operation in operations:
+        if isinstance(operation, Channel):
+            ops.append((operation, None, False))
+        else:
+            ops.append((operation[0], operation[1], True))
+
+    ready = []
+    for index, (channel, item, sending) in enumerate(ops):
+        if sending and channel._can_send():
+            ready.append(index)
+        elif not sending and channel._can_receive():
+            ready.append(index)
+    if ready:
+        index = random.choice(ready)
+        channel, item, sending = ops[index]
+        if sending:
+            channel.send(item)
+            return index, None
+        return index, channel.receive()
+
+    if all(not sending and channel._closing
+            for channel, item, sending in ops):
+        raise StopIteration()
+    if not blocking:
+        return None, None
+
+    # park in every channel at once, whichever one gets to us first marks
+    # the shared select list so the others skip over it
+    current = greenlet.getcurrent()
+    deadline = timeout is not None and time.time() + timeout or None
+    sel = [None, None, deadline]
+    waiters = []
+    for index, (channel, item, sending) in enumerate(ops):
+        waiter = [current, item, sel, index]
+        if sending:
+            channel._senders.append(waiter)
+        else:
+            channel._receivers.append(waiter)
+        waiters.append(waiter)
+    if deadline is not None:
+        bisect.insort(state.timed_paused, (deadline, current))
+
+    try:
+        state.mainloop.switch()
+    finally:
+        for (channel, item, sending), waiter in zip(ops, waiters):
+            queue = sending and channel._senders or channel._receivers
+            for i, other in enumerate(queue):
+                if other is waiter:
+                    del queue[i]
+                    break
+        if sel[0] is None and deadline is not None:
+            scheduler._untime(deadline, current)
+
+    return sel[0], sel[1]
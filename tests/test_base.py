@@ -29,6 +29,8 @@ class StateClearingTestCase(unittest.TestCase):
         state.paused[:] = []
         state.descriptormap.clear()
         state.to_run.clear()
+        state.unflushed.clear()
+        state.write_blocked.clear()
 
         greenhouse.poller.set()
 
@@ -0,0 +1,270 @@
+import os
+import socket
+import struct
+import tempfile
+import time
+import unittest
+
+import greenhouse
+import greenhouse.dns
+
+from test_base import TESTING_TIMEOUT, StateClearingTestCase, port
+
+
+class FakeNameServer(object):
+    "answers A/AAAA queries from a dict, over UDP and TCP on the same port"
+    def __init__(self, records, ttl=300, truncate=False):
+        self.records = records
+        self.ttl = ttl
+        self.truncate = truncate
+        self.ignore = set()
+        self.queries = []
+
+        while 1:
+            self.udp = greenhouse.Socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.udp.bind(("127.0.0.1", 0))
+            self.address = self.udp.getsockname()
+
+            # the UDP port the kernel picked may be taken for TCP
+            self.tcp = greenhouse.Socket()
+            self.tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                self.tcp.bind(self.address)
+            except socket.error:
+                self.udp.close()
+                self.tcp.close()
+                continue
+            break
+        self.tcp.listen(5)
+
+        greenhouse.schedule(self._serve_udp)
+        greenhouse.schedule(self._serve_tcp)
+
+    def close(self):
+        self.udp._sock.close()
+        self.tcp._sock.close()
+
+    def _answer(self, query, truncate):
+        qid = struct.unpack("!H", query[:2])[0]
+        offset, labels = 12, []
+        while ord(query[offset]):
+            length = ord(query[offset])
+            labels.append(query[offset + 1:offset + 1 + length])
+            offset += length + 1
+        question = query[12:offset + 5]
+        qtype = struct.unpack("!H", query[offset + 1:offset + 3])[0]
+        name = ".".join(labels)
+        self.queries.append((name, qtype))
+
+        if qtype in self.ignore:
+            return None
+        if truncate:
+            return struct.pack("!6H", qid, 0x8380, 1, 0, 0, 0) + question
+
+        family = qtype == 28 and socket.AF_INET6 or socket.AF_INET
+        if name not in self.records:
+            return struct.pack("!6H", qid, 0x8183, 1, 0, 0, 0) + question
+
+        answers = [address for address in self.records[name]
+                if (':' in address) == (family == socket.AF_INET6)]
+        rrs = []
+        for address in answers:
+            rdata = socket.inet_pton(family, address)
+            # use a compression pointer back to the question's name
+            rrs.append(struct.pack("!3HIH", 0xC00C, qtype, 1, self.ttl,
+                len(rdata)) + rdata)
+        return struct.pack("!6H", qid, 0x8180, 1, len(rrs), 0, 0) + \
+                question + "".join(rrs)
+
+    def _serve_udp(self):
+        while 1:
+            query, addr = self.udp.recvfrom(512)
+            response = self._answer(query, self.truncate)
+            if response is not None:
+                self.udp.sendto(response, addr)
+
+    def _serve_tcp(self):
+        while 1:
+            conn, addr = self.tcp.accept()
+            stream = greenhouse.Stream(conn)
+            length = struct.unpack("!H", stream.readexactly(2))[0]
+            response = self._answer(stream.readexactly(length), False)
+            conn.sendall(struct.pack("!H", len(response)) + response)
+
+class ResolverTestCase(StateClearingTestCase):
+    def setUp(self):
+        StateClearingTestCase.setUp(self)
+        self.server = FakeNameServer({
+            "example.test": ["10.1.2.3", "10.1.2.4", "fe80::1"],
+            "localhost.test": ["127.0.0.1"],
+            "db.corp.test": ["10.5.5.5"]})
+        self.resolver = greenhouse.dns.Resolver(
+                nameservers=[self.server.address],
+                hosts={("pinned.test", socket.AF_INET): ["10.9.9.9"]},
+                timeout=TESTING_TIMEOUT, search=[])
+        greenhouse.dns.set_resolver(self.resolver)
+
+    def tearDown(self):
+        greenhouse.dns.set_resolver(None)
+        self.server.close()
+        StateClearingTestCase.tearDown(self)
+
+    def test_resolves(self):
+        assert self.resolver.resolve("example.test") == \
+                ["10.1.2.3", "10.1.2.4"]
+        assert self.resolver.resolve("Example.Test.",
+                socket.AF_INET6) == ["fe80::1"]
+        assert self.resolver.resolve("example.test", socket.AF_UNSPEC) == \
+                ["10.1.2.3", "10.1.2.4", "fe80::1"]
+
+    def test_hosts_and_numeric(self):
+        assert self.resolver.resolve("pinned.test") == ["10.9.9.9"]
+        assert self.resolver.resolve("10.0.0.1") == ["10.0.0.1"]
+        assert not self.server.queries
+
+    def test_caches_answers(self):
+        self.resolver.resolve("example.test")
+        self.resolver.resolve("example.test")
+        assert self.server.queries == [("example.test", 1)]
+
+        self.resolver.clear_cache()
+        self.resolver.resolve("example.test")
+        assert len(self.server.queries) == 2
+
+    def test_expires_cache(self):
+        self.server.ttl = 0
+        self.resolver.resolve("example.test")
+        self.resolver.resolve("example.test")
+        assert len(self.server.queries) == 2
+
+    def test_negative_caching(self):
+        self.assertRaises(socket.gaierror, self.resolver.resolve,
+                "missing.test")
+        self.assertRaises(socket.gaierror, self.resolver.resolve,
+                "missing.test")
+        assert self.server.queries == [("missing.test", 1)]
+
+    def test_deduplicates_inflight_lookups(self):
+        results = []
+
+        for i in xrange(5):
+            @greenhouse.schedule
+            def f():
+                results.append(self.resolver.resolve("example.test"))
+
+        while len(results) < 5:
+            greenhouse.pause()
+
+        assert results == [["10.1.2.3", "10.1.2.4"]] * 5
+        assert self.server.queries == [("example.test", 1)]
+
+    def test_tcp_fallback_on_truncation(self):
+        self.server.truncate = True
+        assert self.resolver.resolve("example.test") == \
+                ["10.1.2.3", "10.1.2.4"]
+        assert self.server.queries == [("example.test", 1)] * 2
+
+    def test_search_list(self):
+        self.resolver.search = ["corp.test"]
+        assert self.resolver.resolve("db") == ["10.5.5.5"]
+        assert self.server.queries == [("db.corp.test", 1)]
+
+        # names with ndots dots are tried as they are first
+        del self.server.queries[:]
+        assert self.resolver.resolve("example.test") == \
+                ["10.1.2.3", "10.1.2.4"]
+        assert self.server.queries == [("example.test", 1)]
+
+        # and absolute names only as they are
+        del self.server.queries[:]
+        self.assertRaises(socket.gaierror, self.resolver.resolve, "db.")
+        assert self.server.queries == [("db", 1)]
+
+    def test_unspec_returns_partial_answers(self):
+        self.server.ignore.add(28)
+        self.resolver.attempts = 1
+        assert self.resolver.resolve("example.test", socket.AF_UNSPEC) == \
+                ["10.1.2.3", "10.1.2.4"]
+
+    def test_unspec_queries_concurrently(self):
+        self.server.ignore.update([1, 28])
+        self.resolver.attempts = 1
+        start = time.time()
+        self.assertRaises(socket.gaierror, self.resolver.resolve,
+                "example.test", socket.AF_UNSPEC)
+        assert time.time() - start < TESTING_TIMEOUT * 1.8
+        assert sorted(self.server.queries) == \
+                [("example.test", 1), ("example.test", 28)]
+
+    def test_unreachable_server(self):
+        self.server.close()
+        self.assertRaises(socket.gaierror, self.resolver.resolve,
+                "example.test")
+
+    def test_connect_resolves_hostnames(self):
+        server = greenhouse.Socket()
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(("127.0.0.1", port()))
+        server.listen(5)
+
+        client = greenhouse.Socket()
+        client.connect(("localhost.test", port()))
+        handler, addr = server.accept()
+
+        client.send("howdy")
+        assert handler.recv(5) == "howdy"
+        server._sock.close()
+
+    def test_monkeypatched_getaddrinfo(self):
+        greenhouse.monkeypatch()
+        try:
+            results = socket.getaddrinfo("example.test", 80, socket.AF_INET,
+                    socket.SOCK_STREAM)
+            assert [r[4] for r in results] == \
+                    [("10.1.2.3", 80), ("10.1.2.4", 80)]
+            assert socket.gethostbyname("example.test") == "10.1.2.3"
+        finally:
+            greenhouse.unmonkeypatch()
+        assert socket.getaddrinfo is greenhouse.dns._getaddrinfo
+
+
+class ResolvConfTestCase(StateClearingTestCase):
+    def read(self, text):
+        fd, path = tempfile.mkstemp()
+        try:
+            os.write(fd, text)
+            os.close(fd)
+            return greenhouse.dns._read_resolv_conf(path)
+        finally:
+            os.unlink(path)
+
+    def test_reads_everything(self):
+        conf = self.read("""# comment
+nameserver 10.0.0.1
+nameserver 10.0.0.2 ; trailing
+domain old.test
+search a.test b.test.
+options ndots:2 timeout:3 attempts:4 rotate
+""")
+        assert conf == {
+            'nameservers': ["10.0.0.1", "10.0.0.2"],
+            'search': ["a.test", "b.test"],
+            'ndots': 2, 'timeout': 3, 'attempts': 4}
+
+    def test_last_of_domain_and_search_wins(self):
+        conf = self.read("search a.test b.test\ndomain c.test\n")
+        assert conf['search'] == ["c.test"]
+
+    def test_clamps_options(self):
+        conf = self.read("options ndots:99 timeout:0 attempts:x\n")
+        assert conf['ndots'] == 15
+        assert conf['timeout'] == 1
+        assert 'attempts' not in conf
+
+    def test_missing_file(self):
+        assert greenhouse.dns._read_resolv_conf("/nonexistent") == \
+                {'nameservers': [], 'search': []}
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,5 @@
 import array
+import errno
 import multiprocessing
 import os
 import socket
@@ -59,6 +60,140 @@ class SocketPollerMixin(object):
             client._sock.close()
             self.assertRaises(socket.error, client.recv, 10)
 
+    def test_close_releases_descriptor(self):
+        with self.socketpair() as (client, handler):
+            fd = client.fileno()
+            assert fd in greenhouse._state.state.descriptormap
+            client.close()
+
+            assert client.fileno() == -1
+            assert fd not in greenhouse._state.state.descriptormap
+            self.assertRaises(OSError, os.fstat, fd)
+            self.assertRaises(socket.error, client.recv, 10)
+            self.assertRaises(socket.error, client.send, "howdy")
+            client.close()
+
+    def test_close_wakes_blocked_greenlets(self):
+        with self.socketpair() as (client, handler):
+            errors = []
+
+            @greenhouse.schedule
+            def f():
+                try:
+                    client.recv(10)
+                except socket.error, err:
+                    errors.append(err.args[0])
+
+            greenhouse.pause()
+            assert not errors
+
+            client.close()
+            greenhouse.pause()
+            assert errors == [errno.EBADF]
+            assert client._registrations == 0
+
+    def test_makefile_keeps_socket_open(self):
+        with self.socketpair() as (client, handler):
+            reader = client.makefile('rb', 0)
+            client.close()
+
+            handler.sendall("still open\n")
+            assert reader.readline() == "still open\n"
+            assert client.fileno() != -1
+
+            reader.close()
+            assert client.fileno() == -1
+
+    def test_waiter_slot(self):
+        with self.socketpair() as (client, handler):
+            assert not hasattr(client, "__dict__")
+            assert client._readable is None and client._writable is None
+            results = []
+
+            @greenhouse.schedule
+            def f():
+                results.append(client.recv(5))
+            glet = greenhouse._state.state.paused[-1]
+
+            greenhouse.pause()
+            assert client._readable is glet
+
+            handler.send("howdy")
+            greenhouse.pause()
+            assert results == ["howdy"]
+            assert client._readable is None
+
+    def test_wakeup_cancels_timeout(self):
+        with self.socketpair() as (client, handler):
+            client.settimeout(TESTING_TIMEOUT * 10)
+            results = []
+
+            @greenhouse.schedule
+            def f():
+                results.append(client.recv(5))
+
+            greenhouse.pause()
+            assert client._read_deadline is not None
+            assert len(greenhouse._state.state.timed_paused) == 1
+
+            handler.send("howdy")
+            greenhouse.pause()
+            assert results == ["howdy"]
+            assert client._read_deadline is None
+            assert not greenhouse._state.state.timed_paused
+
+    def test_several_waiters(self):
+        with self.socketpair() as (client, handler):
+            received = []
+
+            @greenhouse.schedule
+            def f():
+                received.append(client.recv(5))
+
+            @greenhouse.schedule
+            def g():
+                received.append(client.recv(5))
+
+            greenhouse.pause()
+            assert isinstance(client._readable, list)
+
+            handler.send("howdy")
+            greenhouse.pause()
+            assert received == ["howdy"]
+
+            handler.send("hello")
+            greenhouse.pause()
+            assert sorted(received) == ["hello", "howdy"]
+            assert client._readable is None
+
+    def test_several_waiters_timeouts(self):
+        with self.socketpair() as (client, handler):
+            client.settimeout(TESTING_TIMEOUT)
+            results = []
+
+            @greenhouse.schedule
+            def f():
+                try:
+                    client.recv(5)
+                except socket.timeout:
+                    results.append("timeout")
+
+            greenhouse.pause()
+            client.settimeout(None)
+
+            @greenhouse.schedule
+            def g():
+                results.append(client.recv(5))
+
+            greenhouse.pause()
+            greenhouse.pause_for(TESTING_TIMEOUT * 2)
+            assert results == ["timeout"]
+
+            handler.send("howdy")
+            greenhouse.pause()
+            assert results == ["timeout", "howdy"]
+            assert client._readable is None
+
     def test_recvfrom(self):
         with self.socketpair() as (client, handler):
             client.send("howdy")
@@ -99,6 +234,337 @@ class SocketPollerMixin(object):
             handler.sendall("hello, world")
             assert client.recv(12) == "hello, world"
 
+    def _recv_in_grlet(self, sock, nbytes):
+        received = []
+
+        @greenhouse.schedule
+        def f():
+            total = 0
+            while total < nbytes:
+                data = sock.recv(65536)
+                received.append(data)
+                total += len(data)
+
+        return received
+
+    def test_sendall_large(self):
+        with self.socketpair() as (client, handler):
+            data = os.urandom(4 * 1024 * 1024)
+            received = self._recv_in_grlet(handler, len(data))
+
+            client.sendall(data)
+            while sum(map(len, received)) < len(data):
+                greenhouse.pause()
+            assert "".join(received) == data
+
+    def test_send_many(self):
+        with self.socketpair() as (client, handler):
+            client.send_many(["head", bytearray("er:"), "", buffer("body")])
+            assert handler.recv(20) == "header:body"
+
+    def test_send_many_memoryviews(self):
+        with self.socketpair() as (client, handler):
+            data = bytearray("xxheader:body")
+            client.send_many([memoryview(data)[2:9], memoryview("body")])
+            assert handler.recv(20) == "header:body"
+
+    def test_send_many_arrays_and_unicode(self):
+        with self.socketpair() as (client, handler):
+            ints = array.array('i', [1, 2])
+            client.send_many([ints, u"abc", "def"])
+            assert handler.recv(20) == ints.tostring() + "abcdef"
+
+    def test_send_many_partial_writes(self):
+        with self.socketpair() as (client, handler):
+            buffers = [os.urandom(1024 * 1024 + i) for i in xrange(5)]
+            total = sum(map(len, buffers))
+            received = self._recv_in_grlet(handler, total)
+
+            client.send_many(buffers)
+            while sum(map(len, received)) < total:
+                greenhouse.pause()
+            assert "".join(received) == "".join(buffers)
+
+    def test_write_coalescing(self):
+        with self.socketpair() as (client, handler):
+            client.setwritebuffer(1024)
+            client.send("GET")
+            client.sendall(" / ")
+            client.send_many(["HTTP/1.0", "\r\n"])
+
+            # nothing goes out until the scheduler is about to poll
+            self.assertRaises(socket.error, handler._sock.recv, 100)
+
+            greenhouse.pause()
+            assert handler.recv(100) == "GET / HTTP/1.0\r\n"
+            assert not greenhouse._state.state.unflushed
+
+    def test_write_coalescing_threshold(self):
+        with self.socketpair() as (client, handler):
+            client.setwritebuffer(8)
+            client.send("1234")
+            client.send("5678")
+            assert handler.recv(100) == "12345678"
+
+            client.send("abc")
+            client.setwritebuffer(0)
+            assert handler.recv(100) == "abc"
+
+            client.send("def")
+            assert handler.recv(100) == "def"
+
+    def test_shutdown_flushes_coalesced_writes(self):
+        with self.socketpair() as (client, handler):
+            client.setwritebuffer(4096)
+            client.sendall("bye")
+            client.shutdown(socket.SHUT_WR)
+            assert client._write_error is None
+            assert handler.recv(100) == "bye"
+            assert handler.recv(100) == ""
+
+    def test_close_flushes_coalesced_writes(self):
+        with self.socketpair() as (client, handler):
+            client.setwritebuffer(4096)
+            client.sendall("bye")
+            client.close()
+            assert handler.recv(100) == "bye"
+            assert handler.recv(100) == ""
+
+    def test_close_reports_writes_a_stalled_peer_never_took(self):
+        with self.socketpair() as (client, handler):
+            client.setwritebuffer(8 * 1024 * 1024)
+            client.settimeout(TESTING_TIMEOUT)
+            data = os.urandom(4 * 1024 * 1024)
+            client.sendall(data)
+
+            # handler never reads, so the buffer can't all go out
+            self.assertRaises(socket.timeout, client.close)
+            assert client.fileno() == -1
+            state = greenhouse._state.state
+            assert client not in state.unflushed
+            assert client not in state.write_blocked
+            assert handler.recv(100)
+
+    def test_watermarks_close_right_after_sendall(self):
+        with self.socketpair() as (client, handler):
+            client.setwatermarks(64 * 1024)
+            data = os.urandom(4 * 1024 * 1024)
+            received = self._recv_in_grlet(handler, len(data))
+            client.sendall(data)
+            assert len(client._outbuf) > client._low_water
+
+            client.close()
+            while sum(map(len, received)) < len(data):
+                greenhouse.pause()
+            assert "".join(received) == data
+
+    def test_watermarks_shutdown_right_after_sendall(self):
+        with self.socketpair() as (client, handler):
+            client.setwatermarks(64 * 1024)
+            data = os.urandom(4 * 1024 * 1024)
+            received = self._recv_in_grlet(handler, len(data))
+            client.sendall(data)
+
+            client.shutdown(socket.SHUT_WR)
+            assert not client._outbuf
+            while sum(map(len, received)) < len(data):
+                greenhouse.pause()
+            assert "".join(received) == data
+            assert handler.recv(100) == ""
+
+    def test_watermarks_never_block_writers(self):
+        with self.socketpair() as (client, handler):
+            client.setwatermarks(64 * 1024)
+            data = os.urandom(4 * 1024 * 1024)
+            client.sendall(data)
+            assert len(client._outbuf) > 0
+
+            # the scheduler waits on writability instead of retrying
+            greenhouse.pause()
+            state = greenhouse._state.state
+            assert client in state.write_blocked
+            assert client not in state.unflushed
+
+            received = self._recv_in_grlet(handler, len(data))
+            while sum(map(len, received)) < len(data):
+                greenhouse.pause()
+            assert "".join(received) == data
+            assert not client._outbuf
+            assert client not in state.write_blocked
+            assert not client._registrations
+
+    def test_drain(self):
+        with self.socketpair() as (client, handler):
+            client.setwatermarks(64 * 1024, 16 * 1024)
+            client.sendall("x" * 32 * 1024)
+            client.drain()
+            assert len(client._outbuf) == 32 * 1024
+
+            client.sendall(os.urandom(4 * 1024 * 1024))
+            received = self._recv_in_grlet(handler, 4 * 1024 * 1024)
+            client.drain()
+            assert len(client._outbuf) <= 16 * 1024
+            assert received
+
+            client.setwatermarks(0)
+            assert client._outbuf is None
+
+    def test_watermark_validation(self):
+        sock = greenhouse.Socket()
+        self.assertRaises(ValueError, sock.setwatermarks, 10, 20)
+
+    def _sendfile_test(self):
+        fname = tempfile.mktemp()
+        data = os.urandom(2 * 1024 * 1024)
+        with open(fname, 'w') as fp:
+            fp.write(data)
+
+        try:
+            with self.socketpair() as (client, handler):
+                fp = greenhouse.File(fname)
+                try:
+                    received = self._recv_in_grlet(handler, len(data) - 100)
+                    assert client.sendfile(fp, 100) == len(data) - 100
+                    while sum(map(len, received)) < len(data) - 100:
+                        greenhouse.pause()
+                    assert "".join(received) == data[100:]
+
+                    assert client.sendfile(fp, 10, 20) == 20
+                    assert handler.recv(100) == data[10:30]
+                    assert fp.read(5) == data[30:35]
+                finally:
+                    fp.close()
+        finally:
+            os.unlink(fname)
+
+    def test_sendfile(self):
+        self._sendfile_test()
+
+    def test_sendfile_fallback(self):
+        sendfile = greenhouse.io.sendfile
+        greenhouse.io.sendfile = None
+        try:
+            self._sendfile_test()
+        finally:
+            greenhouse.io.sendfile = sendfile
+
+    def test_sendfile_flushes_write_buffer(self):
+        fname = tempfile.mktemp()
+        try:
+            with self.socketpair() as (client, handler):
+                fp = greenhouse.File(fname, 'w+b')
+                try:
+                    fp.setwritebuffer(4096)
+                    fp.write("hello world")
+                    assert client.sendfile(fp, 0) == 11
+                    assert handler.recv(100) == "hello world"
+                finally:
+                    fp.close()
+        finally:
+            os.unlink(fname)
+
+    def _splice_test(self):
+        data = os.urandom(256 * 1024)
+        rfp, wfp = greenhouse.pipe()
+        left, right = socket.socketpair()
+        left = greenhouse.Socket(fromsock=left)
+        right = greenhouse.Socket(fromsock=right)
+        received = []
+        done = greenhouse.Event()
+
+        @greenhouse.schedule
+        def writer():
+            wfp.write(data)
+            wfp.close()
+
+        @greenhouse.schedule
+        def reader():
+            while 1:
+                chunk = right.recv(8192)
+                if not chunk:
+                    break
+                received.append(chunk)
+            done.set()
+
+        try:
+            assert greenhouse.splice(rfp, left, 10) == 10
+            assert greenhouse.splice(rfp, left) == len(data) - 10
+            left.shutdown(socket.SHUT_WR)
+            assert not done.wait(TESTING_TIMEOUT)
+            assert "".join(received) == data
+        finally:
+            rfp.close()
+            left.close()
+            right.close()
+
+    def test_splice(self):
+        self._splice_test()
+
+    def test_splice_fallback(self):
+        splice = greenhouse.compat.splice
+        greenhouse.compat.splice = None
+        try:
+            self._splice_test()
+        finally:
+            greenhouse.compat.splice = splice
+
+    def test_proxy(self):
+        a, a_inner = map(lambda s: greenhouse.Socket(fromsock=s),
+                socket.socketpair())
+        b_inner, b = map(lambda s: greenhouse.Socket(fromsock=s),
+                socket.socketpair())
+        l = []
+
+        @greenhouse.schedule
+        def f():
+            l.append(greenhouse.proxy(a_inner, b_inner))
+
+        try:
+            a.sendall("hello")
+            assert b.recv(5) == "hello"
+            b.sendall("hi")
+            assert a.recv(2) == "hi"
+
+            a.shutdown(socket.SHUT_WR)
+            assert b.recv(5) == ""
+            b.shutdown(socket.SHUT_WR)
+            assert a.recv(5) == ""
+
+            greenhouse.pause()
+            assert l == [(5, 2)]
+        finally:
+            for sock in (a, a_inner, b_inner, b):
+                sock.close()
+
+    def test_send_fds(self):
+        if greenhouse.io.sendmsg_fds is None: #pragma: no cover
+            raise unittest.SkipTest("no descriptor passing here")
+        left, right = socket.socketpair()
+        left = greenhouse.Socket(fromsock=left)
+        right = greenhouse.Socket(fromsock=right)
+        rfd, wfd = os.pipe()
+        l = []
+
+        @greenhouse.schedule
+        def f():
+            l.append(right.recv_fds(10, 4))
+
+        greenhouse.pause()
+        assert not l
+
+        left.send_fds("pipe", [wfd])
+        os.close(wfd)
+        greenhouse.pause()
+        assert l
+        data, fds = l[0]
+        assert data == "pipe"
+        assert len(fds) == 1
+
+        os.write(fds[0], "through the pipe")
+        os.close(fds[0])
+        assert os.read(rfd, 100) == "through the pipe"
+        os.close(rfd)
+
     def test_sendto(self):
         with self.socketpair() as (client, handler):
             client.sendto("howdy", ("", port()))
@@ -229,11 +695,127 @@ class SocketPollerMixin(object):
         handler, addr = server.accept()
         assert handler.recv(5) == "howdy"
 
+    def test_several_acceptors(self):
+        server = greenhouse.Socket()
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(("", port()))
+        server.listen(5)
+        received = []
+
+        def acceptor():
+            handler, addr = server.accept()
+            received.append(handler.recv(5))
+        greenhouse.schedule(acceptor)
+        greenhouse.schedule(acceptor)
+        greenhouse.pause()
+
+        clients = []
+        for i in xrange(2):
+            client = greenhouse.Socket()
+            client.connect(("", port()))
+            client.send("howdy")
+            clients.append(client)
+
+        while len(received) < 2:
+            greenhouse.pause_for(TESTING_TIMEOUT)
+        assert received == ["howdy", "howdy"]
+        server.close()
+
     def test_getnames(self):
         with self.socketpair() as (client, handler):
             assert client.getsockname() == handler.getpeername()
             assert client.getpeername() == handler.getsockname()
 
+    def test_recv_into_doesnt_wait_when_ready(self):
+        with self.socketpair() as (client, handler):
+            client.send("howdy")
+            time.sleep(TESTING_TIMEOUT)
+            l = []
+
+            @greenhouse.schedule
+            def f():
+                l.append(1)
+
+            collector = bytearray(10)
+            assert handler.recv_into(memoryview(collector)[5:]) == 5
+            assert collector[5:] == "howdy"
+            assert not l
+
+    def test_ring_buffer_wraps(self):
+        with self.socketpair() as (client, handler):
+            ring = greenhouse.RingBuffer(bytearray(8))
+
+            client.send("abcdef")
+            assert ring.fill(handler) == 6
+            ring.consume(4)
+            assert [v.tobytes() for v in ring.views()] == ["ef"]
+
+            client.send("ghijkl")
+            assert ring.fill(handler) == 2
+            assert ring.fill(handler) == 4
+            assert ring.free() == 0
+            self.assertRaises(BufferError, ring.fill, handler)
+            assert [v.tobytes() for v in ring.views()] == ["efgh", "ijkl"]
+
+            ring.consume(6)
+            assert len(ring) == 2
+            assert [v.tobytes() for v in ring.views()] == ["kl"]
+
+    def test_stream_readline(self):
+        with self.socketpair() as (client, handler):
+            stream = greenhouse.Stream(handler)
+            client.sendall("this\nis\na test\r\n\nwith no end")
+            client.shutdown(socket.SHUT_WR)
+
+            assert stream.readline() == "this\n"
+            assert stream.peek(2) == "is"
+            assert list(stream) == [
+                    "is\n", "a test\r\n", "\n", "with no end"]
+            assert stream.readline() == ""
+
+    def test_stream_readuntil_across_recvs(self):
+        with self.socketpair() as (client, handler):
+            stream = greenhouse.Stream(handler, bufsize=8)
+            results = []
+
+            @greenhouse.schedule
+            def f():
+                results.append(stream.readuntil("\r\n\r\n"))
+                results.append(stream.readexactly(4))
+
+            for piece in ("GET / HTTP/1.0\r", "\nHost: x\r\n\r", "\nbody"):
+                greenhouse.pause()
+                assert not results
+                client.sendall(piece)
+                time.sleep(TESTING_TIMEOUT)
+
+            greenhouse.pause()
+            assert results == [
+                    "GET / HTTP/1.0\r\nHost: x\r\n\r\n", "body"], results
+
+    def test_stream_readexactly_incomplete(self):
+        with self.socketpair() as (client, handler):
+            stream = greenhouse.Stream(handler)
+            client.sendall("1234567")
+            client.shutdown(socket.SHUT_WR)
+
+            assert stream.readexactly(4) == "1234"
+            try:
+                stream.readexactly(4)
+            except greenhouse.Stream.Incomplete, exc:
+                assert exc.partial == "567"
+            else:
+                assert 0, "Stream.Incomplete not raised"
+
+    def test_stream_max_line(self):
+        with self.socketpair() as (client, handler):
+            stream = greenhouse.Stream(handler, bufsize=4, max_line=10)
+            client.sendall("short\n" + "x" * 20 + "\n")
+
+            assert stream.readline() == "short\n"
+            self.assertRaises(greenhouse.Stream.LimitExceeded,
+                    stream.readline)
+
 if greenhouse.poller.Epoll._POLLER:
     class EpollSocketTestCase(SocketPollerMixin, StateClearingTestCase):
         def setUp(self):
@@ -251,6 +833,83 @@ class SelectSocketTestCase(SocketPollerMixin, StateClearingTestCase):
         StateClearingTestCase.setUp(self)
         greenhouse.poller.set(greenhouse.poller.Select())
 
+class DatagramEndpointTestCase(StateClearingTestCase):
+    def setUp(self):
+        StateClearingTestCase.setUp(self)
+        self.receiver = greenhouse.DatagramEndpoint(("127.0.0.1", 0),
+                batch_size=4, bufsize=16)
+        self.sender = greenhouse.DatagramEndpoint(("127.0.0.1", 0))
+        self.address = self.receiver.socket.getsockname()
+
+    def test_drains_pending_datagrams(self):
+        self.sender.sendto_many(
+                [("packet %d" % i, self.address) for i in xrange(6)])
+
+        batch = self.receiver.recv_batch()
+        assert [data.tobytes() for data, addr in batch] == \
+                ["packet 0", "packet 1", "packet 2", "packet 3"]
+        assert batch[0][1] == self.sender.socket.getsockname()
+
+        batch = self.receiver.recv_batch()
+        assert [data.tobytes() for data, addr in batch] == \
+                ["packet 4", "packet 5"]
+
+    def test_waits_for_datagrams(self):
+        batches = []
+
+        @greenhouse.schedule
+        def f():
+            for batch in self.receiver:
+                batches.append([data.tobytes() for data, addr in batch])
+
+        greenhouse.pause()
+        assert not batches
+
+        self.sender.sendto("howdy", self.address)
+        self.sender.sendto("hello", self.address)
+        time.sleep(TESTING_TIMEOUT)
+        greenhouse.pause()
+        assert batches == [["howdy", "hello"]]
+
+    def test_batches_per_datagram_without_mmsg(self):
+        self.receiver._mmsg = self.sender._mmsg = False
+        self.test_drains_pending_datagrams()
+
+    def test_sends_to_hostnames(self):
+        # a name only the greenhouse resolver knows, so the stdlib's blocking
+        # getaddrinfo would fail on it
+        greenhouse.dns.set_resolver(greenhouse.dns.Resolver(nameservers=[],
+                hosts={("endpoint.test", socket.AF_INET): ["127.0.0.1"]},
+                search=[]))
+        unbatched = greenhouse.DatagramEndpoint(("127.0.0.1", 0))
+        unbatched._mmsg = False
+        try:
+            for endpoint in (self.sender, unbatched):
+                endpoint.sendto_many([
+                        ("howdy", ("endpoint.test", self.address[1])),
+                        (u"hello", self.address)])
+                batch = self.receiver.recv_batch()
+                assert [data.tobytes() for data, addr in batch] == \
+                        ["howdy", "hello"]
+        finally:
+            greenhouse.dns.set_resolver(None)
+            unbatched.socket.close()
+
+    def test_ipv6(self):
+        try:
+            receiver = greenhouse.DatagramEndpoint(("::1", 0),
+                    family=socket.AF_INET6)
+        except socket.error: #pragma: no cover
+            return # no IPv6 here
+        sender = greenhouse.DatagramEndpoint(("::1", 0),
+                family=socket.AF_INET6)
+        sender.sendto_many([("howdy", receiver.socket.getsockname())] * 2)
+        batch = receiver.recv_batch()
+        assert [data.tobytes() for data, addr in batch] == ["howdy"] * 2
+        assert batch[0][1] == sender.socket.getsockname()
+        receiver.socket.close()
+        sender.socket.close()
+
 class FilePollerMixin(object):
     def tearDown(self):
         super(FilePollerMixin, self).tearDown()
@@ -266,7 +925,7 @@ class FilePollerMixin(object):
         fp.close()
 
         fp2 = greenhouse.File(self.fname, 'r')
-        text = fp.read()
+        text = fp2.read()
         fp2.close()
 
         assert text == "this is testing text"
@@ -397,6 +1056,384 @@ test""")
         finally:
             fp.close()
 
+    def test_iterating_many_short_lines(self):
+        lines = ["%d\n" % i for i in xrange(20000)]
+        with open(self.fname, 'w') as fp:
+            fp.write("".join(lines))
+
+        fp = greenhouse.File(self.fname)
+        try:
+            assert list(fp) == lines
+        finally:
+            fp.close()
+
+    def test_lines_spanning_chunks(self):
+        lines = ["x" * 5000 + "\n", "y" * 20000 + "\n", "z" * 3]
+        with open(self.fname, 'w') as fp:
+            fp.write("".join(lines))
+
+        fp = greenhouse.File(self.fname)
+        try:
+            assert fp.readline() == lines[0]
+            assert list(fp) == lines[1:]
+        finally:
+            fp.close()
+
+    def test_custom_newline(self):
+        with open(self.fname, 'w') as fp:
+            fp.write("one\r\ntwo\nstill two\r\nthree")
+
+        fp = greenhouse.File(self.fname, newline="\r\n")
+        try:
+            assert fp.readline() == "one\r\n"
+            assert list(fp) == ["two\nstill two\r\n", "three"]
+        finally:
+            fp.close()
+
+    def test_max_line(self):
+        with open(self.fname, 'w') as fp:
+            fp.write("short\n" + "long" * 5 + "\nend\n")
+
+        fp = greenhouse.File(self.fname, max_line=8)
+        try:
+            assert list(fp) == ["short\n", "longlong", "longlong", "long\n",
+                    "end\n"]
+        finally:
+            fp.close()
+
+        fp = greenhouse.File(self.fname)
+        try:
+            assert fp.readline(3) == "sho"
+            assert fp.readline(10) == "rt\n"
+            assert fp.readline(0) == ""
+        finally:
+            fp.close()
+
+    def test_readinto(self):
+        data = os.urandom(100000)
+        with open(self.fname, 'w') as fp:
+            fp.write(data)
+
+        fp = greenhouse.File(self.fname)
+        try:
+            small, large = bytearray(10), bytearray(50000)
+            assert fp.readinto(small) == 10
+            assert fp.readinto(large) == 50000
+            assert fp.read(5) == data[50010:50015]
+            assert fp.readinto(large) == 49985
+            assert small + large[:49985] == data[:10] + data[50015:]
+            assert fp.readinto(small) == 0
+        finally:
+            fp.close()
+
+    def test_large_reads_in_small_chunks(self):
+        data = os.urandom(100000)
+        with open(self.fname, 'w') as fp:
+            fp.write(data)
+
+        fp = greenhouse.File(self.fname)
+        try:
+            chunks = []
+            chunk = fp.read(7)
+            while chunk:
+                chunks.append(chunk)
+                chunk = fp.read(7)
+            assert "".join(chunks) == data
+        finally:
+            fp.close()
+
+    def test_tell_with_read_ahead(self):
+        with open(self.fname, 'w') as fp:
+            fp.write("foo bar spam eggs")
+
+        fp = greenhouse.File(self.fname, 'r+')
+        try:
+            assert fp.read(4) == "foo "
+            assert fp.tell() == 4
+
+            fp.seek(4, os.SEEK_CUR)
+            assert fp.tell() == 8
+            fp.write("SPAM")
+            fp.seek(0)
+            assert fp.read() == "foo bar SPAM eggs"
+        finally:
+            fp.close()
+
+    def test_mmap_reads(self):
+        with open(self.fname, 'w') as fp:
+            fp.write("this\nis\na\n\ntest")
+
+        fp = greenhouse.File(self.fname, mmap=True)
+        try:
+            fp.madvise(fp.MADV_SEQUENTIAL)
+            assert fp.read(4) == "this"
+            assert fp.tell() == 4
+            assert fp.readline() == "\n"
+            assert list(fp) == ["is\n", "a\n", "\n", "test"]
+            assert fp.read() == ""
+
+            fp.seek(-4, os.SEEK_END)
+            assert fp.read() == "test"
+            fp.seek(2)
+            buf = bytearray(3)
+            assert fp.readinto(buf) == 3
+            assert buf == "is\n"
+        finally:
+            fp.close()
+
+    def test_mmap_views(self):
+        with open(self.fname, 'w') as fp:
+            fp.write("this\nis\na\n\ntest")
+
+        fp = greenhouse.File(self.fname, mmap=True, max_line=3)
+        try:
+            view = fp.readview(2)
+            assert isinstance(view, memoryview)
+            assert view.tobytes() == "th"
+            lines = [line.tobytes() for line in fp.iterviews()]
+            assert lines == ["is\n", "is\n", "a\n", "\n", "tes", "t"]
+        finally:
+            fp.close()
+
+        # the views outlive closing the file, but the file itself doesn't
+        assert view.tobytes() == "th"
+        self.assertRaises(IOError, fp.read)
+        self.assertRaises(IOError, fp.readview)
+
+    def test_mmap_views_are_private(self):
+        with open(self.fname, 'w') as fp:
+            fp.write("this\nis\na\n\ntest")
+
+        fp = greenhouse.File(self.fname, mmap=True)
+        try:
+            view = fp.readview(4)
+            view[0] = "T"
+            assert view.tobytes() == "This"
+        finally:
+            fp.close()
+        with open(self.fname) as fp:
+            assert fp.read(4) == "this"
+
+    def test_reads_after_close(self):
+        with open(self.fname, 'w') as fp:
+            fp.write("this\nis\na\n\ntest")
+
+        fp = greenhouse.File(self.fname)
+        assert fp.read(2) == "th"
+        fp.close()
+        for method in (fp.read, fp.readline, fp.readview):
+            try:
+                method()
+            except IOError, err:
+                assert err.args[0] == errno.EBADF
+            else:
+                assert 0, "%s didn't raise" % method.__name__
+        self.assertRaises(IOError, fp.readinto, bytearray(4))
+        self.assertRaises(IOError, list, fp)
+
+    def test_mmap_empty_file(self):
+        self.touch(self.fname)
+        fp = greenhouse.File(self.fname, mmap=True)
+        try:
+            assert fp.read() == ""
+            assert list(fp.iterviews()) == []
+        finally:
+            fp.close()
+
+    def test_mmap_requires_read_only(self):
+        self.assertRaises(ValueError, greenhouse.File, self.fname, 'w',
+                mmap=True)
+        assert not os.path.exists(self.fname)
+
+    def test_mmap_failure_closes_descriptor(self):
+        # directories open read-only fine but can't be mapped
+        dirname = tempfile.mkdtemp()
+        try:
+            before = len(os.listdir("/proc/self/fd"))
+            self.assertRaises(EnvironmentError, greenhouse.File, dirname,
+                    mmap=True)
+            assert len(os.listdir("/proc/self/fd")) == before
+        finally:
+            os.rmdir(dirname)
+
+    def follow(self, fp, count):
+        lines = []
+
+        @greenhouse.schedule
+        def f():
+            follower = fp.follow()
+            for line in follower:
+                lines.append(line)
+                if len(lines) == count:
+                    break
+            follower.close()
+
+        return lines
+
+    def append(self, path, data):
+        with open(path, 'a') as fp:
+            fp.write(data)
+        greenhouse.pause_for(TESTING_TIMEOUT)
+
+    def test_follow(self):
+        self.append(self.fname, "one\n")
+        fp = greenhouse.File(self.fname)
+        try:
+            lines = self.follow(fp, 3)
+            greenhouse.pause()
+            assert lines == ["one\n"]
+
+            self.append(self.fname, "two\nthr")
+            assert lines == ["one\n", "two\n"]
+
+            self.append(self.fname, "ee\n")
+            assert lines == ["one\n", "two\n", "three\n"]
+        finally:
+            fp.close()
+
+    def test_follow_truncation(self):
+        self.append(self.fname, "one\ntwo\n")
+        fp = greenhouse.File(self.fname)
+        try:
+            lines = self.follow(fp, 3)
+            greenhouse.pause()
+            assert lines == ["one\n", "two\n"]
+
+            with open(self.fname, 'w') as stdfp:
+                stdfp.write("a\n")
+            greenhouse.pause_for(TESTING_TIMEOUT)
+            assert lines == ["one\n", "two\n", "a\n"]
+        finally:
+            fp.close()
+
+    def test_follow_rotation(self):
+        rotated = self.fname + ".1"
+        self.append(self.fname, "one\n")
+        fp = greenhouse.File(self.fname)
+        try:
+            lines = self.follow(fp, 4)
+            greenhouse.pause()
+            assert lines == ["one\n"]
+
+            os.rename(self.fname, rotated)
+            self.append(rotated, "two\n")
+            self.append(self.fname, "three\nfour\n")
+            assert lines == ["one\n", "two\n", "three\n", "four\n"]
+        finally:
+            fp.close()
+            os.unlink(rotated)
+
+    def test_follow_requires_a_name(self):
+        self.touch(self.fname)
+        fd = os.open(self.fname, os.O_RDONLY)
+        fp = greenhouse.File.fromfd(fd)
+        try:
+            self.assertRaises(ValueError, next, fp.follow())
+        finally:
+            fp.close()
+
+    def test_write_buffer(self):
+        fp = greenhouse.File(self.fname, 'w')
+        try:
+            fp.setwritebuffer(10)
+            fp.write("howdy")
+            assert os.path.getsize(self.fname) == 0
+            assert fp.tell() == 5
+
+            fp.write("hello")
+            assert os.path.getsize(self.fname) == 10
+
+            fp.write("hi")
+            fp.flush()
+            assert os.path.getsize(self.fname) == 12
+
+            fp.write("hey")
+        finally:
+            fp.close()
+
+        with open(self.fname) as stdfp:
+            assert stdfp.read() == "howdyhellohihey"
+
+    def test_write_buffer_interval(self):
+        fp = greenhouse.File(self.fname, 'w')
+        try:
+            fp.setwritebuffer(1024, interval=TESTING_TIMEOUT)
+            fp.write("howdy")
+            greenhouse.pause()
+            assert os.path.getsize(self.fname) == 0
+
+            greenhouse.pause_for(TESTING_TIMEOUT * 2)
+            assert os.path.getsize(self.fname) == 5
+        finally:
+            fp.close()
+
+    def test_write_buffer_read_back(self):
+        fp = greenhouse.File(self.fname, 'w+')
+        try:
+            fp.setwritebuffer(1024)
+            fp.write("howdy")
+            fp.seek(0)
+            assert fp.read() == "howdy"
+        finally:
+            fp.close()
+
+    def _fsyncs(self, policy):
+        fsyncs = []
+        fsync = os.fsync
+        os.fsync = fsyncs.append
+        try:
+            fp = greenhouse.File(self.fname, 'w')
+            fp.setwritebuffer(1024, fsync=policy)
+            fp.write("howdy")
+            fp.flush()
+            flushed = list(fsyncs)
+            greenhouse.pause_for(TESTING_TIMEOUT * 2)
+            timed = list(fsyncs)
+            fp.close()
+        finally:
+            os.fsync = fsync
+        return flushed, timed, fsyncs, fp.fileno()
+
+    def test_fsync_every_flush(self):
+        flushed, timed, closed, fd = self._fsyncs(0)
+        assert flushed == timed == closed == [fd]
+
+    def test_fsync_interval(self):
+        flushed, timed, closed, fd = self._fsyncs(TESTING_TIMEOUT)
+        assert flushed == []
+        assert timed == closed == [fd]
+
+    def test_fsync_never(self):
+        flushed, timed, closed, fd = self._fsyncs(None)
+        assert flushed == timed == closed == []
+
+    def test_close_waits_for_running_fsync(self):
+        synced = []
+        fsync = os.fsync
+        def slow_fsync(fd):
+            time.sleep(TESTING_TIMEOUT)
+            synced.append(os.fstat(fd))
+        os.fsync = slow_fsync
+        try:
+            fp = greenhouse.File(self.fname, 'w')
+            fp.setwritebuffer(1024, fsync=TESTING_TIMEOUT)
+            fp.write("howdy")
+            fp.flush()
+            greenhouse.pause_for(TESTING_TIMEOUT * 1.5)
+            assert fp._fsyncing
+            fp.close()
+        finally:
+            os.fsync = fsync
+        assert len(synced) == 1
+        assert not fp._fsyncing
+
+    def test_off_loop_wakes_on_base_exception(self):
+        class Bail(BaseException):
+            pass
+        def bail():
+            raise Bail()
+        self.assertRaises(Bail, greenhouse.io._off_loop, bail)
+
     def test_writelines(self):
         lines = ["this\n", "is\n", "a\n", "test\n"]
         fp = greenhouse.File(self.fname, 'w')
@@ -57,6 +57,21 @@ class PollerMixin(object):
 
         self.assertEquals(poller._registry.items(), items)
 
+    def test_unregister_out_of_order(self):
+        with self.socketpair() as (client, handler):
+            poller = greenhouse._state.state.poller
+            poller.register(client, poller.INMASK)
+            poller.register(client, poller.OUTMASK)
+
+            # the socket is writable but not readable, so this should be
+            # left waiting on just the writability
+            poller.unregister(client, poller.INMASK)
+            events = dict(poller.poll(TESTING_TIMEOUT))
+            assert events.get(client.fileno()) == poller.OUTMASK
+
+            poller.unregister(client, poller.OUTMASK)
+            assert client.fileno() not in poller._registry
+
     def test_poller_registration_rollback(self):
         with self.socketpair() as (client, handler):
             r = [False]
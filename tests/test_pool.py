@@ -1,9 +1,11 @@
+import socket
+import time
 import unittest
 
 import greenhouse
 import greenhouse.poller
 
-from test_base import TESTING_TIMEOUT, StateClearingTestCase
+from test_base import TESTING_TIMEOUT, StateClearingTestCase, port
 
 
 class OneWayPoolTestCase(StateClearingTestCase):
@@ -204,5 +206,118 @@ class OrderedPoolTestCase(PoolTestCase):
         pool.close()
 
 
+class ConnectionPoolTestCase(StateClearingTestCase):
+    def setUp(self):
+        StateClearingTestCase.setUp(self)
+        self.server = greenhouse.Socket()
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(("127.0.0.1", port()))
+        self.server.listen(5)
+        self.handlers = []
+
+        @greenhouse.schedule
+        def f():
+            while 1:
+                self.handlers.append(self.server.accept()[0])
+
+    def tearDown(self):
+        self.server._sock.close()
+        StateClearingTestCase.tearDown(self)
+
+    def test_reuses_connections(self):
+        pool = greenhouse.ConnectionPool()
+        sock = pool.get("127.0.0.1", port())
+        pool.put(sock)
+        assert pool.get("127.0.0.1", port()) is sock
+        assert pool.stats['misses'] == 1
+        assert pool.stats['hits'] == 1
+
+    def test_drops_dead_connections(self):
+        pool = greenhouse.ConnectionPool()
+        with pool.connection("127.0.0.1", port()) as sock:
+            sock.sendall("howdy")
+
+        greenhouse.pause()
+        self.handlers[0]._sock.close()
+        time.sleep(TESTING_TIMEOUT)
+
+        assert pool.get("127.0.0.1", port()) is not sock
+        assert pool.stats['misses'] == 2
+
+    def test_discards_on_exception(self):
+        pool = greenhouse.ConnectionPool()
+        try:
+            with pool.connection("127.0.0.1", port()) as sock:
+                raise ValueError()
+        except ValueError:
+            pass
+        assert pool.get("127.0.0.1", port()) is not sock
+
+    def test_waits_when_exhausted(self):
+        pool = greenhouse.ConnectionPool(max_per_host=1)
+        sock = pool.get("127.0.0.1", port())
+        l = []
+
+        @greenhouse.schedule
+        def f():
+            l.append(pool.get("127.0.0.1", port()))
+
+        greenhouse.pause()
+        assert not l
+        assert pool.stats['waits'] == 1
+
+        pool.put(sock)
+        greenhouse.pause()
+        assert l == [sock]
+
+    def test_passes_on_discarded_slot(self):
+        pool = greenhouse.ConnectionPool(max_per_host=1)
+        sock = pool.get("127.0.0.1", port())
+        l = []
+
+        @greenhouse.schedule
+        def f():
+            l.append(pool.get("127.0.0.1", port()))
+
+        greenhouse.pause()
+        pool.put(sock, discard=True)
+        assert pool._open[("127.0.0.1", port())] == 1
+        while not l:
+            greenhouse.pause()
+        assert l[0] is not sock
+
+    def test_exhausted_timeout(self):
+        pool = greenhouse.ConnectionPool(max_per_host=1)
+        pool.get("127.0.0.1", port())
+        self.assertRaises(greenhouse.ConnectionPool.Exhausted, pool.get,
+                "127.0.0.1", port(), TESTING_TIMEOUT)
+        assert not pool._waiters[("127.0.0.1", port())]
+
+    def test_woken_waiter_leaves_no_timer(self):
+        pool = greenhouse.ConnectionPool(max_per_host=1)
+        sock = pool.get("127.0.0.1", port())
+        l = []
+
+        @greenhouse.schedule
+        def f():
+            l.append(pool.get("127.0.0.1", port(), TESTING_TIMEOUT * 10))
+
+        greenhouse.pause()
+        assert len(greenhouse._state.state.timed_paused) == 1
+        pool.put(sock)
+        greenhouse.pause()
+        assert l == [sock]
+        assert not greenhouse._state.state.timed_paused
+
+    def test_evicts_idle_connections(self):
+        pool = greenhouse.ConnectionPool(idle_timeout=TESTING_TIMEOUT)
+        pool.put(pool.get("127.0.0.1", port()))
+
+        greenhouse.pause_for(TESTING_TIMEOUT * 2)
+        assert pool.stats['evictions'] == 1
+        assert not pool._idle
+        assert not pool._open[("127.0.0.1", port())]
+
+
 if __name__ == '__main__':
     unittest.main()
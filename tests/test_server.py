@@ -0,0 +1,238 @@
+import errno
+import socket
+import time
+import unittest
+
+import greenhouse
+
+from test_base import TESTING_TIMEOUT, StateClearingTestCase, port
+
+
+class StreamServerTestCase(StateClearingTestCase):
+    def connect(self):
+        client = greenhouse.Socket()
+        client.connect(("127.0.0.1", port()))
+        return client
+
+    def test_serves_connections(self):
+        def handler(sock, address):
+            sock.sendall(sock.recv(5).upper())
+
+        server = greenhouse.StreamServer(("127.0.0.1", port()), handler)
+        server.start()
+        try:
+            client = self.connect()
+            client.sendall("howdy")
+            assert client.recv(5) == "HOWDY"
+        finally:
+            assert server.stop(TESTING_TIMEOUT)
+
+    def test_accepts_in_batches(self):
+        handled = []
+
+        def handler(sock, address):
+            handled.append(address)
+
+        server = greenhouse.StreamServer(("127.0.0.1", port()), handler)
+        server.start()
+        try:
+            clients = []
+            for i in xrange(10):
+                client = greenhouse.Socket()
+                client.connect_ex(("127.0.0.1", port()))
+                clients.append(client)
+            time.sleep(TESTING_TIMEOUT)
+
+            # the loop runs once to accept them all, then once for handlers
+            greenhouse.pause()
+            greenhouse.pause()
+            assert len(handled) == 10, len(handled)
+        finally:
+            server.stop(TESTING_TIMEOUT)
+
+    def test_accept_backs_off_when_out_of_descriptors(self):
+        handled = []
+
+        def handler(sock, address):
+            handled.append(address)
+
+        class FailingOnce(object):
+            def __init__(self, sock):
+                self._sock = sock
+                self.failed = False
+
+            def accept(self):
+                if not self.failed:
+                    self.failed = True
+                    raise socket.error(errno.EMFILE, "Too many open files")
+                return self._sock.accept()
+
+            def __getattr__(self, name):
+                return getattr(self._sock, name)
+
+        server = greenhouse.StreamServer(("127.0.0.1", port()), handler)
+        server.ACCEPT_BACKOFF = TESTING_TIMEOUT
+        listener = server.socket._sock = FailingOnce(server.socket._sock)
+        server.start()
+        try:
+            client = self.connect()
+            greenhouse.pause_for(TESTING_TIMEOUT * 2)
+            greenhouse.pause()
+            assert listener.failed
+            assert len(handled) == 1
+        finally:
+            assert server.stop(TESTING_TIMEOUT)
+
+    def test_max_connections(self):
+        release = greenhouse.Event()
+        handled = []
+
+        def handler(sock, address):
+            handled.append(address)
+            release.wait()
+
+        server = greenhouse.StreamServer(("127.0.0.1", port()), handler,
+                max_connections=2)
+        server.start()
+        try:
+            clients = [self.connect() for i in xrange(4)]
+            time.sleep(TESTING_TIMEOUT)
+            for i in xrange(5):
+                greenhouse.pause()
+            assert len(handled) == 2
+            assert server.connections == 2
+
+            release.set()
+            release.clear()
+            for i in xrange(5):
+                greenhouse.pause()
+            assert len(handled) == 4
+        finally:
+            release.set()
+            server.stop(TESTING_TIMEOUT)
+
+    def test_stop_waits_for_handlers(self):
+        finished = []
+
+        def handler(sock, address):
+            greenhouse.pause_for(TESTING_TIMEOUT)
+            finished.append(address)
+
+        server = greenhouse.StreamServer(("127.0.0.1", port()), handler)
+        server.start()
+        self.connect()
+        greenhouse.pause()
+        greenhouse.pause()
+
+        assert server.connections == 1
+        assert server.stop(TESTING_TIMEOUT * 4)
+        assert len(finished) == 1
+
+    def test_stop_times_out(self):
+        def handler(sock, address):
+            greenhouse.pause_for(TESTING_TIMEOUT * 4)
+
+        server = greenhouse.StreamServer(("127.0.0.1", port()), handler)
+        server.start()
+        self.connect()
+        greenhouse.pause()
+        greenhouse.pause()
+
+        assert not server.stop(TESTING_TIMEOUT)
+
+
+class DispatcherTestCase(StateClearingTestCase):
+    def setUp(self):
+        StateClearingTestCase.setUp(self)
+        if greenhouse.io.sendmsg_fds is None: #pragma: no cover
+            raise unittest.SkipTest("no descriptor passing here")
+
+    def channel(self):
+        left, right = socket.socketpair()
+        return greenhouse.Socket(fromsock=left), \
+                greenhouse.Socket(fromsock=right)
+
+    def test_workers_serve_connections(self):
+        front, back = self.channel()
+
+        def handler(sock, address):
+            sock.sendall(sock.recv(5).upper())
+
+        worker = greenhouse.Worker(back, handler)
+        greenhouse.schedule(worker.serve_forever)
+
+        dispatcher = greenhouse.Dispatcher(("127.0.0.1", port()), [front])
+        dispatcher.start()
+        try:
+            client = greenhouse.Socket()
+            client.connect(("127.0.0.1", port()))
+            client.sendall("howdy")
+            assert client.recv(5) == "HOWDY"
+        finally:
+            dispatcher.stop(TESTING_TIMEOUT)
+
+    def test_balances_by_reported_load(self):
+        release = greenhouse.Event()
+        channels = [self.channel() for i in xrange(2)]
+        handled = [[], []]
+
+        def make_handler(index):
+            def handler(sock, address):
+                handled[index].append(address)
+                if index == 0:
+                    release.wait()
+            return handler
+
+        for index, (front, back) in enumerate(channels):
+            worker = greenhouse.Worker(back, make_handler(index))
+            greenhouse.schedule(worker.serve_forever)
+
+        dispatcher = greenhouse.Dispatcher(("127.0.0.1", port()),
+                [front for front, back in channels])
+        dispatcher.start()
+        try:
+            clients = []
+            for i in xrange(6):
+                client = greenhouse.Socket()
+                client.connect(("127.0.0.1", port()))
+                clients.append(client)
+                for j in xrange(5):
+                    greenhouse.pause()
+
+            # the first worker holds on to its connection, while the second
+            # finishes each one and reports itself idle again
+            assert len(handled[0]) == 1, handled
+            assert len(handled[1]) == 5, handled
+            assert dispatcher.loads == [1, 0]
+        finally:
+            release.set()
+            dispatcher.stop(TESTING_TIMEOUT)
+
+    def test_skips_dead_workers(self):
+        channels = [self.channel() for i in xrange(2)]
+        handled = []
+
+        def handler(sock, address):
+            handled.append(address)
+
+        worker = greenhouse.Worker(channels[1][1], handler)
+        greenhouse.schedule(worker.serve_forever)
+        channels[0][1]._sock.close()
+
+        dispatcher = greenhouse.Dispatcher(("127.0.0.1", port()),
+                [front for front, back in channels])
+        dispatcher.start()
+        try:
+            greenhouse.pause()
+            for i in xrange(3):
+                client = greenhouse.Socket()
+                client.connect(("127.0.0.1", port()))
+                for j in xrange(5):
+                    greenhouse.pause()
+            assert len(handled) == 3
+        finally:
+            dispatcher.stop(TESTING_TIMEOUT)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import tempfile
+import unittest
+
+import greenhouse
+import greenhouse.ssl
+
+from test_base import TESTING_TIMEOUT, StateClearingTestCase, port
+
+
+def make_certificate(directory):
+    "create a self-signed certificate, returns (certfile, keyfile)"
+    keyfile = os.path.join(directory, "key.pem")
+    certfile = os.path.join(directory, "cert.pem")
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(["openssl", "req", "-x509", "-newkey",
+            "rsa:2048", "-nodes", "-days", "3650", "-subj", "/CN=localhost",
+            "-keyout", keyfile, "-out", certfile],
+            stdout=devnull, stderr=devnull)
+    return certfile, keyfile
+
+class SSLTestCase(StateClearingTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.certdir = tempfile.mkdtemp()
+        try:
+            cls.certfile, cls.keyfile = make_certificate(cls.certdir)
+        except (OSError, subprocess.CalledProcessError):
+            shutil.rmtree(cls.certdir)
+            raise unittest.SkipTest("couldn't create a test certificate")
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.certdir)
+
+    def setUp(self):
+        StateClearingTestCase.setUp(self)
+        self.server_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        self.server_context.load_cert_chain(self.certfile, self.keyfile)
+        self.client_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        self.client_context.verify_mode = ssl.CERT_REQUIRED
+        self.client_context.load_verify_locations(self.certfile)
+
+    def serve(self, handler):
+        def wrapped(sock, address):
+            handler(greenhouse.ssl.wrap_socket(sock, self.server_context,
+                server_side=True))
+        server = greenhouse.StreamServer(("127.0.0.1", port()), wrapped)
+        server.start()
+        return server
+
+    def connect(self, **kwargs):
+        sock = greenhouse.Socket()
+        sock.connect(("127.0.0.1", port()))
+        return greenhouse.ssl.wrap_socket(sock, self.client_context,
+                server_hostname="localhost", **kwargs)
+
+    def test_handshake_and_echo(self):
+        def handler(sock):
+            sock.sendall(sock.recv(5).upper())
+
+        server = self.serve(handler)
+        try:
+            client = self.connect()
+            assert client.getpeercert()['subject'] == \
+                    ((('commonName', 'localhost'),),)
+            client.sendall("howdy")
+            assert client.recv(5) == "HOWDY"
+        finally:
+            server.stop(TESTING_TIMEOUT)
+
+    def test_doesnt_block_other_greenlets(self):
+        ticks = []
+
+        def handler(sock):
+            sock.sendall(sock.recv(5))
+
+        @greenhouse.schedule
+        def f():
+            for i in xrange(3):
+                ticks.append(i)
+                greenhouse.pause()
+
+        server = self.serve(handler)
+        try:
+            client = self.connect()
+            client.sendall("howdy")
+            assert client.recv(5) == "howdy"
+            assert ticks == [0, 1, 2]
+        finally:
+            server.stop(TESTING_TIMEOUT)
+
+    def test_large_transfers(self):
+        data = os.urandom(4 * 1024 * 1024)
+
+        def handler(sock):
+            sock.sendall(data)
+
+        server = self.serve(handler)
+        try:
+            client = self.connect()
+            stream = greenhouse.Stream(client)
+            assert stream.readexactly(len(data)) == data
+        finally:
+            server.stop(TESTING_TIMEOUT)
+
+    def test_read_timeout(self):
+        def handler(sock):
+            greenhouse.pause_for(TESTING_TIMEOUT * 4)
+
+        server = self.serve(handler)
+        try:
+            client = self.connect()
+            client.settimeout(TESTING_TIMEOUT)
+            self.assertRaises(socket.timeout, client.recv, 10)
+        finally:
+            server.stop(TESTING_TIMEOUT * 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -554,6 +554,221 @@ class QueueTestCase(StateClearingTestCase):
         q.put(7)
         assert q.qsize() == 3
 
+    def test_put_hands_off_to_getter(self):
+        q = greenhouse.Queue()
+        l = []
+
+        @greenhouse.schedule
+        def f():
+            l.append(q.get())
+
+        greenhouse.pause()
+        q.put(5)
+        assert q.empty()
+        assert q.unfinished_tasks == 1
+
+        greenhouse.pause()
+        assert l == [5]
+
+    def test_blocked_puts_keep_order(self):
+        q = greenhouse.Queue(1)
+        q.put(1)
+
+        for i in (2, 3):
+            greenhouse.schedule(q.put, (i,))
+        greenhouse.pause()
+        assert q.qsize() == 1
+
+        assert [q.get(), q.get(), q.get()] == [1, 2, 3]
+        assert q.empty()
+
+    def test_put_timeout(self):
+        q = greenhouse.Queue(1)
+        q.put(1)
+        self.assertRaises(q.Full, q.put, 2, timeout=TESTING_TIMEOUT)
+        assert q.unfinished_tasks == 1
+        assert not q._putters
+
+    def test_timeout_cleans_up(self):
+        q = greenhouse.Queue()
+        self.assertRaises(q.Empty, q.get, timeout=TESTING_TIMEOUT)
+        assert not q._getters
+
+        q.put(1)
+        assert q.get() == 1
+
+    def test_handoff_cancels_timeout(self):
+        q = greenhouse.Queue()
+        l = []
+
+        @greenhouse.schedule
+        def f():
+            l.append(q.get(timeout=TESTING_TIMEOUT * 10))
+
+        greenhouse.pause()
+        assert len(greenhouse._state.state.timed_paused) == 1
+        q.put(1)
+        assert not greenhouse._state.state.timed_paused
+
+        greenhouse.pause()
+        assert l == [1]
+
+    def test_put_many(self):
+        q = greenhouse.Queue()
+        q.put_many([1, 2, 3])
+        assert q.qsize() == 3
+        assert q.unfinished_tasks == 3
+        assert [q.get(), q.get(), q.get()] == [1, 2, 3]
+
+    def test_put_many_blocks_once(self):
+        q = greenhouse.Queue(2)
+        l = []
+
+        @greenhouse.schedule
+        def f():
+            q.put_many(range(5))
+            l.append(True)
+
+        greenhouse.pause()
+        assert q.qsize() == 2
+        assert not l
+
+        assert q.get() == 0
+        assert q.qsize() == 2
+        assert not l
+
+        # taking items lets the rest in as it goes
+        assert q.get_many(3) == [1, 2, 3]
+        assert q.qsize() == 1
+
+        greenhouse.pause()
+        assert l == [True]
+        assert q.get() == 4
+
+    def test_put_many_nonblocking_raises_full(self):
+        q = greenhouse.Queue(2)
+        self.assertRaises(q.Full, q.put_many, [1, 2, 3], False)
+        assert q.get_many(5) == [1, 2]
+
+    def test_get_many(self):
+        q = greenhouse.Queue()
+        self.assertRaises(q.Empty, q.get_many, 3, False)
+        self.assertRaises(q.Empty, q.get_many, 3, timeout=TESTING_TIMEOUT)
+
+        q.put_many([1, 2, 3, 4])
+        assert q.get_many(3) == [1, 2, 3]
+        assert q.get_many(3) == [4]
+
+    def test_get_many_blocks_until_anything(self):
+        q = greenhouse.Queue()
+        l = []
+
+        @greenhouse.schedule
+        def f():
+            l.append(q.get_many(3))
+
+        greenhouse.pause()
+        q.put(1)
+        q.put(2)
+        greenhouse.pause()
+        assert l == [[1, 2]]
+
+    def test_get_batch(self):
+        q = greenhouse.Queue()
+        l = []
+
+        @greenhouse.schedule
+        def f():
+            l.append(q.get_batch(3))
+
+        q.put(1)
+        greenhouse.pause()
+        q.put_many([2, 3, 4])
+        assert q.qsize() == 1
+        assert q.unfinished_tasks == 4
+
+        greenhouse.pause()
+        assert l == [[1, 2, 3]]
+
+    def test_get_batch_max_wait(self):
+        q = greenhouse.Queue()
+        q.put(1)
+        assert q.get_batch(3, TESTING_TIMEOUT) == [1]
+        assert q.get_batch(3, TESTING_TIMEOUT) == []
+        assert not q._getters
+
+        q.task_done()
+        self.assertRaises(ValueError, q.task_done)
+
+class PriorityQueueTestCase(StateClearingTestCase):
+    def test_priority_order(self):
+        q = greenhouse.PriorityQueue()
+        for item in [(3, "c"), (1, "a"), (2, "b")]:
+            q.put(item)
+        assert q.get_many(3) == [(1, "a"), (2, "b"), (3, "c")]
+
+    def test_plain_items(self):
+        q = greenhouse.PriorityQueue()
+        q.put_many([5, 2, 8, 1])
+        assert [q.get() for i in xrange(4)] == [1, 2, 5, 8]
+
+    def test_equal_priorities_are_fifo(self):
+        q = greenhouse.PriorityQueue()
+        q.put((1, {"second": 1}))
+        q.put((0, {"first": 1}))
+        q.put((1, {"third": 1}))
+        assert q.get() == (0, {"first": 1})
+        assert q.get() == (1, {"second": 1})
+        assert q.get() == (1, {"third": 1})
+
+    def test_blocking_handoff(self):
+        q = greenhouse.PriorityQueue()
+        l = []
+
+        @greenhouse.schedule
+        def f():
+            l.append(q.get())
+
+        greenhouse.pause()
+        q.put((2, "b"))
+        q.put((1, "a"))
+        greenhouse.pause()
+        assert l == [(2, "b")]
+        assert q.get() == (1, "a")
+
+    def test_maxsize(self):
+        q = greenhouse.PriorityQueue(2)
+        q.put(3)
+        q.put(2)
+        self.assertRaises(q.Full, q.put, 1, timeout=TESTING_TIMEOUT)
+
+        greenhouse.schedule(q.put, (1,))
+        greenhouse.pause()
+        assert q.get() == 2
+        assert q.get() == 1
+        assert q.get() == 3
+
+        for i in xrange(3):
+            q.task_done()
+        self.assertRaises(ValueError, q.task_done)
+
+class LifoQueueTestCase(StateClearingTestCase):
+    def test_lifo_order(self):
+        q = greenhouse.LifoQueue()
+        q.put_many([1, 2, 3])
+        assert [q.get() for i in xrange(3)] == [3, 2, 1]
+
+    def test_blocking(self):
+        q = greenhouse.LifoQueue(1)
+        q.put(1)
+        greenhouse.schedule(q.put, (2,))
+        greenhouse.pause()
+        assert q.qsize() == 1
+
+        assert q.get() == 1
+        assert q.get() == 2
+        self.assertRaises(q.Empty, q.get, timeout=TESTING_TIMEOUT)
+
 class ChannelTestCase(StateClearingTestCase):
     def recver(self, channel, aggregator):
         return lambda: aggregator.append(channel.receive())
@@ -663,6 +878,138 @@ class ChannelTestCase(StateClearingTestCase):
         greenhouse.pause() # now the sender greenlets will finish
         assert len(sendcounter) == 20
 
+    def test_buffered_send_doesnt_block(self):
+        ch = greenhouse.utils.Channel(2)
+        ch.send(1)
+        ch.send(2)
+        assert ch.balance == 2
+
+        l = []
+
+        @greenhouse.schedule
+        def f():
+            ch.send(3)
+            l.append(True)
+
+        greenhouse.pause()
+        assert not l
+        assert ch.balance == 3
+
+        assert ch.receive() == 1
+        greenhouse.pause()
+        assert l == [True]
+        assert [ch.receive(), ch.receive()] == [2, 3]
+        assert ch.balance == 0
+
+    def test_buffered_close(self):
+        ch = greenhouse.utils.Channel(2)
+        ch.send(1)
+        ch.close()
+        assert not ch.closed
+        assert list(ch) == [1]
+        assert ch.closed
+
+class SelectTestCase(StateClearingTestCase):
+    def test_ready_receive(self):
+        a = greenhouse.utils.Channel(1)
+        b = greenhouse.utils.Channel(1)
+        b.send("howdy")
+        assert greenhouse.utils.select([a, b]) == (1, "howdy")
+
+    def test_ready_send(self):
+        a = greenhouse.utils.Channel()
+        b = greenhouse.utils.Channel(1)
+        assert greenhouse.utils.select([(a, 1), (b, 2)]) == (1, None)
+        assert b.receive() == 2
+
+    def test_blocks_and_cancels_the_rest(self):
+        a = greenhouse.utils.Channel()
+        b = greenhouse.utils.Channel()
+        c = greenhouse.utils.Channel()
+        l = []
+
+        @greenhouse.schedule
+        def f():
+            l.append(greenhouse.utils.select([a, (b, "sent"), c]))
+
+        greenhouse.pause()
+        assert a.balance == -1 and b.balance == 1 and c.balance == -1
+
+        c.send("howdy")
+        greenhouse.pause()
+        assert l == [(2, "howdy")]
+        assert a.balance == b.balance == c.balance == 0
+
+    def test_blocked_send(self):
+        a = greenhouse.utils.Channel()
+        b = greenhouse.utils.Channel()
+        l = []
+
+        @greenhouse.schedule
+        def f():
+            l.append(greenhouse.utils.select([a, (b, "sent")]))
+
+        greenhouse.pause()
+        assert b.receive() == "sent"
+        greenhouse.pause()
+        assert l == [(1, None)]
+        assert a.balance == 0
+
+    def test_nonblocking(self):
+        a = greenhouse.utils.Channel()
+        assert greenhouse.utils.select([a, (a, 1)], blocking=False) == \
+                (None, None)
+        assert a.balance == 0
+
+    def test_timeout(self):
+        a = greenhouse.utils.Channel()
+        assert greenhouse.utils.select([a], TESTING_TIMEOUT) == (None, None)
+        assert a.balance == 0
+        assert not greenhouse._state.state.timed_paused
+
+    def test_wakeup_cancels_timeout(self):
+        a = greenhouse.utils.Channel()
+        l = []
+
+        @greenhouse.schedule
+        def f():
+            l.append(greenhouse.utils.select([a], TESTING_TIMEOUT * 10))
+
+        greenhouse.pause()
+        a.send(1)
+        assert not greenhouse._state.state.timed_paused
+        greenhouse.pause()
+        assert l == [(0, 1)]
+
+    def test_closed_channels(self):
+        a = greenhouse.utils.Channel()
+        a.close()
+        self.assertRaises(StopIteration, greenhouse.utils.select, [a])
+
+        b = greenhouse.utils.Channel(1)
+        assert greenhouse.utils.select([a, (b, 1)]) == (1, None)
+
+    def test_losing_senders_are_skipped(self):
+        a = greenhouse.utils.Channel()
+        b = greenhouse.utils.Channel()
+
+        @greenhouse.schedule
+        def f():
+            greenhouse.utils.select([(a, 1), (b, 2)])
+
+        greenhouse.pause()
+        assert a.receive() == 1
+        assert not b._can_receive()
+
+        # the losing send on b is gone, so a receive has to wait
+        l = []
+        greenhouse.schedule(lambda: l.append(b.receive()))
+        greenhouse.pause()
+        assert not l
+        b.send(3)
+        greenhouse.pause()
+        assert l == [3]
+
 
 if __name__ == '__main__':
     unittest.main()